@@ -31,7 +31,10 @@ from .secrets import SecretsStore
 from . import get_version
 from .config import config as mlconf
 from .builder import upload_tarball
-from .db import get_run_db
+from .db import FileRunDB, SQLDB, get_run_db
+from .db.export import RunExport
+from .db.shardeddb import ShardedSQLDB, parse_shards
+from .db.sqldb import create_indexes, missing_indexes
 from .k8s_utils import K8sHelper
 from .model import RunTemplate
 from .run import new_function, import_function_to_dict, import_function, get_object
@@ -425,11 +428,15 @@ def get(kind, name, selector, namespace, uid, project, tag, db, extra_args):
         print('currently only get pods | runs | artifacts | func [name] are supported')
 
 
-@main.command()
+@main.group(invoke_without_command=True)
 @click.option('--port', '-p', help='port to listen on', type=int)
 @click.option('--dirpath', '-d', help='database directory (dirpath)')
-def db(port, dirpath):
-    """Run HTTP api/database server"""
+@click.pass_context
+def db(ctx, port, dirpath):
+    """Run HTTP api/database server (or a db maintenance command)"""
+    if ctx.invoked_subcommand is not None:
+        return
+
     env = environ.copy()
     if port is not None:
         env['MLRUN_httpdb__port'] = str(port)
@@ -443,6 +450,181 @@ def db(port, dirpath):
         raise SystemExit(returncode)
 
 
+@db.command()
+@click.option('--dsn', help='SQL database DSN (default: httpdb.dsn)')
+@click.option('--format', 'body_format', default='json', show_default=True,
+              type=click.Choice(['json', 'pickle']), help='target body format')
+@click.option('--batch-size', type=int, default=1000, show_default=True,
+              help='rows per transaction')
+def migrate(dsn, body_format, batch_size):
+    """Convert stored run/artifact/function bodies to a new format"""
+    sqldb = SQLDB(dsn or mlconf.httpdb.dsn, body_format=body_format).connect()
+    counts = sqldb.migrate_bodies(batch_size=batch_size)
+    for table, count in counts.items():
+        print('{:12} {} rows'.format(table, count))
+
+
+@db.command()
+@click.option('--dsn', help='SQL database DSN (default: httpdb.dsn)')
+@click.option('--train', is_flag=True,
+              help='train a compression dictionary per table')
+@click.option('--samples', type=int, default=1000, show_default=True,
+              help='bodies per table to train on')
+@click.option('--recompress', is_flag=True,
+              help='compress existing bodies (httpdb.compression)')
+def compress(dsn, train, samples, recompress):
+    """Train compression dictionaries, show stored vs raw body bytes"""
+    sqldb = SQLDB(dsn or mlconf.httpdb.dsn).connect()
+    if train:
+        for table, dict_id in sqldb.train_compression(
+                samples=samples).items():
+            print('{:12} dictionary {}'.format(table, dict_id))
+    if recompress:
+        sqldb.migrate_bodies()
+    for table, stats in sqldb.storage_stats().items():
+        ratio = stats['raw_bytes'] / (stats['stored_bytes'] or 1)
+        print('{:12} {:8} rows {:8} compressed {:12} bytes ({:.1f}x)'.format(
+            table, stats['rows'], stats['compressed_rows'],
+            stats['stored_bytes'], ratio))
+
+
+@db.command()
+@click.option('--dsn', help='SQL database DSN (default: httpdb.dsn)')
+@click.option('--dirpath', '-d', help='file database directory (default: '
+              'httpdb.dirpath if httpdb.db_type is not sqldb)')
+@click.option('--path', 'archive_path',
+              help='archive URL (default: httpdb.archive_path)')
+@click.option('--days', type=int, help='archive runs older than days '
+              '(default: httpdb.archive_days)')
+@click.option('--project', '-p', help='archive only this project')
+@click.option('--batch-size', type=int, default=500, show_default=True,
+              help='rows per transaction')
+def archive(dsn, dirpath, archive_path, days, project, batch_size):
+    """Move old runs, logs and artifacts to Parquet cold storage"""
+    if archive_path:
+        mlconf.httpdb.archive_path = archive_path
+    days = mlconf.httpdb.archive_days if days is None else days
+    if not days:
+        print('archive days must be > 0 (--days)')
+        exit(1)
+    if dirpath or (not dsn and mlconf.httpdb.db_type != 'sqldb'):
+        mldb = FileRunDB(dirpath or mlconf.httpdb.dirpath).connect()
+    else:
+        mldb = SQLDB(dsn or mlconf.httpdb.dsn).connect()
+    counts = mldb.archive_runs(days, project, batch_size)
+    for kind, count in counts.items():
+        print('{:12} {} archived'.format(kind, count))
+
+
+@db.command()
+@click.option('--dsn', help='SQL database DSN (default: httpdb.dsn)')
+@click.option('--shards', help='"name=dsn,..." (default: httpdb.shards)')
+@click.option('--move', 'project', help='project to move')
+@click.option('--to', 'shard', help='shard to move the project to')
+@click.option('--batch-size', type=int, default=500, show_default=True,
+              help='rows per transaction')
+def shards(dsn, shards, project, shard, batch_size):
+    """List project shard routes, move a project to another shard"""
+    shards = parse_shards(shards) if shards else None
+    sdb = ShardedSQLDB(dsn or mlconf.httpdb.dsn, shards).connect()
+    if project:
+        if not shard:
+            print('missing --to shard')
+            exit(1)
+        for table, count in sdb.move_project(
+                project, shard, batch_size).items():
+            print('{:12} {} rows copied'.format(table, count))
+    for name, db in sdb.shards.items():
+        print('{:12} {}'.format(name, db.dsn))
+    for name, shard in sorted(sdb.routes().items()):
+        print('  {} → {}'.format(name, shard))
+
+
+@db.command()
+@click.argument('path', type=str)
+@click.option('--project', '-p', help='project name')
+@click.option('--db', help='db path/url (default: dbpath)')
+def export(path, project, db):
+    """Append runs new since the last export to Parquet files in path"""
+    mldb = get_run_db(db or mlconf.dbpath).connect()
+    count = RunExport(path).export(mldb, project or '')
+    print('exported {} runs'.format(count))
+
+
+@db.command()
+@click.option('--dsn', help='SQL database DSN (default: httpdb.dsn)')
+@click.option('--create', is_flag=True, help='create missing indexes')
+@click.option('--explain', is_flag=True,
+              help='show query plans of the hot queries')
+@click.option('--project', '-p', help='project name for --explain')
+def indexes(dsn, create, explain, project):
+    """List (and create) missing indexes, show the indexes queries use"""
+    sqldb = SQLDB(dsn or mlconf.httpdb.dsn).connect()
+    missing = [idx.name for idx in missing_indexes(sqldb.engine)]
+    if create and missing:
+        for name in create_indexes(sqldb.engine):
+            print('created index {}'.format(name))
+    elif missing:
+        print('missing indexes (use --create):')
+        for name in missing:
+            print('  {}'.format(name))
+    else:
+        print('all indexes exist')
+
+    if explain:
+        for name, info in sqldb.explain_queries(project).items():
+            print('\n{}: uses {}'.format(
+                name, ', '.join(info['indexes']) or 'no index'))
+            for line in info['plan']:
+                print('  {}'.format(line))
+
+
+@db.command('file-index')
+@click.option('--dirpath', '-d', help='database directory '
+              '(default: httpdb.dirpath)')
+@click.option('--project', '-p', help='rebuild only this project')
+@click.option('--table', 'tables', multiple=True,
+              type=click.Choice(['runs', 'artifacts', 'functions']),
+              help='table to rebuild (default all)')
+def file_index(dirpath, project, tables):
+    """Rebuild the list indexes of a file database"""
+    filedb = FileRunDB(dirpath or mlconf.httpdb.dirpath).connect()
+    counts = filedb.rebuild_index(tables or None, project or '')
+    for table, count in counts.items():
+        print('{:12} {} files'.format(table, count))
+
+
+@db.command('file-format')
+@click.argument('format', type=click.Choice(['.yaml', '.json', '.msgpack']))
+@click.option('--dirpath', '-d', help='database directory '
+              '(default: httpdb.dirpath)')
+@click.option('--table', 'tables', multiple=True,
+              type=click.Choice(['runs', 'artifacts', 'functions',
+                                 'schedules']),
+              help='table to convert (default all)')
+def file_format(format, dirpath, tables):
+    """Convert the files of a file database to format"""
+    filedb = FileRunDB(dirpath or mlconf.httpdb.dirpath).connect()
+    counts = filedb.convert_format(format, tables or None)
+    for table, count in counts.items():
+        print('{:12} {} files converted'.format(table, count))
+
+
+@db.command('file-layout')
+@click.argument('layout', type=click.Choice(['flat', 'hashed']))
+@click.option('--dirpath', '-d', help='database directory '
+              '(default: httpdb.dirpath)')
+@click.option('--project', '-p', help='migrate only this project')
+@click.option('--levels', type=int, help='hash directory levels '
+              '(default: httpdb.file_layout_levels)')
+def file_layout(layout, dirpath, project, levels):
+    """Move the run and artifact files of a file database to layout"""
+    filedb = FileRunDB(dirpath or mlconf.httpdb.dirpath).connect()
+    counts = filedb.migrate_layout(layout, project or '', levels)
+    for table, count in counts.items():
+        print('{:12} {} files moved'.format(table, count))
+
+
 @main.command()
 def version():
     """get mlrun version"""
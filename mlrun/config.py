@@ -69,6 +69,89 @@ default_config = {
         'data_volume': '',
         'real_path': '',
         'db_type': 'sqldb',
+        # body serialization for new SQLDB rows, "pickle" or "json"
+        'body_format': 'pickle',
+        # store runs, artifacts and functions with a single INSERT .. ON
+        # CONFLICT per table (SQLite 3.24+, PostgreSQL and MySQL)
+        'native_upsert': True,
+        # project sharding (see db.ShardedSQLDB), "name=dsn,..." databases
+        # besides dsn (shard "default", holds the project → shard routes).
+        # Projects without a route are in shard_default.
+        'shards': '',
+        'shard_default': 'default',
+        'shard_routes_ttl': 10,  # seconds
+        # stored body (and full log chunk) compression, "" (none) or "zstd"
+        # (needs zstandard). "mlrun db compress --train" trains a dictionary
+        # per table used for new bodies.
+        'compression': '',
+        'compression_level': 3,
+        'compression_min_size': 64,  # bytes, smaller bodies are stored as is
+        'compression_dict_size': 32768,
+        # SQL connection pool (not used for in memory SQLite)
+        'pool_size': 10,
+        'pool_max_overflow': 20,
+        'pool_recycle': 3600,
+        'pool_timeout': 30,
+        # SQLDB logs are stored in chunks of this many bytes
+        'log_chunk_size': 65536,
+        # API server read cache of runs, functions and artifacts (see
+        # db.CachedRunDB), cache_size 0 disables it
+        'cache_size': 0,
+        'cache_ttl': 10,  # seconds
+        # SQLDB tag → uid cache, ttl 0 disables it
+        'tag_cache_size': 1024,
+        'tag_cache_ttl': 30,  # seconds
+        # run retention (SQLDB), 0 is keep forever. retention_days deletes
+        # runs started (and untagged artifacts updated) before that,
+        # retention_runs keeps only the last N runs per name.
+        'retention_days': 0,
+        'retention_runs': 0,
+        # per project override - "project:days:runs,...", e.g. "iris:7:0"
+        'retention_projects': '',
+        'retention_interval': 600,  # seconds
+        'retention_batch_size': 500,
+        'retention_batch_delay': 0.1,  # seconds between delete batches
+        # cold storage of old runs, logs and artifacts in Parquet files
+        # (see db.RunArchive), archive_path is a data store URL (file path,
+        # s3://, v3io://). archive_days 0 disables periodic archiving.
+        'archive_path': '',
+        'archive_days': 0,
+        'archive_interval': 3600,  # seconds
+        'archive_batch_size': 500,
+        # FileRunDB keeps a JSON lines index per table directory (filters
+        # and sort keys of the list methods) so lists read only the files
+        # they return. "mlrun db index" rebuilds it.
+        'file_index': True,
+        # FileRunDB format of written files - .yaml, .json (orjson when
+        # installed) or .msgpack (needs msgpack), files of other formats are
+        # read as well. "mlrun db file-format" converts a db.
+        'file_format': '.yaml',
+        # FileRunDB threads reading and decoding files (1 reads in the
+        # calling thread). Without the index list_runs(last=N) reads run
+        # files newest (mtime) first and stops once N runs started after
+        # the next file was modified (+ file_mtime_slack for clock skew
+        # between clients and a network file system).
+        'file_load_workers': 8,
+        'file_mtime_slack': 60,  # seconds
+        # FileRunDB layout of new run and artifact directories - "flat"
+        # (runs/<project>/<uid>.yaml) or "hashed" (runs/<project>/ab/cd/
+        # <uid>.yaml, file_layout_levels directories named by a hash of the
+        # uid or artifact tree). Directories keep their layout in a manifest,
+        # "mlrun db file-layout" migrates them.
+        'file_layout': 'flat',
+        'file_layout_levels': 2,
+        # FileRunDB files are written to a temp file renamed over the object
+        # file, file_fsync syncs it first (durable on power loss, slower)
+        'file_fsync': False,
+        # FileRunDB write-behind, seconds stored runs are kept in memory
+        # (repeated writes of a run are coalesced), 0 writes through. Runs
+        # are written on this timer, on run context commit() and at exit.
+        'file_write_behind': 0,
+        # FileRunDB on an object store (S3, v3io): files listed per page,
+        # decoded files cached by etag (file_cache_size 0 disables it)
+        'file_list_page_size': 1000,
+        'file_cache_size': 4096,
+        'file_cache_ttl': 300,  # seconds
     },
 }
 
@@ -28,10 +28,11 @@ if not verify_ssl:
 
 
 class FileStats:
-    def __init__(self, size, modified, content_type=None):
+    def __init__(self, size, modified, content_type=None, etag=None):
         self.size = size
         self.modified = modified
         self.content_type = content_type
+        self.etag = etag  # changes when the file content changes
 
 
 class DataStore:
@@ -88,6 +89,20 @@ class DataStore:
     def listdir(self, key):
         raise ValueError('data store doesnt support listdir')
 
+    def list_files(self, key, page_size=1000, recursive=True):
+        """Pages (lists) of (path, FileStats) of the files under key
+
+        Paths are relative to key. Without recursive the direct children
+        are listed, with None stats for directories. The default lists
+        listdir(key) in one page.
+        """
+        key = key.rstrip('/')
+        yield [(name, self.stat(f'{key}/{name}'))
+               for name in self.listdir(key)]
+
+    def delete(self, key):
+        raise ValueError('data store doesnt support delete')
+
     def download(self, key, target_path):
         data = self.get(key)
         mode = 'wb'
@@ -251,6 +266,17 @@ def http_put(url, data, headers=None, auth=None):
             'failed to upload to {} {}'.format(url, resp.status_code))
 
 
+def http_delete(url, headers=None, auth=None):
+    try:
+        resp = requests.delete(
+            url, headers=headers, auth=auth, verify=verify_ssl)
+    except OSError as e:
+        raise OSError('error: cannot connect to {}: {}'.format(url, e))
+    if not resp.ok:
+        raise OSError(
+            'failed to delete {} {}'.format(url, resp.status_code))
+
+
 def http_upload(url, file_path, headers=None, auth=None):
     with open(file_path, 'rb') as data:
         http_put(url, data, headers, auth)
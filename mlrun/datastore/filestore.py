@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from os import path, makedirs, listdir, stat
+from os import path, makedirs, listdir, remove, scandir, stat, walk
 from shutil import copyfile
 
 from .base import DataStore, FileStats
@@ -64,7 +64,43 @@ class FileStore(DataStore):
 
     def stat(self, key):
         s = stat(self._join(key))
-        return FileStats(size=s.st_size, modified=s.st_mtime)
+        return FileStats(
+            size=s.st_size, modified=s.st_mtime, etag=_etag(s))
 
     def listdir(self, key):
         return listdir(key)
+
+    def list_files(self, key, page_size=1000, recursive=True):
+        root = self._join(key)
+        if not path.isdir(root):
+            return
+        page = []
+        if not recursive:
+            for entry in scandir(root):
+                s = entry.stat()
+                page.append((entry.name, None if entry.is_dir() else
+                             FileStats(s.st_size, s.st_mtime, etag=_etag(s))))
+            yield page
+            return
+        for dirpath, _, names in walk(root):
+            for name in names:
+                filepath = path.join(dirpath, name)
+                try:
+                    s = stat(filepath)
+                except FileNotFoundError:  # Deleted while listing
+                    continue
+                page.append((
+                    path.relpath(filepath, root),
+                    FileStats(s.st_size, s.st_mtime, etag=_etag(s))))
+                if len(page) >= page_size:
+                    yield page
+                    page = []
+        if page:
+            yield page
+
+    def delete(self, key):
+        remove(self._join(key))
+
+
+def _etag(s):
+    return '{:x}-{:x}'.format(s.st_mtime_ns, s.st_size)
@@ -50,7 +50,8 @@ class S3Store(DataStore):
         obj = self.s3.Object(self.endpoint, self._join(key)[1:])
         size = obj.content_length
         modified = obj.last_modified
-        return FileStats(size, time.mktime(modified.timetuple()))
+        return FileStats(size, time.mktime(modified.timetuple()),
+                         etag=obj.e_tag.strip('"'))
 
     def listdir(self, key):
         if not key.endswith('/'):
@@ -59,4 +60,30 @@ class S3Store(DataStore):
         bucket = self.s3.Bucket(self.endpoint)
         return [obj.key[l:] for obj in bucket.objects.filter(Prefix=key)]
 
+    def list_files(self, key, page_size=1000, recursive=True):
+        prefix = self._join(key)[1:]
+        if not prefix.endswith('/'):
+            prefix += '/'
+        kw = {
+            'Bucket': self.endpoint,
+            'Prefix': prefix,
+            'PaginationConfig': {'PageSize': page_size},
+        }
+        if not recursive:
+            kw['Delimiter'] = '/'
+        paginator = self.s3.meta.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**kw):
+            items = [
+                (item['Prefix'][len(prefix):].rstrip('/'), None)
+                for item in page.get('CommonPrefixes', [])]
+            items.extend(
+                (obj['Key'][len(prefix):], FileStats(
+                    obj['Size'], obj['LastModified'].timestamp(),
+                    etag=obj['ETag'].strip('"')))
+                for obj in page.get('Contents', []))
+            yield items
+
+    def delete(self, key):
+        self.s3.Object(self.endpoint, self._join(key)[1:]).delete()
+
 
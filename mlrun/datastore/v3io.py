@@ -20,7 +20,7 @@ import v3io.dataplane
 
 from ..platforms.iguazio import split_path
 from .base import (DataStore, FileStats, basic_auth_header, get_range,
-                   http_get, http_put, http_head, http_upload)
+                   http_delete, http_get, http_put, http_head, http_upload)
 
 
 V3IO_LOCAL_ROOT = 'v3io'
@@ -87,3 +87,47 @@ class V3ioStore(DataStore):
 
         # todo: full = key, size, last_modified
         return [obj.key[l:] for obj in response.output.contents]
+
+    def list_files(self, key, page_size=1000, recursive=True):
+        v3io_client = v3io.dataplane.Client(endpoint=self.endpoint,
+                                            access_key=self.token)
+        container, subpath = split_path(self._join(key))
+        if not subpath.endswith('/'):
+            subpath += '/'
+        prefix_len = len(subpath) - 1
+        dirs = [subpath]
+        while dirs:
+            dirpath, marker = dirs.pop(), None
+            while True:
+                output = v3io_client.get_container_contents(
+                    container=container, path=dirpath,
+                    get_all_attributes=False, directories_only=False,
+                    limit=page_size, marker=marker).output
+                items = []
+                for prefix in output.common_prefixes:
+                    if recursive:
+                        dirs.append('/' + prefix.prefix.lstrip('/'))
+                    else:
+                        name = prefix.prefix[prefix_len:].rstrip('/')
+                        items.append((name, None))
+                for obj in output.contents:
+                    modified = getattr(obj, 'last_modified', '')
+                    size = getattr(obj, 'size', 0)
+                    items.append((obj.key[prefix_len:], FileStats(
+                        size, _parse_time(modified),
+                        etag=f'{modified}-{size}')))
+                yield items
+                if str(output.is_truncated).lower() != 'true':
+                    break
+                marker = output.next_marker
+
+    def delete(self, key):
+        http_delete(self.url + self._join(key), self.headers)
+
+
+def _parse_time(value):
+    try:
+        return datetime.strptime(
+            value[:19], '%Y-%m-%dT%H:%M:%S').timestamp()
+    except ValueError:
+        return 0
@@ -14,9 +14,11 @@
 from urllib.parse import urlparse
 
 from ..config import config
-from .base import RunDBError, RunDBInterface  # noqa
+from .base import RunDBConflictError, RunDBError, RunDBInterface  # noqa
+from .cachedb import CachedRunDB  # noqa
 from .filedb import FileRunDB
 from .httpdb import HTTPRunDB
+from .shardeddb import ShardedSQLDB  # noqa
 from .sqldb import SQLDB
 from os import environ
 
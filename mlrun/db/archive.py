@@ -0,0 +1,146 @@
+# Copyright 2019 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cold storage of old runs, logs and artifacts in Parquet files
+
+Archived objects leave a stub in the database pointing to the archive
+file they were written to (see SQLDB.archive_runs), reads of a stub fetch
+the object from the file.
+"""
+
+import json
+from datetime import date, datetime
+from io import BytesIO
+from uuid import uuid4
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ..datastore import StoreManager
+from .base import RunDBError
+from .cachedb import LRUCache
+
+# kind → (file schema, columns identifying a row)
+schemas = {
+    'runs': (pa.schema([
+        ('project', pa.string()),
+        ('uid', pa.string()),
+        ('iteration', pa.int64()),
+        ('name', pa.string()),
+        ('state', pa.string()),
+        ('start_time', pa.timestamp('us')),
+        ('labels', pa.string()),  # JSON
+        ('body', pa.binary()),  # JSON
+    ]), ('project', 'uid', 'iteration')),
+    'logs': (pa.schema([
+        ('project', pa.string()),
+        ('uid', pa.string()),
+        ('body', pa.binary()),
+    ]), ('project', 'uid')),
+    'artifacts': (pa.schema([
+        ('project', pa.string()),
+        ('key', pa.string()),
+        ('uid', pa.string()),
+        ('updated', pa.timestamp('us')),
+        ('labels', pa.string()),
+        ('body', pa.binary()),
+    ]), ('project', 'key', 'uid')),
+}
+
+
+def _json_default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    return str(obj)
+
+
+def encode_struct(struct):
+    return json.dumps(struct, default=_json_default).encode('utf-8')
+
+
+def decode_struct(data):
+    return json.loads(data)
+
+
+def month(ts):
+    """Archive partition (YYYY-MM) of ts"""
+    return ts.strftime('%Y-%m') if ts else 'unknown'
+
+
+class RunArchive:
+    """Write once Parquet files in a data store (file, s3, v3io)
+
+    Files are <url>/<kind>/project=<project>/month=<YYYY-MM>/<id>.parquet,
+    rows of the same project and month archived together go to one file.
+    """
+
+    def __init__(self, url, secrets=None, cache_size=16):
+        self.url = url.rstrip('/')
+        self._store, subpath = StoreManager(secrets).get_or_create_store(
+            self.url)
+        self._subpath = subpath.rstrip('/')
+        # Files never change, cache the last ones read
+        self._cache = LRUCache(cache_size, ttl=3600)
+
+    def write(self, kind, project, partition, rows):
+        """Write rows to a new file, return the file key"""
+        schema, _ = schemas[kind]
+        columns = {
+            field.name: [row.get(field.name) for row in rows]
+            for field in schema
+        }
+        table = pa.Table.from_pydict(columns, schema=schema)
+        buf = BytesIO()
+        pq.write_table(table, buf)
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        key = (
+            f'{kind}/project={project}/month={partition}/'
+            f'{stamp}-{uuid4().hex[:8]}.parquet'
+        )
+        self._store.put(self._path(key), buf.getvalue())
+        return key
+
+    def read(self, key):
+        """Rows of file key (list of dicts)"""
+        return list(self._index(key).values())
+
+    def find(self, file_key, **match):
+        """Row of file_key with the match id columns (see schemas)"""
+        kind = file_key.split('/', 1)[0]
+        _, ids = schemas[kind]
+        row = self._index(file_key).get(tuple(match[col] for col in ids))
+        if row is None:
+            raise RunDBError(
+                f'{kind} {match} not found in archive {file_key}')
+        return row
+
+    def _index(self, key):
+        """id columns → row of file key"""
+        index = self._cache.get(key)
+        if index is not None:
+            return index
+        try:
+            data = self._store.get(self._path(key))
+        except Exception as err:
+            raise RunDBError(f'archive {key} - {err}') from err
+        columns = pq.read_table(BytesIO(data)).to_pydict()
+        _, ids = schemas[key.split('/', 1)[0]]
+        index = {}
+        for values in zip(*columns.values()):
+            row = dict(zip(columns, values))
+            index[tuple(row[col] for col in ids)] = row
+        self._cache.set(key, index)
+        return index
+
+    def _path(self, key):
+        return f'{self._subpath}/{key}' if self._subpath else key
@@ -12,14 +12,330 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import math
+import operator
+import re
 from abc import ABC, abstractmethod
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime, timezone
 import warnings
 
+from dateutil import parser
+
+from ..lists import RunList
+from ..utils import get_in, update_in
+
 
 class RunDBError(Exception):
     pass
 
 
+class RunDBConflictError(RunDBError):
+    """Object was changed by another writer, re-read and retry"""
+
+
+# write operations allowed in RunDBInterface.batch
+batch_ops = ('store_run', 'update_run', 'patch_run', 'store_artifact')
+patch_ops = ('set', 'append', 'inc')
+
+
+def patch_struct(struct, ops):
+    """Apply patch operations to struct (in place)
+
+    ops is either a {dotted.key: value} dict (set operations) or a list of
+    {'op': 'set'|'append'|'inc', 'key': 'dotted.key', 'value': value}.
+    append adds value to the list in key, inc adds value (default 1) to the
+    number in key. Missing keys are created.
+    """
+    if isinstance(ops, dict):
+        ops = [{'op': 'set', 'key': key, 'value': value}
+               for key, value in ops.items()]
+
+    for op in ops:
+        name, key = op.get('op', 'set'), op.get('key')
+        if name not in patch_ops or not key:
+            raise RunDBError(f'bad patch operation - {op!r}')
+        value = op.get('value')
+        if name == 'set':
+            update_in(struct, key, value)
+            continue
+
+        current = get_in(struct, key)
+        if name == 'append':
+            if current is None:
+                current = []
+            elif not isinstance(current, list):
+                raise RunDBError(f'can\'t append to {key} - not a list')
+            current.append(value)
+        else:
+            value = 1 if value is None else value
+            try:
+                current = (current or 0) + value
+            except TypeError as err:
+                raise RunDBError(f'can\'t increment {key} - {err}') from err
+        update_in(struct, key, current)
+    return struct
+
+
+def encode_cursor(values):
+    """Encode the sort key of the last item in a page as an opaque token"""
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    data = json.dumps(values).encode('utf-8')
+    return urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, ValueError) as err:
+        raise RunDBError(f'bad cursor - {cursor!r}') from err
+    if not isinstance(values, list):
+        raise RunDBError(f'bad cursor - {cursor!r}')
+    return values
+
+
+def page_list(items, key, page_size, cursor=None):
+    """Return a (page, next_cursor) of items sorted by descending key
+
+    key must return a tuple of JSON compatible values, this is used by
+    databases that have to load the full list anyway. Items with an equal
+    key are told apart by their rank (input order) among themselves.
+    """
+    ranked, prev, rank = [], None, 0
+    for item in sorted(items, key=key, reverse=True):
+        item_key = key(item)
+        rank = rank + 1 if item_key == prev else 0
+        prev = item_key
+        ranked.append((item_key, rank, item))
+
+    if cursor:
+        *last, last_rank = decode_cursor(cursor)
+        last = tuple(last)
+        ranked = [
+            entry for entry in ranked
+            if entry[0] < last or (entry[0] == last and entry[1] > last_rank)
+        ]
+
+    page = ranked[:page_size]
+    next_cursor = None
+    if len(ranked) > page_size:
+        item_key, rank, _ = page[-1]
+        next_cursor = encode_cursor(list(item_key) + [rank])
+    return [item for _, _, item in page], next_cursor
+
+
+# aggregate_runs group by keys, "label.<name>" groups by a label value
+run_group_keys = ('project', 'name', 'state', 'owner', 'kind')
+# start_time bucket → bucket start format
+time_buckets = {
+    'minute': '%Y-%m-%dT%H:%M:00',
+    'hour': '%Y-%m-%dT%H:00:00',
+    'day': '%Y-%m-%dT00:00:00',
+}
+failed_states = ('error',)
+default_percentiles = (50, 90, 99)
+
+
+def check_aggregate(group_by, bucket):
+    for key in group_by:
+        if key not in run_group_keys and not key.startswith('label.'):
+            raise RunDBError(f'bad group by key - {key!r}')
+    if bucket and bucket not in time_buckets:
+        raise RunDBError(f'bad time bucket - {bucket!r}')
+
+
+def parse_utc(ts):
+    """Parse time to naive UTC datetime (None if empty)"""
+    if not ts:
+        return None
+    if not isinstance(ts, datetime):
+        ts = parser.parse(ts)
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def run_group_value(run, key):
+    if key == 'project':
+        return get_in(run, 'metadata.project')
+    if key == 'name':
+        return get_in(run, 'metadata.name')
+    if key == 'state':
+        return get_in(run, 'status.state')
+    if key.startswith('label.'):
+        key = key[len('label.'):]
+    return get_in(run, 'metadata.labels', {}).get(key)
+
+
+def run_duration(run):
+    """Run duration in seconds (start_time to last_update)"""
+    start = parse_utc(get_in(run, 'status.start_time'))
+    end = parse_utc(get_in(run, 'status.last_update'))
+    if start and end:
+        return (end - start).total_seconds()
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of sorted values"""
+    rank = max(math.ceil(pct / 100.0 * len(values)), 1)
+    return values[rank - 1]
+
+
+def duration_stats(durations, percentiles=()):
+    """avg, min, max and percentiles (p50 ...) of sorted durations"""
+    if not durations:
+        return {}
+    out = {
+        'avg': sum(durations) / len(durations),
+        'min': durations[0],
+        'max': durations[-1],
+    }
+    for pct in percentiles:
+        out[f'p{pct}'] = percentile(durations, pct)
+    return out
+
+
+def aggregate_group(group_by, bucket, key, count, failed, duration):
+    """Aggregation result of one group, key is group values (+ bucket)"""
+    out = dict(zip(group_by, key))
+    if bucket:
+        out['bucket'] = key[-1]
+    out.update(
+        count=count,
+        failed=failed,
+        failure_rate=failed / count if count else 0.0,
+        duration=duration,
+    )
+    return out
+
+
+def aggregate_runs_list(
+        runs, group_by=(), bucket=None, since=None, until=None,
+        percentiles=default_percentiles):
+    """Aggregate run structs, for databases without aggregation queries"""
+    since, until = parse_utc(since), parse_utc(until)
+    groups = {}
+    for run in runs:
+        start = parse_utc(get_in(run, 'status.start_time'))
+        if (since and (not start or start < since)) or \
+                (until and (not start or start > until)):
+            continue
+        key = tuple(run_group_value(run, name) for name in group_by)
+        if bucket:
+            key += (start.strftime(time_buckets[bucket]) if start else None,)
+        group = groups.setdefault(key, [0, 0, []])
+        group[0] += 1
+        if get_in(run, 'status.state') in failed_states:
+            group[1] += 1
+        duration = run_duration(run)
+        if duration is not None:
+            group[2].append(duration)
+
+    out = []
+    for key in sorted(groups, key=lambda k: [str(v) for v in k]):
+        count, failed, durations = groups[key]
+        duration = duration_stats(sorted(durations), percentiles)
+        out.append(
+            aggregate_group(group_by, bucket, key, count, failed, duration))
+    return out
+
+
+# query_results filter operators
+result_ops = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '=': operator.eq,
+    '!=': operator.ne,
+}
+_result_filter = re.compile(
+    r'^\s*([^<>=!\s]+)\s*(>=|<=|==|!=|>|<|=)\s*(\S+)\s*$')
+
+
+def parse_result_filter(expr):
+    """Parse "results.accuracy > 0.9" to ('accuracy', '>', 0.9)"""
+    match = _result_filter.match(expr or '')
+    if not match:
+        raise RunDBError(f'bad results filter - {expr!r}')
+    key, op, value = match.groups()
+    if key.startswith('results.'):
+        key = key[len('results.'):]
+    try:
+        value = float(value)
+    except ValueError:
+        raise RunDBError(f'non numeric value in results filter - {expr!r}')
+    return key, op, value
+
+
+def numeric_results(run):
+    """Numeric values in run status.results"""
+    results = get_in(run, 'status.results') or {}
+    return {
+        key: float(value) for key, value in results.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+        and math.isfinite(value)
+    }
+
+
+# label_stats kind → path of the labels in the object struct
+label_kinds = {
+    'runs': 'metadata.labels',
+    'artifacts': 'labels',
+    'functions': 'metadata.labels',
+}
+
+
+def check_label_kind(kind):
+    if kind not in label_kinds:
+        raise ValueError(
+            f'bad kind: {kind!r} (should be one of {sorted(label_kinds)})')
+
+
+def count_labels(objs, kind):
+    """Label name → {value: number of objects} of objs"""
+    return count_label_dicts(
+        get_in(obj, label_kinds[kind]) or {} for obj in objs)
+
+
+def count_label_dicts(label_dicts):
+    """Label name → {value: number of objects} of the objects labels"""
+    stats = {}
+    for labels in label_dicts:
+        for name, value in labels.items():
+            values = stats.setdefault(name, {})
+            value = str(value)
+            values[value] = values.get(value, 0) + 1
+    return stats
+
+
+def _run_key(run):
+    return (
+        str(get_in(run, 'status.start_time') or ''),
+        get_in(run, 'metadata.uid') or '',
+        get_in(run, 'metadata.iteration') or 0,
+    )
+
+
+def _artifact_key(artifact):
+    return (
+        str(artifact.get('updated') or ''),
+        artifact.get('key') or '',
+        artifact.get('tree') or '',
+        artifact.get('iter') or 0,
+    )
+
+
+def _function_key(func):
+    return (
+        str(get_in(func, 'metadata.updated') or ''),
+        get_in(func, 'metadata.name') or '',
+        get_in(func, 'metadata.tag') or '',
+    )
+
+
 class RunDBInterface(ABC):
     kind = ''
 
@@ -43,6 +359,20 @@ class RunDBInterface(ABC):
     def update_run(self, updates: dict, uid, project='', iter=0):
         pass
 
+    def patch_run(self, ops, uid, project='', iter=0, version=None):
+        """Apply patch operations (see patch_struct) to a stored run
+
+        If version is given, the patch is applied only if the run is still
+        in that version, otherwise RunDBConflictError is raised. Returns the
+        new run version (an opaque value) or None if versions are not
+        supported. With empty ops, returns the current version.
+        """
+        if version is not None:
+            raise RunDBError(f'{self.kind} db does not support versions')
+        if ops:
+            struct = self.read_run(uid, project, iter=iter)
+            self.store_run(patch_struct(struct, ops), uid, project, iter=iter)
+
     @abstractmethod
     def read_run(self, uid, project='', iter=0):
         pass
@@ -50,9 +380,59 @@ class RunDBInterface(ABC):
     @abstractmethod
     def list_runs(
             self, name='', uid=None, project='', labels=None,
-            state='', sort=True, last=0, iter=False):
+            state='', sort=True, last=0, iter=False, archived=False):
         pass
 
+    def batch(self, ops):
+        """Apply a list of write operations (in one transaction if supported)
+
+        Each operation is a dict with the method name in "op" (one of
+        store_run, update_run or store_artifact) and its keyword arguments,
+        e.g. {'op': 'update_run', 'updates': {...}, 'uid': 'x', 'iter': 3}
+        """
+        for op in ops:
+            kw = dict(op)
+            name = kw.pop('op', None)
+            if name not in batch_ops:
+                raise RunDBError(f'unsupported batch operation - {name}')
+            getattr(self, name)(**kw)
+
+    def store_runs(self, runs):
+        """Store runs, each item holds the store_run keyword arguments"""
+        self.batch([dict(run, op='store_run') for run in runs])
+
+    def update_runs(self, updates):
+        """Update runs, each item holds the update_run keyword arguments"""
+        self.batch([dict(item, op='update_run') for item in updates])
+
+    def store_artifacts(self, artifacts):
+        """Store artifacts, each item holds the store_artifact arguments"""
+        self.batch([dict(item, op='store_artifact') for item in artifacts])
+
+    def flush(self):
+        """Write changes buffered by the db (FileRunDB write-behind)"""
+
+    def list_runs_page(
+            self, name='', uid=None, project='', labels=None, state='',
+            iter=False, page_size=100, cursor=None, archived=False):
+        """Return a (runs, next_cursor) page, newest runs first
+
+        Pass next_cursor to get the following page, it's None on the last
+        page. The default implementation pages over list_runs.
+        """
+        runs = self.list_runs(
+            name, uid, project, labels, state, sort=False, last=0, iter=iter,
+            archived=archived)
+        page, cursor = page_list(runs, _run_key, page_size, cursor)
+        return type(runs)(page), cursor
+
+    def iter_runs(self, page_size=100, **kw):
+        """Iterate over runs, fetching page_size runs at a time
+
+        Accepts the list_runs_page filters (name, uid, project ...).
+        """
+        return self._iter_pages(self.list_runs_page, page_size, kw)
+
     @abstractmethod
     def del_run(self, uid, project='', iter=0):
         pass
@@ -61,6 +441,69 @@ class RunDBInterface(ABC):
     def del_runs(self, name='', project='', labels=None, state='', days_ago=0):
         pass
 
+    def query_results(
+            self, project='', where=None, order_by=None, desc=True, limit=10,
+            iter=True):
+        """Return runs by their (numeric) results
+
+        where is a list of filters like "results.accuracy > 0.9" (or
+        "accuracy > 0.9"), order_by a result key, limit=0 returns all runs.
+        Runs without the order_by or filter keys are skipped.
+
+        The default implementation scans list_runs.
+        """
+        filters = [parse_result_filter(expr) for expr in where or []]
+        out = []
+        for run in self.list_runs(
+                project=project, sort=False, last=0, iter=iter):
+            results = numeric_results(run)
+            if order_by and order_by not in results:
+                continue
+            if all(key in results and result_ops[op](results[key], value)
+                   for key, op, value in filters):
+                out.append(run)
+        if order_by:
+            out.sort(
+                key=lambda run: numeric_results(run)[order_by], reverse=desc)
+        return RunList(out[:limit] if limit else out)
+
+    def aggregate_runs(
+            self, project='', group_by=None, bucket=None, since=None,
+            until=None, name='', labels=None, state='', iter=False,
+            percentiles=default_percentiles):
+        """Run statistics per group
+
+        group_by is a list of project, name, state, owner, kind or
+        label.<name>. bucket ("minute", "hour" or "day") adds grouping by
+        start_time bucket. Returns a list of dicts with the group values,
+        bucket (start, UTC), count, failed, failure_rate and duration (avg,
+        min, max and percentiles, in seconds, from start_time to
+        last_update).
+
+        The default implementation scans list_runs.
+        """
+        group_by = list(group_by or [])
+        check_aggregate(group_by, bucket)
+        runs = self.list_runs(
+            name, None, project, labels, state, sort=False, last=0, iter=iter)
+        return aggregate_runs_list(
+            runs, group_by, bucket, since, until, percentiles)
+
+    def label_stats(self, project='', kind='runs'):
+        """Label name → {value: number of objects} in project
+
+        kind is runs (iteration 0), artifacts (latest) or functions.
+        The default implementation scans the list method of kind.
+        """
+        check_label_kind(kind)
+        if kind == 'runs':
+            objs = self.list_runs(project=project, sort=False, last=0)
+        elif kind == 'artifacts':
+            objs = self.list_artifacts(project=project)
+        else:
+            objs = self.list_functions(None, project=project)
+        return count_labels(objs, kind)
+
     @abstractmethod
     def store_artifact(self, key, artifact, uid, iter=None, tag='', project=''):
         pass
@@ -75,6 +518,21 @@ class RunDBInterface(ABC):
             since=None, until=None):
         pass
 
+    def list_artifacts_page(
+            self, name='', project='', tag='', labels=None, since=None,
+            until=None, page_size=100, cursor=None):
+        """Return a (artifacts, next_cursor) page, last updated first"""
+        artifacts = self.list_artifacts(
+            name, project, tag, labels, since, until)
+        page, cursor = page_list(artifacts, _artifact_key, page_size, cursor)
+        out = type(artifacts)(page)
+        out.tag = getattr(artifacts, 'tag', tag)
+        return out, cursor
+
+    def iter_artifacts(self, page_size=100, **kw):
+        """Iterate over artifacts, fetching page_size artifacts at a time"""
+        return self._iter_pages(self.list_artifacts_page, page_size, kw)
+
     @abstractmethod
     def del_artifact(self, key, tag='', project=''):
         pass
@@ -104,6 +562,28 @@ class RunDBInterface(ABC):
     def list_functions(self, name, project='', tag='', labels=None):
         pass
 
+    def list_functions_page(
+            self, name, project='', tag='', labels=None, page_size=100,
+            cursor=None):
+        """Return a (functions, next_cursor) page, last updated first"""
+        funcs = self.list_functions(name, project, tag, labels)
+        page, cursor = page_list(funcs, _function_key, page_size, cursor)
+        return page, cursor
+
+    def iter_functions(self, name, page_size=100, **kw):
+        """Iterate over functions, fetching page_size functions at a time"""
+        kw['name'] = name
+        return self._iter_pages(self.list_functions_page, page_size, kw)
+
+    def _iter_pages(self, list_page, page_size, kw):
+        cursor = None
+        while True:
+            items, cursor = list_page(
+                page_size=page_size, cursor=cursor, **kw)
+            yield from items
+            if not cursor:
+                return
+
     def list_projects(self):
         return []
 
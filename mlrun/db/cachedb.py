@@ -0,0 +1,311 @@
+# Copyright 2019 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Read-through cache around a RunDBInterface"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import deepcopy
+from threading import Lock
+from time import monotonic
+
+from ..config import config
+from .base import RunDBInterface
+
+_missing = object()
+
+
+class LRUCache:
+    """Thread safe LRU cache with entries expiring after ttl seconds
+
+    ttl=0 disables the cache. Entries set with groups (e.g. a project) are
+    removed together by discard_group.
+    """
+
+    def __init__(self, size=1024, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._items = OrderedDict()  # key → (value, expires, groups)
+        self._groups = {}  # group → keys
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key, _missing)
+            if item is not _missing and item[1] < monotonic():
+                self._remove(key)
+                item = _missing
+            if item is _missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value, groups=()):
+        if not self.ttl or not self.size:
+            return
+        with self._lock:
+            self._remove(key)
+            self._items[key] = (value, monotonic() + self.ttl, groups)
+            for group in groups:
+                self._groups.setdefault(group, set()).add(key)
+            while len(self._items) > self.size:
+                self._remove(next(iter(self._items)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def discard_group(self, group):
+        """Remove the entries set with group"""
+        with self._lock:
+            for key in list(self._groups.get(group, ())):
+                self._remove(key)
+
+    def _remove(self, key):
+        # Called with _lock held
+        item = self._items.pop(key, None)
+        if item is None:
+            return
+        for group in item[2]:
+            keys = self._groups[group]
+            keys.discard(key)
+            if not keys:
+                del self._groups[group]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._groups.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
+
+
+class CachedRunDB(RunDBInterface):
+    """Caches read_run, get_function and read_artifact of another db
+
+    Writes done through the cache invalidate the matching entries, writes
+    done elsewhere are seen after at most ttl seconds. Other methods are
+    passed to the wrapped db as is.
+    """
+
+    def __init__(self, db, size=None, ttl=None):
+        self.db = db
+        self.kind = db.kind
+        size = config.httpdb.cache_size if size is None else size
+        ttl = config.httpdb.cache_ttl if ttl is None else ttl
+        self._caches = {
+            name: LRUCache(size, ttl)
+            for name in ('run', 'function', 'artifact')
+        }
+
+    def __getattr__(self, attr):
+        # Methods not in RunDBInterface (store_schedule, pool_stats ...)
+        if attr == 'db':  # Not initialized (e.g. unpickling)
+            raise AttributeError(attr)
+        return getattr(self.db, attr)
+
+    def cache_stats(self):
+        """Return hit/miss counters per object kind"""
+        return {name: cache.stats() for name, cache in self._caches.items()}
+
+    def clear_cache(self):
+        for cache in self._caches.values():
+            cache.clear()
+
+    def connect(self, secrets=None):
+        self.db.connect(secrets)
+        return self
+
+    def store_log(self, uid, project='', body=None, append=False):
+        return self.db.store_log(uid, project, body, append)
+
+    def get_log(self, uid, project='', offset=0, size=0):
+        return self.db.get_log(uid, project, offset, size)
+
+    def flush(self):
+        return self.db.flush()
+
+    def store_run(self, struct, uid, project='', iter=0):
+        with self._invalidating('store_run', project, uid=uid, iter=iter):
+            return self.db.store_run(struct, uid, project, iter)
+
+    def update_run(self, updates: dict, uid, project='', iter=0):
+        with self._invalidating('update_run', project, uid=uid, iter=iter):
+            return self.db.update_run(updates, uid, project, iter)
+
+    def patch_run(self, ops, uid, project='', iter=0, version=None):
+        with self._invalidating('patch_run', project, uid=uid, iter=iter):
+            return self.db.patch_run(ops, uid, project, iter, version)
+
+    def read_run(self, uid, project='', iter=0):
+        key = (project or config.default_project, uid, iter or 0)
+        return self._cached(
+            'run', key, self.db.read_run, uid, project, iter=iter)
+
+    # list methods pass arguments as is, defaults differ between dbs
+    def list_runs(self, *args, **kw):
+        return self.db.list_runs(*args, **kw)
+
+    def list_runs_page(self, *args, **kw):
+        return self.db.list_runs_page(*args, **kw)
+
+    def aggregate_runs(self, *args, **kw):
+        return self.db.aggregate_runs(*args, **kw)
+
+    def query_results(self, *args, **kw):
+        return self.db.query_results(*args, **kw)
+
+    def label_stats(self, project='', kind='runs'):
+        return self.db.label_stats(project, kind)
+
+    def del_run(self, uid, project='', iter=0):
+        with self._invalidating('del_run', uid=uid, project=project):
+            return self.db.del_run(uid, project, iter)
+
+    def del_runs(
+            self, name=None, project=None, labels=None, state=None,
+            days_ago=0):
+        with self._invalidating('del_runs', project=project):
+            return self.db.del_runs(name, project, labels, state, days_ago)
+
+    def batch(self, ops):
+        try:
+            return self.db.batch(ops)
+        finally:
+            for op in ops:
+                kw = dict(op)
+                self._invalidate(kw.pop('op', None), **kw)
+
+    def store_artifact(
+            self, key, artifact, uid, iter=None, tag='', project=''):
+        with self._invalidating('store_artifact', project, key=key):
+            return self.db.store_artifact(
+                key, artifact, uid, iter, tag, project)
+
+    def read_artifact(self, key, tag='', iter=None, project=''):
+        cache_key = (project or config.default_project, key, tag, iter)
+        return self._cached(
+            'artifact', cache_key, self.db.read_artifact, key, tag, iter,
+            project)
+
+    def list_artifacts(self, *args, **kw):
+        return self.db.list_artifacts(*args, **kw)
+
+    def list_artifacts_page(self, *args, **kw):
+        return self.db.list_artifacts_page(*args, **kw)
+
+    def list_artifact_tags(self, project):
+        return self.db.list_artifact_tags(project)
+
+    def del_artifact(self, key, tag='', project=''):
+        with self._invalidating('del_artifact', key=key, project=project):
+            return self.db.del_artifact(key, tag, project)
+
+    def del_artifacts(
+            self, name='', project='', tag='', labels=None):
+        with self._invalidating('del_artifacts', project=project):
+            return self.db.del_artifacts(name, project, tag, labels)
+
+    def store_metric(
+            self, uid, project='', keyvals=None, timestamp=None, labels=None):
+        return self.db.store_metric(uid, project, keyvals, timestamp, labels)
+
+    def read_metric(self, keys, project='', query=''):
+        return self.db.read_metric(keys, project, query)
+
+    def store_function(self, func, name, project='', tag=''):
+        with self._invalidating('store_function', project, name=name):
+            return self.db.store_function(func, name, project, tag)
+
+    def get_function(self, name, project='', tag=''):
+        key = (project or config.default_project, name, tag or 'latest')
+        return self._cached(
+            'function', key, self.db.get_function, name, project, tag)
+
+    def list_functions(self, *args, **kw):
+        return self.db.list_functions(*args, **kw)
+
+    def list_functions_page(self, *args, **kw):
+        return self.db.list_functions_page(*args, **kw)
+
+    def list_projects(self, *args, **kw):
+        return self.db.list_projects(*args, **kw)
+
+    def tag_objects(self, objs, project: str, name: str):
+        with self._invalidating('tag', project=project):
+            return self.db.tag_objects(objs, project, name)
+
+    def tag_query(self, project: str, name: str, queries: dict):
+        with self._invalidating('tag', project=project):
+            return self.db.tag_query(project, name, queries)
+
+    def del_tag(self, project: str, name: str):
+        with self._invalidating('tag', project=project):
+            return self.db.del_tag(project, name)
+
+    def _cached(self, name, key, fn, *args, **kw):
+        # key is (project, uid or name ...), invalidated by its project and
+        # by its first two fields
+        cache = self._caches[name]
+        value = cache.get(key, _missing)
+        if value is _missing:
+            value = fn(*args, **kw)
+            if value is None:  # Not found
+                return value
+            cache.set(key, deepcopy(value), groups=(key[:1], key[:2]))
+        # Callers (e.g. MLClientCtx) modify the returned objects
+        return deepcopy(value)
+
+    @contextmanager
+    def _invalidating(self, op, project='', **kw):
+        # After the write as well, a read might cache the old object while
+        # the write is in progress
+        self._invalidate(op, project, **kw)
+        try:
+            yield
+        finally:
+            self._invalidate(op, project, **kw)
+
+    def _invalidate(self, op, project='', **kw):
+        project = project or config.default_project
+        if op in ('store_run', 'update_run', 'patch_run'):
+            key = (project, kw.get('uid'), kw.get('iter') or 0)
+            self._caches['run'].delete(key)
+        elif op == 'del_run':
+            self._caches['run'].discard_group((project, kw.get('uid')))
+        elif op == 'del_runs':
+            self._caches['run'].discard_group((project,))
+        elif op in ('store_artifact', 'del_artifact'):
+            # Any tag or iteration of key
+            key = kw.get('key')
+            group = (project,) if key is None else (project, key)
+            self._caches['artifact'].discard_group(group)
+        elif op == 'del_artifacts':
+            self._caches['artifact'].discard_group((project,))
+        elif op == 'store_function':
+            self._caches['function'].discard_group((project, kw.get('name')))
+        elif op == 'tag':
+            for name in ('artifact', 'function'):
+                self._caches[name].discard_group((project,))
@@ -0,0 +1,144 @@
+# Copyright 2019 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Optional zstd compression of stored bodies
+
+Bodies of a kind (e.g. table) are compressed with the dictionary trained
+for it, small and similar documents (hyper param runs) compress well with
+a dictionary. A compressed body is a zstd frame, its header holds the
+dictionary id so bodies stay readable after training a new dictionary.
+"""
+
+from threading import Lock
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+codecs = ('zstd',)
+zstd_magic = b'\x28\xb5\x2f\xfd'
+_lock = Lock()
+_dicts = {}  # zstd dictionary id → ZstdCompressionDict
+_loaders = {}  # name → function of dictionary id returning its data
+
+
+def check_codec(codec):
+    if not codec:
+        return
+    if codec not in codecs:
+        raise ValueError(f'unsupported compression - {codec}')
+    if zstd is None:
+        raise ValueError('zstd compression requires the zstandard package')
+
+
+def is_compressed(data):
+    return isinstance(data, bytes) and data[:4] == zstd_magic
+
+
+def add_dict(data):
+    """Register a dictionary, return its id"""
+    check_codec('zstd')
+    zdict = zstd.ZstdCompressionDict(data)
+    with _lock:
+        _dicts.setdefault(zdict.dict_id(), zdict)
+    return zdict.dict_id()
+
+
+def set_dict_loader(name, loader):
+    """Set loader (dictionary id → data or None) of unknown dictionaries
+
+    name identifies the store (e.g. database DSN), a new loader of the same
+    name replaces the old one.
+    """
+    with _lock:
+        _loaders[name] = loader
+
+
+def get_dict(dict_id):
+    with _lock:
+        zdict = _dicts.get(dict_id)
+        loaders = list(_loaders.values())
+    if zdict is not None:
+        return zdict
+    # Trained by another process
+    for loader in loaders:
+        data = loader(dict_id)
+        if data:
+            add_dict(data)
+            return _dicts[dict_id]
+    raise ValueError(f'unknown compression dictionary - {dict_id}')
+
+
+def train_dict(samples, size):
+    """Train a dictionary from samples (bytes), None if too few samples"""
+    check_codec('zstd')
+    samples = [sample for sample in samples if sample]
+    if len(samples) < 8:
+        return None
+    try:
+        return zstd.train_dictionary(size, samples).as_bytes()
+    except zstd.ZstdError:  # Not enough data for size
+        return None
+
+
+def raw_size(data):
+    """Size of data before compression"""
+    if not is_compressed(data):
+        return len(data)
+    return zstd.get_frame_parameters(data).content_size
+
+
+def decompress(data, codec='zstd'):
+    if not codec or data is None:
+        return data
+    check_codec(codec)
+    dict_id = zstd.get_frame_parameters(data).dict_id
+    zdict = get_dict(dict_id) if dict_id else None
+    return zstd.ZstdDecompressor(dict_data=zdict).decompress(data)
+
+
+class Compressor:
+    """Compress bodies with the current dictionary of their kind
+
+    codec "" stores bodies as is, bodies shorter than min_size (or not
+    getting smaller) are not compressed.
+    """
+
+    def __init__(self, codec='', level=3, min_size=64):
+        check_codec(codec)
+        self.codec = codec
+        self.level = level
+        self.min_size = min_size
+        self._current = {}  # kind → dictionary id
+
+    def set_dict(self, kind, dict_id):
+        """Compress new bodies of kind with dictionary dict_id"""
+        self._current[kind] = dict_id
+
+    def dict_ids(self):
+        """Current dictionary id per kind"""
+        return dict(self._current)
+
+    def compress(self, data, kind=''):
+        """Return (data, codec), codec is None if data is not compressed"""
+        if not self.codec or len(data) < self.min_size:
+            return data, None
+        dict_id = self._current.get(kind)
+        zdict = get_dict(dict_id) if dict_id else None
+        # Compressors are not thread safe, they're cheap to create
+        cctx = zstd.ZstdCompressor(level=self.level, dict_data=zdict)
+        out = cctx.compress(data)
+        if len(out) >= len(data):
+            return data, None
+        return out, self.codec
@@ -0,0 +1,319 @@
+# Copyright 2019 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Columnar export of runs and vectorized queries over it
+
+    exp = RunExport('/data/runs')
+    exp.export(get_run_db(), 'iris')  # appends runs new since last export
+    df = exp.query(
+        'iris',
+        where=['state == completed', 'result.accuracy > 0.9'],
+        group_by=['param.lr'],
+        agg={'result.accuracy': ['mean', 'max']},
+    )
+
+Each run is one row with its metadata, timings, labels (label.<name>),
+parameters (param.<name>) and results (result.<name>). A project is a
+directory of Parquet files, queries read only the needed columns and skip
+row groups using the file statistics of the where columns.
+"""
+
+import json
+import re
+from datetime import datetime
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ..config import config
+from ..utils import get_in
+from .base import RunDBError, parse_utc, result_ops, run_duration
+
+# pyarrow.dataset and Table.group_by are available from pyarrow 7
+if int(pa.__version__.split('.')[0]) < 7:
+    raise ImportError(
+        f'mlrun.db.export requires pyarrow>=7, found {pa.__version__}')
+
+import pyarrow.dataset as ds  # noqa: E402
+
+# Runs in these states are exported once they're done
+open_states = ('created', 'pending', 'running')
+manifest_file = '_manifest.json'
+# column type name → arrow type
+column_types = {
+    'string': pa.string(),
+    'double': pa.float64(),
+    'int64': pa.int64(),
+    'bool': pa.bool_(),
+    'timestamp': pa.timestamp('us'),
+}
+fixed_columns = {
+    'project': 'string',
+    'uid': 'string',
+    'iteration': 'int64',
+    'name': 'string',
+    'kind': 'string',
+    'owner': 'string',
+    'state': 'string',
+    'start_time': 'timestamp',
+    'last_update': 'timestamp',
+    'duration': 'double',
+    'error': 'string',
+}
+# column prefix → path of the values in the run
+dynamic_columns = {
+    'label.': 'metadata.labels',
+    'param.': 'spec.parameters',
+    'result.': 'status.results',
+}
+aggregations = ('count', 'sum', 'mean', 'min', 'max', 'stddev')
+_where = re.compile(r'^\s*(\S+?)\s*(>=|<=|==|!=|>|<|=)\s*(.*?)\s*$')
+
+
+def value_type(value):
+    """Column type of a parameter or result value"""
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, float)):
+        return 'double'
+    return 'string'
+
+
+def convert(value, typ):
+    """value as column type typ, None if it can't be converted"""
+    if value is None:
+        return None
+    if typ == 'bool':
+        return value if isinstance(value, bool) else None
+    if typ in ('double', 'int64'):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return None
+        return int(value) if typ == 'int64' else value
+    if typ == 'timestamp':
+        try:
+            return parse_utc(value)
+        except (TypeError, ValueError, OverflowError):
+            return None
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, default=str)
+
+
+def run_row(run, project):
+    """Flat row of run, values are not converted to column types"""
+    labels = get_in(run, 'metadata.labels') or {}
+    row = {
+        'project': project,
+        'uid': get_in(run, 'metadata.uid'),
+        'iteration': get_in(run, 'metadata.iteration') or 0,
+        'name': get_in(run, 'metadata.name'),
+        'kind': labels.get('kind'),
+        'owner': labels.get('owner'),
+        'state': get_in(run, 'status.state'),
+        'start_time': get_in(run, 'status.start_time'),
+        'last_update': get_in(run, 'status.last_update'),
+        'duration': run_duration(run),
+        'error': get_in(run, 'status.error'),
+    }
+    for prefix, key in dynamic_columns.items():
+        for name, value in (get_in(run, key) or {}).items():
+            row[prefix + name] = value
+    return row
+
+
+def parse_where(expr, columns):
+    """Parse "result.accuracy > 0.9" to a dataset filter expression"""
+    match = _where.match(expr or '')
+    if not match:
+        raise RunDBError(f'bad filter - {expr!r}')
+    col, op, value = match.groups()
+    if col not in columns:
+        raise RunDBError(f'unknown column in filter - {expr!r}')
+    typ = columns[col]
+    if typ == 'bool':
+        value = value.lower() in ('true', 'yes', '1')
+    else:
+        value = convert(value, typ)
+    if value is None:
+        raise RunDBError(f'bad {typ} value in filter - {expr!r}')
+    return result_ops[op](ds.field(col), value)
+
+
+class RunExport:
+    """Runs of projects in Parquet files under a local directory
+
+    path/<project>/ holds part-<n>.parquet files and a manifest with the
+    column types and the export watermark. A column type is set by the
+    first exported value, later values are converted to it (or null).
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def export(self, db, project='', batch_size=10000, page_size=1000):
+        """Append runs of project (all iterations) new since the last export
+
+        Runs still running are exported once they're done. Returns the
+        number of exported runs.
+        """
+        project = project or config.default_project
+        manifest = self._manifest(project)
+        window_start = parse_utc(manifest['window_start'])
+        # Runs exported at or after window_start, (uid, iteration) → start
+        window = {
+            (uid, it): parse_utc(start)
+            for uid, it, start in manifest['window_keys']
+        }
+
+        rows, running = [], []
+        runs = db.iter_runs(
+            page_size, project=project, iter=True, archived=True)
+        for run in runs:
+            start = parse_utc(get_in(run, 'status.start_time'))
+            if not start:
+                continue
+            if window_start and start < window_start:
+                break  # Newest first, the rest were exported
+            key = (
+                get_in(run, 'metadata.uid'),
+                get_in(run, 'metadata.iteration') or 0,
+            )
+            if key in window:
+                continue
+            if get_in(run, 'status.state') in open_states:
+                running.append(start)
+                continue
+            rows.append(run_row(run, project))
+            window[key] = start
+
+        # Runs from the oldest running one on are checked again next time
+        if running:
+            window_start = min(running)
+        elif window:
+            window_start = max(window.values())
+        for i in range(0, len(rows), batch_size):
+            self._write(project, manifest, rows[i:i+batch_size])
+        manifest['window_start'] = \
+            window_start.isoformat() if window_start else None
+        manifest['window_keys'] = [
+            [uid, it, start.isoformat()]
+            for (uid, it), start in window.items() if start >= window_start
+        ]
+        manifest['exported'] = datetime.utcnow().isoformat()
+        self._save_manifest(project, manifest)
+        return len(rows)
+
+    def columns(self, project=''):
+        """Exported column → type"""
+        return dict(self._manifest(project)['columns'])
+
+    def dataset(self, project=''):
+        """pyarrow dataset of the project runs"""
+        project = project or config.default_project
+        columns = self.columns(project)
+        schema = pa.schema(
+            [(name, column_types[typ]) for name, typ in columns.items()])
+        files = sorted(
+            str(p) for p in (self.path / project).glob('part-*.parquet'))
+        return ds.dataset(files, schema=schema, format='parquet')
+
+    def query(
+            self, project='', columns=None, where=None, group_by=None,
+            agg=None, as_df=True):
+        """Query exported runs
+
+        columns - columns to return (default all), where - list of filters
+        like "result.accuracy > 0.9" or "state == completed", group_by -
+        list of columns, agg - column → aggregation (or list of) out of
+        count, sum, mean, min, max and stddev. With group_by and no agg the
+        runs per group are counted. Returns a DataFrame (or arrow table if
+        as_df is False).
+        """
+        project = project or config.default_project
+        types = self.columns(project)
+        group_by = list(group_by or [])
+        agg = {
+            col: [fns] if isinstance(fns, str) else list(fns)
+            for col, fns in (agg or {}).items()
+        }
+        if group_by and not agg:
+            agg = {'uid': ['count']}
+        for col in list(columns or []) + group_by + list(agg):
+            if col not in types:
+                raise RunDBError(f'unknown column - {col!r}')
+        for fns in agg.values():
+            for fn in fns:
+                if fn not in aggregations:
+                    raise RunDBError(f'unknown aggregation - {fn!r}')
+
+        expr = None
+        for where_expr in where or []:
+            cond = parse_where(where_expr, types)
+            expr = cond if expr is None else expr & cond
+        if agg:
+            read = list(dict.fromkeys(group_by + list(agg)))
+        else:
+            read = list(columns) if columns else None
+        table = self.dataset(project).to_table(columns=read, filter=expr)
+        if agg:
+            table = table.group_by(group_by).aggregate([
+                (col, fn) for col, fns in agg.items() for fn in fns])
+        return table.to_pandas() if as_df else table
+
+    def _write(self, project, manifest, rows):
+        columns = manifest['columns']
+        names = list(fixed_columns)
+        for row in rows:
+            for name, value in row.items():
+                if name not in columns:
+                    columns[name] = value_type(value)
+                if name not in fixed_columns and name not in names:
+                    names.append(name)
+        schema = pa.schema(
+            [(name, column_types[columns[name]]) for name in names])
+        data = {
+            name: [convert(row.get(name), columns[name]) for row in rows]
+            for name in names
+        }
+        table = pa.Table.from_pydict(data, schema=schema)
+        manifest['files'] += 1
+        filepath = self.path / project / f'part-{manifest["files"]:06}.parquet'
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        pq.write_table(table, str(filepath))
+        manifest['rows'] += len(rows)
+
+    def _manifest(self, project):
+        project = project or config.default_project
+        filepath = self.path / project / manifest_file
+        if filepath.is_file():
+            return json.loads(filepath.read_text())
+        return {
+            'columns': dict(fixed_columns),
+            'files': 0,
+            'rows': 0,
+            'window_start': None,
+            'window_keys': [],
+            'exported': None,
+        }
+
+    def _save_manifest(self, project, manifest):
+        # Written after the data files, an interrupted export is redone
+        # (overwriting the files it wrote)
+        filepath = self.path / project / manifest_file
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        tmp = filepath.with_suffix('.tmp')
+        tmp.write_text(json.dumps(manifest))
+        tmp.replace(filepath)
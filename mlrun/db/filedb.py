@@ -12,46 +12,122 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
 import json
 import pathlib
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import partial
 from datetime import datetime, timedelta, timezone
-from os import makedirs, path, remove, scandir, listdir
+from hashlib import md5
+from heapq import heappush, heappushpop
+from itertools import islice
+from operator import itemgetter
+from os import (
+    fsync, getpid, listdir, makedirs, path, remove, replace, rmdir, scandir,
+    walk
+)
+from stat import S_ISREG
+from threading import Lock, Timer, get_ident
+from time import time
 from dateutil.parser import parse as parse_time
 
-import yaml
-
 from ..config import config
 from ..datastore import StoreManager
 from ..lists import ArtifactList, RunList
 from ..utils import (
-    dict_to_json, dict_to_yaml, get_in, logger, match_labels, match_value,
-    update_in
+    get_in, logger, match_labels, match_value, update_in
+)
+from .archive import RunArchive, decode_struct, encode_struct, month
+from .base import (
+    RunDBConflictError, RunDBError, RunDBInterface, aggregate_runs_list,
+    check_aggregate, check_label_kind, count_label_dicts, default_percentiles,
+    page_list, patch_struct
 )
-from .base import RunDBError, RunDBInterface
+from .cachedb import LRUCache
+from .compress import (
+    Compressor, add_dict, decompress, is_compressed, raw_size,
+    set_dict_loader, train_dict
+)
+from .fileindex import FileIndex
+from .filelock import object_locks
+from .formats import formats, get_format, is_format
 
 run_logs = 'runs'
 artifacts_dir = 'artifacts'
 functions_dir = 'functions'
 schedules_dir = 'schedules'
+dicts_dir = '.dicts'  # compression dictionaries, <kind>/<dict id>.dict
+layout_file = '.layout.json'  # layout manifest of a runs/artifacts directory
+layouts = ('flat', 'hashed')
+version_key = '_version'  # run file version (patch_run version)
+_version_lock = Lock()
+_last_version = 0
 
 
 class FileRunDB(RunDBInterface):
     kind = 'file'
 
-    def __init__(self, dirpath='', format='.yaml'):
-        self.format = format
+    def __init__(self, dirpath='', format=''):
+        # Format of written files, files of other formats are read as well
+        self.format = format or config.httpdb.file_format
+        get_format(self.format)
         self.dirpath = dirpath
         self._datastore = None
         self._subpath = None
-        makedirs(self.schedules_dir, exist_ok=True)
+        self._local = '://' not in dirpath  # else an object store (S3, v3io)
+        cfg = config.httpdb
+        self.compressor = Compressor(
+            cfg.compression, int(cfg.compression_level),
+            int(cfg.compression_min_size))
+        self.archive = None  # RunArchive, set by connect from archive_path
+        self.use_index = bool(cfg.file_index)
+        self._indexes = {}  # table directory → FileIndex
+        self._layouts = {}  # table directory → layout manifest
+        self.fsync = bool(cfg.file_fsync)
+        # Write-behind, seconds runs are kept in memory (0 is write through)
+        self.write_behind = float(cfg.file_write_behind)
+        self._pending = {}  # (project, uid, iter) → run
+        self._pending_lock = Lock()
+        self._flush_lock = Lock()
+        self._flush_timer = None
+        if self.write_behind:
+            atexit.register(_flush_at_exit, weakref.ref(self))
+        # Decoded object store files by (path, etag)
+        self._file_cache = LRUCache(
+            int(cfg.file_cache_size), float(cfg.file_cache_ttl))
+        self._etags = {}  # object store file path → etag in the last list
+        if self._local:
+            makedirs(self.schedules_dir, exist_ok=True)
 
     def connect(self, secrets=None):
         sm = StoreManager(secrets)
         self._datastore, self._subpath = sm.get_or_create_store(self.dirpath)
+        self._local = self._datastore.kind == 'file'
+        if not self._local:
+            # The index is a local file, object store lists are scans
+            self.use_index = False
+        self._load_dicts()
+        if config.httpdb.archive_path:
+            self.archive = RunArchive(config.httpdb.archive_path, secrets)
         return self
 
     def store_log(self, uid, project='', body=None, append=False):
-        filepath = self._filepath(run_logs, project, uid, '') + '.log'
+        filepath = self._log_path(project, uid, create=True)
+        if self._exists(filepath + '.archive'):  # Bring archived log back
+            archived = b''
+            if append:
+                archived = self._archived_log(filepath, project, uid)
+            self._put(filepath, archived)
+            self._remove(filepath + '.archive')
+        if not self._is_local():
+            # Objects can't be appended to, the log is rewritten
+            if append and self._exists(filepath):
+                body = self._get(filepath) + body
+            self._put(filepath, body)
+            return
         makedirs(path.dirname(filepath), exist_ok=True)
         mode = 'ab' if append else 'wb'
         with open(filepath, mode) as fp:
@@ -59,121 +135,429 @@ class FileRunDB(RunDBInterface):
             fp.close()
 
     def get_log(self, uid, project='', offset=0, size=0):
-        filepath = self._filepath(run_logs, project, uid, '') + '.log'
-        if pathlib.Path(filepath).is_file():
+        filepath = self._log_path(project, uid)
+        if not self._is_local():
+            stats = self._stat(filepath)
+            if stats is not None:
+                if offset >= stats.size:  # Ranges past the end fail
+                    return '', b''
+                return '', self._get(filepath, size or 2**18, offset)
+        elif pathlib.Path(filepath).is_file():
             with open(filepath, 'rb') as fp:
                 if offset:
                     fp.seek(offset)
                 if not size:
                     size = 2**18
                 return '', fp.read(size)
+        archived = self._archived_log(filepath, project, uid)
+        if archived is not None:
+            return '', archived[offset:offset + (size or 2**18)]
         return '', None
 
+    def _archived_log(self, filepath, project, uid):
+        """Archived log contents, None if the log is not archived"""
+        marker = filepath + '.archive'
+        if not self._exists(marker):
+            return None
+        row = self._get_archive().find(
+            self._get(marker).decode('utf-8'),
+            project=project or config.default_project,
+            uid=uid)
+        return row['body']
+
     def _run_path(self, uid, iter):
         if iter:
             return '{}-{}'.format(uid, iter)
         return uid
 
+    def _run_paths(self, project, uid, iter=0, create=False):
+        """Paths (no extension) of a run file, the layout path first"""
+        layout = self._layout(run_logs, project, create)
+        name = self._run_path(uid, iter)
+        paths = [
+            self._filepath(run_logs, project, name, ''),
+            self._filepath(run_logs, project, path.join(
+                _shard(uid, _levels(layout)), name), ''),
+        ]
+        return paths[::-1] if layout['layout'] == 'hashed' else paths
+
+    def _log_path(self, project, uid, create=False):
+        logpaths = [
+            p + '.log' for p in self._run_paths(project, uid, create=create)]
+        for logpath in logpaths:
+            if self._exists(logpath) or self._exists(logpath + '.archive'):
+                return logpath
+        return logpaths[0]
+
     def store_run(self, struct, uid, project='', iter=0):
-        data = self._dumps(struct)
-        filepath = self._filepath(
-            run_logs, project, self._run_path(uid, iter), '') + self.format
-        self._datastore.put(filepath, data)
+        if not self.write_behind:
+            self._store_run(struct, uid, project, iter)
+            return
+        with self._pending_lock:
+            self._buffer_run(deepcopy(struct), uid, project, iter)
+
+    def _store_run(self, struct, uid, project, iter):
+        basepath = self._run_paths(project, uid, iter, create=True)[0]
+        with self._lock(run_logs, project, self._run_path(uid, iter)):
+            # A new version without reading the stored one
+            self._store(
+                run_logs, project, basepath,
+                dict(struct, **{version_key: _next_version()}))
 
     def update_run(self, updates: dict, uid, project='', iter=0):
-        run = self.read_run(uid, project, iter=iter)
-        # TODO: Should we raise if run not found?
-        if run and updates:
-            for key, val in updates.items():
-                update_in(run, key, val)
-        self.store_run(run, uid, project, iter=iter)
+        if not self.write_behind:
+            self.patch_run(updates or {}, uid, project, iter=iter)
+            return
+        key = (project or config.default_project, uid, iter)
+        with self._pending_lock:
+            run = self._pending.get(key)
+            if run is None:
+                run = self._read_run(uid, project, iter)
+            self._buffer_run(
+                patch_struct(run, updates or {}), uid, project, iter)
+
+    def patch_run(self, ops, uid, project='', iter=0, version=None):
+        # version is the run version, stored in the run file
+        self._flush_pending()
+        basepaths = self._run_paths(project, uid, iter)
+        with self._lock(run_logs, project, self._run_path(uid, iter)):
+            stored = self._read_stored(self._find_file(*basepaths))
+            if stored is None:
+                raise RunDBError(uid)
+            current = stored.get(version_key, 0)
+            if version is not None and version != current:
+                raise RunDBConflictError(
+                    f'run {uid}:{project} version is {current} '
+                    f'(expected {version})')
+            if not ops:
+                return current
+            # Patching an archived run brings it back
+            run = patch_struct(self._unstub(stored, project), ops)
+            run[version_key] = _next_version(current)
+            self._store(run_logs, project, basepaths[0], run)
+            return run[version_key]
+
+    def _buffer_run(self, run, uid, project, iter):
+        # Called with _pending_lock held
+        self._pending[(project or config.default_project, uid, iter)] = run
+        if self._flush_timer is None:
+            self._flush_timer = Timer(self.write_behind, self._timed_flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self):
+        """Write the runs buffered by write-behind (httpdb.file_write_behind)
+
+        Runs are written on a timer, by the run context commit() and at
+        exit as well.
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                pending, self._pending = list(self._pending.items()), {}
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+            for i, ((project, uid, iter), run) in enumerate(pending):
+                try:
+                    self._store_run(run, uid, project, iter)
+                except Exception:
+                    with self._pending_lock:  # Newer buffered runs win
+                        for key, run in pending[i:]:
+                            self._pending.setdefault(key, run)
+                    raise
+
+    def _flush_pending(self):
+        # Lists, deletes and patches see the buffered runs
+        if self._pending:
+            self.flush()
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except Exception as err:
+            logger.warning(f'failed to write buffered runs - {err}')
+
+    def _read_stored(self, filepath):
+        """Run file object as stored (with version), None if missing"""
+        data = self._get_file(filepath)
+        if data is None:
+            return None
+        return self._decode(filepath, data)
 
     def read_run(self, uid, project='', iter=0):
-        filepath = self._filepath(
-            run_logs, project, self._run_path(uid, iter), '') + self.format
-        if not pathlib.Path(filepath).is_file():
+        if self.write_behind:
+            key = (project or config.default_project, uid, iter)
+            with self._pending_lock:
+                run = self._pending.get(key)
+                if run is not None:
+                    return deepcopy(run)
+        return self._read_run(uid, project, iter)
+
+    def _read_run(self, uid, project, iter):
+        filepath = self._find_file(*self._run_paths(project, uid, iter))
+        run = self._read_stored(filepath)
+        if run is None:
             raise RunDBError(uid)
-        data = self._datastore.get(filepath)
-        return self._loads(data)
+        return self._unstub(run, project)
 
     def list_runs(self, name='', uid=None, project='', labels=None,
-                  state='', sort=True, last=1000, iter=False):
+                  state='', sort=True, last=1000, iter=False,
+                  archived=False):
+        self._flush_pending()
         labels = [] if labels is None else labels
-        filepath = self._filepath(run_logs, project)
-        results = RunList()
         if isinstance(labels, str):
             labels = labels.split(',')
-        for run, _ in self._load_list(filepath, '*'):
-            if match_value(name, run, 'metadata.name') and \
-               match_labels(get_in(run, 'metadata.labels', {}), labels) and \
-               match_value(state, run, 'status.state') and \
-               match_value(uid, run, 'metadata.uid') and \
-               (iter or get_in(run, 'metadata.iteration', 0) == 0):
-                results.append(run)
-
+        match = _run_match(name, uid, state, iter, archived)
+        sort_key = None
         if sort or last:
-            results.sort(key=lambda i: get_in(
-                i, ['status', 'start_time'], ''), reverse=True)
-        if last and len(results) > last:
-            return RunList(results[:last])
-        return results
+            sort_key = 'start_time'
+        found = self._find(
+            run_logs, project, match, labels, sort_key=sort_key, last=last)
+        return RunList(self._unstub(run, project) for run, _ in found)
+
+    def list_runs_page(
+            self, name='', uid=None, project='', labels=None, state='',
+            iter=False, page_size=100, cursor=None, archived=False):
+        if not self.use_index:
+            return super().list_runs_page(
+                name, uid, project, labels, state, iter, page_size, cursor,
+                archived)
+        self._flush_pending()
+        labels = [] if labels is None else labels
+        if isinstance(labels, str):
+            labels = labels.split(',')
+        match = _run_match(name, uid, state, iter, archived)
+        found, cursor = self._find_page(
+            run_logs, project, match, labels, 'start_time', page_size, cursor)
+        return RunList(self._unstub(run, project) for run, _ in found), cursor
+
+    def aggregate_runs(
+            self, project='', group_by=None, bucket=None, since=None,
+            until=None, name='', labels=None, state='', iter=False,
+            percentiles=default_percentiles):
+        # Aggregates the run index fields, the run files are not read
+        if not self.use_index:
+            return super().aggregate_runs(
+                project, group_by, bucket, since, until, name, labels, state,
+                iter, percentiles)
+        group_by = list(group_by or [])
+        check_aggregate(group_by, bucket)
+        self._flush_pending()
+        labels = [] if labels is None else labels
+        if isinstance(labels, str):
+            labels = labels.split(',')
+        match = _run_match(name, None, state, iter, archived=True)
+        projects = [project or config.default_project]
+        if project == '*':
+            projects = [prj['name'] for prj in self.list_projects()]
+        runs = []
+        for project in projects:
+            runs.extend(
+                _index_run(fields, project) for fields in
+                self._run_fields(project, match, labels))
+        return aggregate_runs_list(
+            runs, group_by, bucket, since, until, percentiles)
+
+    def _run_fields(self, project, match, labels):
+        """Index fields of the matching runs"""
+        dirpath = self._table_dir(run_logs, project)
+        out, old = [], []
+        for relpath, fields in self._index(run_logs, project).entries(labels):
+            if not match(relpath, fields) or not match_labels(
+                    fields.get('labels') or {}, labels):
+                continue
+            if 'last_update' in fields:
+                out.append(fields)
+            else:  # Indexed before last_update was, read the run file
+                old.append(path.join(dirpath, relpath))
+        out.extend(
+            index_fields(run_logs, run) for run, _ in self._load_files(old))
+        return out
+
+    def label_stats(self, project='', kind='runs'):
+        if not self.use_index:
+            return super().label_stats(project, kind)
+        check_label_kind(kind)
+        self._flush_pending()
+        table = {
+            'runs': run_logs,
+            'artifacts': artifacts_dir,
+            'functions': functions_dir,
+        }[kind]
+        levels = _levels(self._layout(artifacts_dir, project))
+        label_dicts = []
+        for relpath, fields in self._index(table, project).entries():
+            if kind == 'runs' and fields.get('iteration', 0) != 0:
+                continue
+            if kind == 'artifacts' and not _in_tag(relpath, 'latest', levels):
+                continue
+            label_dicts.append(fields.get('labels') or {})
+        return count_label_dicts(label_dicts)
 
     def del_run(self, uid, project='', iter=0):
-        filepath = self._filepath(
-            run_logs, project, self._run_path(uid, iter), '') + self.format
+        self._flush_pending()
+        filepath = self._find_file(*self._run_paths(project, uid, iter))
         self._safe_del(filepath)
+        self._index_del(run_logs, project, filepath)
 
     def del_runs(self, name='', project='', labels=None, state='', days_ago=0):
+        self._flush_pending()
 
         labels = [] if labels is None else labels
         if not any([name, state, days_ago, labels]):
             raise RunDBError(
                 'filter is too wide, select name and/or state and/or days_ago')
 
-        filepath = self._filepath(run_logs, project)
         if isinstance(labels, str):
             labels = labels.split(',')
 
         if days_ago:
             days_ago = datetime.now() - timedelta(days=days_ago)
 
-        def date_before(run):
-            d = get_in(run, 'status.start_time', '')
+        def date_before(fields):
+            d = fields.get('start_time')
             if not d:
                 return False
             return parse_time(d) < days_ago
 
-        for run, p in self._load_list(filepath, '*'):
-            if match_value(name, run, 'metadata.name') and \
-               match_labels(get_in(run, 'metadata.labels', {}), labels) and \
-               match_value(state, run, 'status.state') and \
-               (not days_ago or date_before(run)):
-                self._safe_del(p)
+        def match(_, fields):
+            return match_value(name, fields, 'name') and \
+                match_value(state, fields, 'state') and \
+                (not days_ago or date_before(fields))
+
+        for _, p in list(self._find(run_logs, project, match, labels)):
+            self._safe_del(p)
+            self._index_del(run_logs, project, p)
+
+    def archive_runs(self, days, project=None, batch_size=500):
+        """Move runs started more than days ago (with logs) to the archive
+
+        Run files are replaced by stubs holding the run metadata and state
+        (so runs can still be found and deleted) and the archive file key.
+        Artifacts are not archived. Returns archived count per kind.
+        """
+        archive = self._get_archive()
+        self._flush_pending()
+        cutoff = datetime.now() - timedelta(days=days)
+        counts = {'runs': 0, 'logs': 0, 'artifacts': 0}
+        projects = [project] if project else [
+            prj['name'] for prj in self.list_projects()]
+        for project in projects:
+            groups = {}
+            candidates = self._find(
+                run_logs, project,
+                lambda _, fields: not fields.get('archived') and
+                fields.get('start_time'))
+            for run, p in candidates:
+                start = get_in(run, 'status.start_time')
+                start = parse_time(start)
+                if start.tzinfo:
+                    start = start.astimezone(timezone.utc).replace(
+                        tzinfo=None)
+                if start < cutoff:
+                    groups.setdefault(month(start), []).append((run, p, start))
+            for partition, items in groups.items():
+                for i in range(0, len(items), batch_size):
+                    self._archive_runs(
+                        archive, project, partition, items[i:i+batch_size],
+                        counts)
+        return counts
+
+    def _archive_runs(self, archive, project, partition, items, counts):
+        rows = [{
+            'project': project,
+            'uid': get_in(run, 'metadata.uid'),
+            'iteration': get_in(run, 'metadata.iteration', 0) or 0,
+            'name': get_in(run, 'metadata.name'),
+            'state': get_in(run, 'status.state'),
+            'start_time': start,
+            'labels': json.dumps(get_in(run, 'metadata.labels', {})),
+            'body': encode_struct(run),
+        } for run, _, start in items]
+        key = archive.write(run_logs, project, partition, rows)
+        archived = []
+        for (run, p, _), row in zip(items, rows):
+            version = run.get(version_key, 0)
+            stub = {
+                'metadata': run.get('metadata', {}),
+                'status': {
+                    'state': row['state'],
+                    'start_time': get_in(run, 'status.start_time'),
+                    'last_update': get_in(run, 'status.last_update'),
+                },
+                '_archive': key,
+                version_key: version,
+            }
+            name = self._run_path(row['uid'], row['iteration'])
+            with self._lock(run_logs, project, name):
+                # Runs updated since they were read stay, their archive row
+                # is not used
+                stored = self._read_stored(p)
+                if not stored or stored.get(version_key, 0) != version or \
+                        '_archive' in stored:
+                    continue
+                self._put(p, self._dumps(stub, path.splitext(p)[1]))
+                self._index_put(run_logs, project, p, stub)
+            archived.append(row)
+        counts['runs'] += len(archived)
+
+        logs = []
+        for uid in {row['uid'] for row in archived}:
+            logpath = self._log_path(project, uid)
+            body = self._get_file(logpath)
+            if body is not None:
+                logs.append((logpath, {
+                    'project': project, 'uid': uid, 'body': body}))
+        if not logs:
+            return
+        key = archive.write('logs', project, partition, [r for _, r in logs])
+        for logpath, _ in logs:
+            self._put(logpath + '.archive', key)
+            self._remove(logpath)
+        counts['logs'] += len(logs)
+
+    def _unstub(self, run, project):
+        """Run (without version), fetched from the archive if a stub"""
+        if not run:
+            return run
+        run.pop(version_key, None)
+        if '_archive' not in run:
+            return run
+        row = self._get_archive().find(
+            run['_archive'],
+            project=project or config.default_project,
+            uid=get_in(run, 'metadata.uid'),
+            iteration=get_in(run, 'metadata.iteration', 0) or 0,
+        )
+        run = decode_struct(row['body'])
+        run.pop(version_key, None)
+        return run
+
+    def _get_archive(self):
+        if not self.archive:
+            raise RunDBError('archive is not configured (archive_path)')
+        return self.archive
 
     def store_artifact(self, key, artifact, uid, iter=None, tag='', project=''):
         if 'updated' not in artifact:
             artifact['updated'] = datetime.now(timezone.utc).isoformat()
-        data = self._dumps(artifact)
+        data = self._encode(artifact, artifacts_dir)
         if iter:
             key = '{}-{}'.format(iter, key)
-        filepath = self._filepath(
-            artifacts_dir, project, key, uid) + self.format
-        self._datastore.put(filepath, data)
-        filepath = self._filepath(
-            artifacts_dir, project, key, tag or 'latest') + self.format
-        self._datastore.put(filepath, data)
+        for tree in (uid, tag or 'latest'):
+            basepath = self._artifact_paths(project, key, tree, create=True)[0]
+            self._store(artifacts_dir, project, basepath, artifact, data)
 
     def read_artifact(self, key, tag='', iter=None, project=''):
         tag = tag or 'latest'
         if iter:
             key = '{}-{}'.format(iter, key)
-        filepath = self._filepath(
-            artifacts_dir, project, key, tag) + self.format
-
-        if not pathlib.Path(filepath).is_file():
+        filepath = self._find_file(
+            *self._artifact_paths(project, key, tag))
+        data = self._get_file(filepath)
+        if data is None:
             raise RunDBError(key)
-        data = self._datastore.get(filepath)
-        return self._loads(data)
+        return self._decode(filepath, data)
 
     def list_artifacts(
             self, name='', project='', tag='', labels=None, since=None,
@@ -183,94 +567,140 @@ class FileRunDB(RunDBInterface):
         name = name or ''
         logger.info(
             f'reading artifacts in {project} name/mask: {name} tag: {tag} ...')
-        filepath = self._filepath(artifacts_dir, project, tag=tag)
         results = ArtifactList()
         results.tag = tag
         if isinstance(labels, str):
             labels = labels.split(',')
+
+        match = self._artifact_match(name, project, tag, since, until)
+        found = self._find(artifacts_dir, project, match, labels)
         if tag == '*':
-            mask = '**/*' + name
-            if name:
-                mask += '*'
-        else:
-            mask = '**/*'
+            dirpath = self._table_dir(artifacts_dir, project)
+            found = self._without_copies(
+                found, project,
+                lambda item: (path.relpath(item[1], dirpath), item[0]))
+        for artifact, p in found:
+            if 'artifacts/latest' in p:
+                artifact['tree'] = 'latest'
+            results.append(artifact)
 
+        return results
+
+    def list_artifacts_page(
+            self, name='', project='', tag='', labels=None, since=None,
+            until=None, page_size=100, cursor=None):
+        if not self.use_index:
+            return super().list_artifacts_page(
+                name, project, tag, labels, since, until, page_size, cursor)
+        labels = [] if labels is None else labels
+        tag = tag or 'latest'
+        if isinstance(labels, str):
+            labels = labels.split(',')
+        match = self._artifact_match(name or '', project, tag, since, until)
+        unique = None
+        if tag == '*':
+            unique = partial(self._without_copies, project=project)
+        found, cursor = self._find_page(
+            artifacts_dir, project, match, labels, 'updated', page_size,
+            cursor, unique)
+        results = ArtifactList()
+        results.tag = tag
+        for artifact, p in found:
+            if 'artifacts/latest' in p:
+                artifact['tree'] = 'latest'
+            results.append(artifact)
+        return results, cursor
+
+    def _artifact_match(self, name, project, tag, since, until):
         time_pred = make_time_pred(since, until)
-        for artifact, p in self._load_list(filepath, mask):
-            if (name == '' or name in get_in(artifact, 'key', ''))\
-                    and match_labels(get_in(artifact, 'labels', {}), labels):
-                if not time_pred(artifact):
-                    continue
-                if 'artifacts/latest' in p:
-                    artifact['tree'] = 'latest'
-                results.append(artifact)
+        levels = _levels(self._layout(artifacts_dir, project))
 
-        return results
+        def match(relpath, fields):
+            return _in_tag(relpath, tag, levels) and \
+                (name == '' or name in (fields.get('key') or '')) and \
+                time_pred(fields)
+        return match
+
+    def _without_copies(self, items, project, info=None):
+        """Artifact items (of tag="*" lists) without their tag copies
+
+        store_artifact writes an artifact under its uid and under its tag,
+        the copies have the same key and updated time, the first copy not
+        under "latest" is kept. info returns the (relative path, fields) of
+        an item (default the item itself).
+        """
+        info = info or (lambda item: item)
+        levels = _levels(self._layout(artifacts_dir, project))
+        kept = {}
+        for item in items:
+            relpath, fields = info(item)
+            copy = (
+                _artifact_key(relpath, levels), str(fields.get('updated')))
+            prev = kept.get(copy)
+            if prev is None or _in_tag(info(prev)[0], 'latest', levels) and \
+                    not _in_tag(relpath, 'latest', levels):
+                kept[copy] = item
+        return list(kept.values())
 
     def del_artifact(self, key, tag='', project=''):
         tag = tag or 'latest'
-        filepath = self._filepath(
-            artifacts_dir, project, key, tag) + self.format
+        filepath = self._find_file(
+            *self._artifact_paths(project, key, tag))
         self._safe_del(filepath)
+        self._index_del(artifacts_dir, project, filepath)
 
     def del_artifacts(self, name='', project='', tag='', labels=None):
         labels = [] if labels is None else labels
         tag = tag or 'latest'
-        filepath = self._filepath(artifacts_dir, project, tag=tag)
-
         if isinstance(labels, str):
             labels = labels.split(',')
-        if tag == '*':
-            mask = '**/*' + name
-            if name:
-                mask += '*'
-        else:
-            mask = '**/*'
+        levels = _levels(self._layout(artifacts_dir, project))
 
-        for artifact, p in self._load_list(filepath, mask):
-            if (name == '' or name == get_in(artifact, 'key', ''))\
-                    and match_labels(get_in(artifact, 'labels', {}), labels):
+        def match(relpath, fields):
+            return _in_tag(relpath, tag, levels) and \
+                (name == '' or name == fields.get('key'))
 
-                self._safe_del(p)
+        found = list(self._find(artifacts_dir, project, match, labels))
+        for _, p in found:
+            self._safe_del(p)
+            self._index_del(artifacts_dir, project, p)
 
     def store_function(self, func, name, project='', tag=''):
         update_in(func, 'metadata.updated', datetime.now(timezone.utc))
         update_in(func, 'metadata.tag', '')
-        data = self._dumps(func)
-        filepath = path.join(self.dirpath, '{}/{}/{}/{}'.format(
+        basepath = path.join(self.dirpath, '{}/{}/{}/{}'.format(
             functions_dir, project or config.default_project, name,
-            tag or 'latest')) + self.format
-        self._datastore.put(filepath, data)
+            tag or 'latest'))
+        self._store(functions_dir, project, basepath, func)
 
     def get_function(self, name, project='', tag=''):
-        filepath = path.join(self.dirpath, '{}/{}/{}/{}'.format(
+        basepath = path.join(self.dirpath, '{}/{}/{}/{}'.format(
             functions_dir, project or config.default_project, name,
-            tag or 'latest')) + self.format
-        if not pathlib.Path(filepath).is_file():
+            tag or 'latest'))
+        filepath = self._find_file(basepath)
+        data = self._get_file(filepath)
+        if data is None:
             return None
-        data = self._datastore.get(filepath)
-        return self._loads(data)
+        return self._decode(filepath, data)
 
     def list_functions(self, name, project='', tag='', labels=None):
         labels = labels or []
         logger.info(
             f'reading functions in {project} name/mask: {name} tag: {tag} ...')
-        filepath = path.join(self.dirpath, '{}/{}/'.format(
-            functions_dir, project or config.default_project))
         results = []
         if isinstance(labels, str):
             labels = labels.split(',')
-        mask = '**/*'
-        if name:
-            filepath = '{}{}/'.format(filepath, name)
-            mask = '*'
-        for func, fullname in self._load_list(filepath, mask):
-            if match_labels(get_in(func, 'metadata.labels', {}), labels):
-                name, _ = path.splitext(path.basename(fullname))
-                if len(name) > 20:  # hash vs tags
-                    name = ''
-                update_in(func, 'metadata.tag', name)
-                results.append(func)
+
+        def match(relpath, _):
+            return not name or path.dirname(relpath) == name
+
+        for func, fullname in self._find(
+                functions_dir, project, match, labels):
+            name, _ = path.splitext(path.basename(fullname))
+            if len(name) > 20:  # hash vs tags
+                name = ''
+            update_in(func, 'metadata.tag', name)
+            results.append(func)
 
         return results
 
@@ -283,8 +713,289 @@ class FileRunDB(RunDBInterface):
         return path.join(self.dirpath, '{}/{}/{}{}'.format(
             table, project, tag, key))
 
+    def _table_dir(self, table, project):
+        return path.join(
+            self.dirpath, table, project or config.default_project)
+
+    def _artifact_paths(self, project, key, tree, create=False):
+        """Paths (no extension) of an artifact file, the layout path first
+
+        tree is the artifact uid or tag.
+        """
+        layout = self._layout(artifacts_dir, project, create)
+        paths = [
+            self._filepath(artifacts_dir, project, key, tree),
+            self._filepath(artifacts_dir, project, key, path.join(
+                _shard(tree, _levels(layout)), tree)),
+        ]
+        return paths[::-1] if layout['layout'] == 'hashed' else paths
+
+    def _layout(self, table, project, create=False):
+        """Layout manifest of a runs or artifacts directory
+
+        {"layout": "flat" or "hashed", "levels": <hash directory levels>}.
+        Directories created before layouts (without a manifest) are flat,
+        new ones get httpdb.file_layout, create writes their manifest.
+        """
+        dirpath = self._table_dir(table, project)
+        layout = self._layouts.get(dirpath)
+        if layout:
+            return layout
+        data = self._get_file(path.join(dirpath, layout_file))
+        if data is not None:
+            layout = json.loads(data)
+        elif self._is_dir(dirpath):
+            layout = {'layout': 'flat', 'levels': 0}
+        else:
+            layout = new_layout(config.httpdb.file_layout)
+            if not create:
+                return layout
+            self._save_layout(dirpath, layout)
+        self._layouts[dirpath] = layout
+        return layout
+
+    def _save_layout(self, dirpath, layout):
+        if self._is_local():
+            _save_layout(dirpath, layout)
+        else:
+            self._put(path.join(dirpath, layout_file), json.dumps(layout))
+
+    def _is_dir(self, dirpath):
+        if self._is_local():
+            return path.isdir(dirpath)
+        # Object stores have no directories, only keys with the prefix
+        for page in self._datastore.list_files(self._key(dirpath), 1):
+            if page:
+                return True
+        return False
+
+    def migrate_layout(self, layout, project='', levels=None):
+        """Move the run and artifact files to layout (flat or hashed)
+
+        levels is the number of hash directory levels (default
+        httpdb.file_layout_levels), project default is all projects. Run it
+        when the db is idle, an interrupted migration can be run again.
+        Returns moved files per table.
+        """
+        self._local_only('migrate_layout')
+        target = new_layout(layout, levels)
+        counts = {run_logs: 0, artifacts_dir: 0}
+        for table in counts:
+            projects = [project] if project else _subdirs(
+                path.join(self.dirpath, table))
+            for prj in projects:
+                dirpath = self._table_dir(table, prj)
+                if not path.isdir(dirpath):
+                    continue
+                old_levels = _levels(self._layout(table, prj))
+                _save_layout(dirpath, target)
+                self._layouts[dirpath] = target
+                for filepath in _layout_files(dirpath):
+                    relpath = self._layout_relpath(
+                        table, filepath, path.relpath(filepath, dirpath),
+                        target, old_levels)
+                    newpath = path.join(dirpath, relpath)
+                    if newpath == filepath:
+                        continue
+                    if path.exists(newpath):
+                        remove(filepath)  # Written after the layout change
+                    else:
+                        makedirs(path.dirname(newpath), exist_ok=True)
+                        replace(filepath, newpath)
+                    counts[table] += 1
+                _remove_empty_dirs(dirpath)
+                index = self._indexes.setdefault(dirpath, FileIndex(dirpath))
+                if self.use_index or index.exists():
+                    self._build_index(table, index)
+        return counts
+
+    def _layout_relpath(self, table, filepath, relpath, layout, old_levels):
+        parts = relpath.split(path.sep)
+        if table == run_logs:
+            name = parts[-1]
+            if name.endswith('.log'):
+                uid = name[:-len('.log')]
+            elif name.endswith('.log.archive'):
+                uid = name[:-len('.log.archive')]
+            else:
+                obj = self._load_file(filepath) or {}
+                uid = get_in(obj, 'metadata.uid') or path.splitext(name)[0]
+            parts = [uid, name]
+        else:
+            # Files of an interrupted migration may be in either layout
+            for levels in {old_levels, _levels(layout)}:
+                if len(parts) > levels + 1 and path.join(*parts[:levels]) \
+                        == _shard(parts[levels], levels):
+                    parts = parts[levels:]
+                    break
+            parts = [parts[0]] + parts
+        shard, name = parts[0], parts[1:]
+        if layout['layout'] == 'hashed':
+            return path.join(_shard(shard, layout['levels']), *name)
+        return path.join(*name)
+
+    def _find(self, table, project, match, labels=None, sort_key=None,
+              last=0):
+        """(object, file path) of table files matching the index fields
+
+        match is called with the file path (relative to the table directory)
+        and the index fields, labels are match_labels conditions. With
+        sort_key objects are sorted (newest first) by that field and only
+        the last ones are loaded. Without the index all files are loaded.
+        """
+        dirpath = self._table_dir(table, project)
+        if not self.use_index:
+            yield from self._scan(
+                table, dirpath, match, labels, sort_key, last)
+            return
+        items = [
+            (relpath, fields) for relpath, fields in
+            self._index(table, project).entries(labels)
+            if match(relpath, fields) and
+            match_labels(fields.get('labels') or {}, labels or [])
+        ]
+        if sort_key:
+            items.sort(
+                key=lambda item: str(item[1].get(sort_key) or ''),
+                reverse=True)
+        if last:
+            items = items[:last]
+        yield from self._load_files(
+            [path.join(dirpath, relpath) for relpath, _ in items])
+
+    def _find_page(self, table, project, match, labels, sort_key, page_size,
+                   cursor=None, unique=None):
+        """(objects, next_cursor) page of _find, newest first by the index
+
+        Index entries are sorted by (sort_key field, path), only the files
+        of the page are loaded. unique filters the matching entries.
+        """
+        dirpath = self._table_dir(table, project)
+        entries = [
+            (relpath, fields) for relpath, fields in
+            self._index(table, project).entries(labels)
+            if match(relpath, fields) and
+            match_labels(fields.get('labels') or {}, labels or [])
+        ]
+        if unique:
+            entries = unique(entries)
+        page, cursor = page_list(
+            entries,
+            lambda entry: (str(entry[1].get(sort_key) or ''), entry[0]),
+            page_size, cursor)
+        found = self._load_files(
+            [path.join(dirpath, relpath) for relpath, _ in page])
+        return list(found), cursor
+
+    def _scan(self, table, dirpath, match, labels, sort_key=None, last=0):
+        """_find without the index, loads and filters all the table files
+
+        Runs by start_time with last are loaded newest (mtime) first. A run
+        file is written at or after the run start, the scan stops once last
+        runs started after the modification time of the next file.
+        """
+        early = bool(last) and sort_key == 'start_time' and \
+            table == run_logs
+        slack = float(config.httpdb.file_mtime_slack)
+        files = self._list_files(dirpath, '**/*', early)
+        mtimes = dict(files)
+        items = []
+        starts = []  # heap of the last start times (timestamps)
+        loaded = self._load_files([p for p, _ in files])
+        try:
+            for obj, p in loaded:
+                if early and len(starts) == last and \
+                        starts[0] > mtimes[p] + slack:
+                    break
+                relpath = path.relpath(p, dirpath)
+                fields = index_fields(table, obj)
+                if not match(relpath, fields) or not match_labels(
+                        fields.get('labels') or {}, labels or []):
+                    continue
+                items.append((fields, obj, p))
+                start = _timestamp(fields.get('start_time')) \
+                    if early else None
+                if start is None:
+                    continue
+                if len(starts) < last:
+                    heappush(starts, start)
+                else:
+                    heappushpop(starts, start)
+        finally:
+            loaded.close()
+
+        if sort_key:
+            items.sort(
+                key=lambda item: str(item[0].get(sort_key) or ''),
+                reverse=True)
+        if last:
+            items = items[:last]
+        for _, obj, p in items:
+            yield obj, p
+
+    def _index(self, table, project):
+        dirpath = self._table_dir(table, project)
+        index = self._indexes.get(dirpath)
+        if index is None:
+            index = self._indexes.setdefault(dirpath, FileIndex(dirpath))
+        if not index.exists() and path.isdir(dirpath):
+            # Files stored without the index (or the index was removed)
+            self._build_index(table, index)
+        return index
+
+    def _build_index(self, table, index):
+        entries = [
+            (path.relpath(p, index.dirpath), index_fields(table, obj))
+            for obj, p in self._load_list(index.dirpath, '**/*')
+        ]
+        index.rebuild(entries)
+        return len(entries)
+
+    def _index_put(self, table, project, filepath, obj):
+        if self.use_index:
+            index = self._index(table, project)
+            index.put(
+                path.relpath(filepath, index.dirpath),
+                index_fields(table, obj))
+
+    def _index_del(self, table, project, filepath):
+        if self.use_index:
+            index = self._index(table, project)
+            index.delete(path.relpath(filepath, index.dirpath))
+
+    def rebuild_index(self, tables=None, project=''):
+        """Rebuild the list indexes from the stored files
+
+        tables are runs, artifacts and functions (default all), project
+        default is all projects. Returns indexed files per table.
+        """
+        self._local_only('rebuild_index')
+        counts = {}
+        for table in tables or (run_logs, artifacts_dir, functions_dir):
+            table_dir = path.join(self.dirpath, table)
+            if project:
+                projects = [project]
+            elif path.isdir(table_dir):
+                projects = [
+                    d for d in listdir(table_dir)
+                    if path.isdir(path.join(table_dir, d))]
+            else:
+                projects = []
+            counts[table] = 0
+            for prj in projects:
+                dirpath = self._table_dir(table, prj)
+                index = self._indexes.setdefault(dirpath, FileIndex(dirpath))
+                counts[table] += self._build_index(table, index)
+        return counts
+
     def list_projects(self):
         run_dir = path.join(self.dirpath, run_logs)
+        if not self._is_local():
+            return [
+                {'name': name}
+                for page in self._datastore.list_files(
+                    self._key(run_dir), recursive=False)
+                for name, stats in page if stats is None]
         if not path.isdir(run_dir):
             return []
         return [{'name': d} for d in listdir(run_dir)
@@ -295,58 +1006,536 @@ class FileRunDB(RunDBInterface):
         return path.join(self.dirpath, schedules_dir)
 
     def store_schedule(self, data):
-        sched_id = 1 + sum(1 for _ in scandir(self.schedules_dir))
+        if self._is_local():
+            sched_id = 1 + sum(1 for _ in scandir(self.schedules_dir))
+        else:
+            sched_id = 1 + len(self._list_files(self.schedules_dir, '*'))
         fname = path.join(
             self.schedules_dir,
             '{}{}'.format(sched_id, self.format),
         )
-        with open(fname, 'w') as out:
-            out.write(self._dumps(data))
+        self._put(fname, self._dumps(data))
 
     def list_schedules(self):
-        pattern = '*{}'.format(self.format)
-        for p in pathlib.Path(self.schedules_dir).glob(pattern):
-            with p.open() as fp:
-                yield self._loads(fp.read())
-
-    _encodings = {
-        '.yaml': ('to_yaml', dict_to_yaml),
-        '.json': ('to_json', dict_to_json),
-    }
+        if not self._is_local():
+            for p, _ in sorted(self._list_files(self.schedules_dir, '*')):
+                yield self._load_file(p)
+            return
+        for p in sorted(pathlib.Path(self.schedules_dir).iterdir()):
+            if is_format(p.suffix):
+                yield self._loads(p.read_bytes(), p.suffix)
+
+    # file extension → Format (see formats.register_format)
+    _encodings = formats
+
+    def _dumps(self, obj, format=None):
+        return get_format(format or self.format).dumps(obj)
+
+    def _encode(self, obj, kind):
+        """Serialized obj, compressed if enabled"""
+        data = self._dumps(obj)
+        if not self.compressor.codec:
+            return data
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        data, _ = self.compressor.compress(data, kind)
+        return data
+
+    def _loads(self, data, format=None):
+        if is_compressed(data):
+            data = decompress(data)
+        return get_format(format or self.format).decode(data)
+
+    def _decode(self, filepath, data):
+        return self._loads(data, path.splitext(filepath)[1])
+
+    def _find_file(self, *basepaths):
+        """Path of an object file, in the db format or else any format
+
+        basepaths (no extension) are the object paths in each layout, the
+        first one is returned if there's no file.
+        """
+        for basepath in basepaths:
+            if self._exists(basepath + self.format):
+                return basepath + self.format
+        for basepath in basepaths:
+            for ext in self._encodings:
+                if ext != self.format and self._exists(basepath + ext):
+                    return basepath + ext
+        return basepaths[0] + self.format
+
+    def _store(self, table, project, basepath, obj, data=None):
+        """Write obj to basepath in the db format
+
+        Files of the object in other formats are removed.
+        """
+        filepath = basepath + self.format
+        if data is None:
+            data = self._encode(obj, table)
+        self._put(filepath, data)
+        for ext in self._encodings:
+            if ext != self.format and self._exists(basepath + ext):
+                self._remove(basepath + ext)
+                self._index_del(table, project, basepath + ext)
+        self._index_put(table, project, filepath, obj)
+        return filepath
+
+    def _put(self, filepath, data):
+        """Write a file, atomically (temp file renamed) on local storage"""
+        if not self._is_local():
+            # Object puts are atomic
+            self._datastore.put(self._key(filepath), data)
+            return
+        dirpath, name = path.split(filepath)
+        makedirs(dirpath, exist_ok=True)
+        tmp = path.join(dirpath, f'.{name}.{getpid()}.{get_ident()}.tmp')
+        try:
+            with open(tmp, 'wb' if isinstance(data, bytes) else 'w') as fp:
+                fp.write(data)
+                if self.fsync:
+                    fp.flush()
+                    fsync(fp.fileno())
+            replace(tmp, filepath)
+        except BaseException:
+            if path.exists(tmp):
+                remove(tmp)
+            raise
+
+    def _is_local(self):
+        return self._local
+
+    def _key(self, filepath):
+        """Data store key of a db file path"""
+        if self._is_local():
+            return filepath
+        return self._subpath + filepath[len(self.dirpath.rstrip('/')):]
+
+    def _get(self, filepath, size=None, offset=0):
+        if self._is_local():
+            with open(filepath, 'rb') as fp:
+                if offset:
+                    fp.seek(offset)
+                return fp.read(size or -1)
+        return self._datastore.get(self._key(filepath), size, offset)
 
-    def _dumps(self, obj):
-        meth_name, enc_fn = self._encodings.get(self.format, (None, None))
-        if meth_name is None:
-            raise ValueError(f'unsupported format - {self.format}')
+    def _get_file(self, filepath):
+        """File contents, None if there's no such file"""
+        try:
+            return self._get(filepath)
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+        except Exception:
+            if self._is_local() or self._exists(filepath):
+                raise
+            return None
 
-        meth = getattr(obj, meth_name, None)
-        if meth:
-            return meth()
+    def _stat(self, filepath):
+        """FileStats of an object store file, None if there's no file"""
+        try:
+            return self._datastore.stat(self._key(filepath))
+        except Exception:  # Each store raises its own not found error
+            return None
 
-        return enc_fn(obj)
+    def _exists(self, filepath):
+        if self._is_local():
+            return path.isfile(filepath)
+        return self._stat(filepath) is not None
 
-    def _loads(self, data):
-        if self.format == '.yaml':
-            return yaml.load(data, Loader=yaml.FullLoader)
+    def _remove(self, filepath):
+        if self._is_local():
+            remove(filepath)
         else:
-            return json.loads(data)
+            self._datastore.delete(self._key(filepath))
+
+    def _local_only(self, name):
+        if not self._is_local():
+            raise RunDBError(
+                f'{name} is supported on local (file system) dbs only')
+
+    def _lock(self, table, project, name):
+        """Advisory lock of object name (across processes on local storage)"""
+        locks = object_locks(
+            self._table_dir(table, project), records=self._is_local())
+        return locks.lock(name)
+
+    def convert_format(self, format, tables=None):
+        """Rewrite the files of other formats in format
+
+        format becomes the format of this db (set httpdb.file_format for
+        other db instances). tables are runs, artifacts, functions and
+        schedules (default all). Returns converted files per table.
+        """
+        self._local_only('convert_format')
+        get_format(format)
+        self.format = format
+        counts = {}
+        for table in tables or (
+                run_logs, artifacts_dir, functions_dir, schedules_dir):
+            table_dir = pathlib.Path(self.dirpath, table)
+            counts[table] = 0
+            for p in self._body_files(table):
+                if p.suffix == format:
+                    continue
+                obj = self._loads(p.read_bytes(), p.suffix)
+                basepath = str(p)[:-len(p.suffix)]
+                if table == schedules_dir:
+                    self._put(basepath + format, self._dumps(obj))
+                    remove(str(p))
+                else:
+                    project = p.relative_to(table_dir).parts[0]
+                    self._store(table, project, basepath, obj)
+                counts[table] += 1
+        return counts
 
     def _load_list(self, dirpath, mask):
-        for p in pathlib.Path(dirpath).glob(mask + self.format):
-            if p.is_file():
-                if '.ipynb_checkpoints' in p.parts:
+        return self._load_files(
+            [p for p, _ in self._list_files(dirpath, mask)])
+
+    def _list_files(self, dirpath, mask, newest_first=False):
+        """(path, modification time) of dirpath files matching mask
+
+        mask is '**/*' (all files) or '*' (dirpath files) on object stores,
+        their etags are kept to cache the decoded files.
+        """
+        if not self._is_local():
+            return self._list_objects(dirpath, mask, newest_first)
+        files = []
+        for p in pathlib.Path(dirpath).glob(mask):
+            if not is_format(p.suffix) or p.name.startswith('.') or \
+                    '.ipynb_checkpoints' in p.parts:
+                continue
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            if S_ISREG(st.st_mode):
+                files.append((str(p), st.st_mtime))
+        if newest_first:
+            files.sort(key=itemgetter(1), reverse=True)
+        return files
+
+    def _list_objects(self, dirpath, mask, newest_first=False):
+        files = []
+        etags = {}
+        key = self._key(dirpath)
+        page_size = int(config.httpdb.file_list_page_size)
+        for page in self._datastore.list_files(
+                key, page_size, recursive=mask != '*'):
+            for relpath, stats in page:
+                if stats is None:  # Directory (recursive=False)
+                    continue
+                parts = relpath.split('/')
+                if not is_format(path.splitext(relpath)[1]) or any(
+                        part.startswith('.') for part in parts) or \
+                        '.ipynb_checkpoints' in parts:
                     continue
-                data = self._loads(p.read_text())
-                if data:
-                    yield data, str(p)
+                filepath = path.join(dirpath, relpath)
+                files.append((filepath, stats.modified))
+                etags[filepath] = stats.etag
+        self._etags.update(etags)
+        if newest_first:
+            files.sort(key=itemgetter(1), reverse=True)
+        return files
+
+    def _load_files(self, paths):
+        """(object, path) of files, read and decoded by a thread pool
+
+        Objects are returned in paths order, reads run up to a few files per
+        thread ahead of the consumer and stop when the generator is closed.
+        """
+        workers = int(config.httpdb.file_load_workers)
+        if workers <= 1 or len(paths) < 2:
+            for p in paths:
+                obj = self._load_file(p)
+                if obj:
+                    yield obj, p
+            return
+
+        paths = iter(paths)
+        with ThreadPoolExecutor(workers) as pool:
+            pending = deque(
+                (p, pool.submit(self._load_file, p))
+                for p in islice(paths, workers * 4))
+            try:
+                while pending:
+                    p, future = pending.popleft()
+                    for next_path in islice(paths, 1):
+                        pending.append(
+                            (next_path,
+                             pool.submit(self._load_file, next_path)))
+                    obj = future.result()
+                    if obj:
+                        yield obj, p
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+    def _load_file(self, filepath):
+        if not self._is_local():
+            return self._load_object(filepath)
+        try:
+            data = pathlib.Path(filepath).read_bytes()
+        except FileNotFoundError:  # Deleted by another process
+            return None
+        return self._loads(data, path.splitext(filepath)[1])
+
+    def _load_object(self, filepath):
+        # Object store files are fetched once per etag (from the list)
+        etag = self._etags.get(filepath)
+        key = (filepath, etag)
+        if etag:
+            obj = self._file_cache.get(key)
+            if obj is not None:
+                return deepcopy(obj)
+        data = self._get_file(filepath)
+        if data is None:  # Deleted by another process
+            return None
+        obj = self._decode(filepath, data)
+        if etag and obj:
+            self._file_cache.set(key, deepcopy(obj))
+        return obj
+
+    def train_compression(self, kinds=None, samples=1000, dict_size=None):
+        """Train a compression dictionary per kind on its last files
+
+        kinds are runs, artifacts and functions (default all). Files stored
+        afterwards are compressed with the dictionary, kinds without
+        enough files are skipped. Returns kind → dictionary id.
+        """
+        self._local_only('train_compression')
+        dict_size = dict_size or int(config.httpdb.compression_dict_size)
+        out = {}
+        for kind in kinds or (run_logs, artifacts_dir, functions_dir):
+            files = self._body_files(kind)
+            files.sort(key=lambda p: p.stat().st_mtime, reverse=True)
+            data = train_dict(
+                [self._raw_data(p.read_bytes()) for p in files[:samples]],
+                dict_size)
+            if not data:
+                continue
+            dict_id = add_dict(data)
+            filepath = path.join(
+                self.dirpath, dicts_dir, kind, f'{dict_id}.dict')
+            makedirs(path.dirname(filepath), exist_ok=True)
+            with open(filepath, 'wb') as fp:
+                fp.write(data)
+            self.compressor.set_dict(kind, dict_id)
+            out[kind] = dict_id
+        return out
+
+    def storage_stats(self):
+        """Stored and raw (before compression) file bytes per kind"""
+        self._local_only('storage_stats')
+        stats = {}
+        for kind in (run_logs, artifacts_dir, functions_dir):
+            files = self._body_files(kind)
+            stored = raw = compressed = 0
+            for p in files:
+                with p.open('rb') as fp:
+                    header = fp.read(18)  # max zstd frame header size
+                stored += p.stat().st_size
+                if is_compressed(header):
+                    compressed += 1
+                    raw += raw_size(header)
+                else:
+                    raw += p.stat().st_size
+            stats[kind] = {
+                'rows': len(files),
+                'compressed_rows': compressed,
+                'stored_bytes': stored,
+                'raw_bytes': raw,
+                'dict_id': self.compressor.dict_ids().get(kind),
+            }
+        return stats
+
+    def _body_files(self, kind):
+        dirpath = pathlib.Path(self.dirpath, kind)
+        return [
+            p for p in dirpath.glob('**/*')
+            if is_format(p.suffix) and not p.name.startswith('.') and
+            p.is_file()
+        ]
+
+    def _raw_data(self, data):
+        return decompress(data) if is_compressed(data) else data
+
+    def _load_dicts(self):
+        """Use the last trained dictionary of each kind"""
+        if not self._is_local():
+            return
+        dirpath = pathlib.Path(self.dirpath, dicts_dir)
+        set_dict_loader(str(dirpath), self._load_dict)
+        files = sorted(
+            dirpath.glob('*/*.dict'), key=lambda p: p.stat().st_mtime)
+        for p in files:
+            dict_id = add_dict(p.read_bytes())
+            self.compressor.set_dict(p.parent.name, dict_id)
+
+    def _load_dict(self, dict_id):
+        dirpath = pathlib.Path(self.dirpath, dicts_dir)
+        for p in dirpath.glob(f'*/{dict_id}.dict'):
+            return p.read_bytes()
 
     def _safe_del(self, filepath):
-        if path.isfile(filepath):
-            remove(filepath)
+        if self._exists(filepath):
+            self._remove(filepath)
         else:
             raise RunDBError(f'run file is not found or valid ({filepath})')
 
 
+def index_fields(table, obj):
+    """Fields of a table object kept in the index (the list filters)"""
+    if table == run_logs:
+        return {
+            'name': get_in(obj, 'metadata.name'),
+            'uid': get_in(obj, 'metadata.uid'),
+            'iteration': get_in(obj, 'metadata.iteration', 0),
+            'state': get_in(obj, 'status.state'),
+            'start_time': get_in(obj, 'status.start_time'),
+            'last_update': get_in(obj, 'status.last_update'),
+            'labels': get_in(obj, 'metadata.labels') or {},
+            'archived': '_archive' in obj,
+        }
+    if table == artifacts_dir:
+        return {
+            'key': obj.get('key'),
+            'updated': obj.get('updated'),
+            'labels': obj.get('labels') or {},
+        }
+    return {'labels': get_in(obj, 'metadata.labels') or {}}
+
+
+def _timestamp(value):
+    """POSIX timestamp of a time (string), None if it's not a time
+
+    Naive times are local, like the file modification times.
+    """
+    if not isinstance(value, datetime):
+        try:
+            value = parse_time(value)
+        except (TypeError, ValueError, OverflowError):
+            return None
+    return value.timestamp()
+
+
+def _next_version(current=0):
+    """Run version greater than current and the versions issued before
+
+    Versions are time stamps (in nanoseconds) so store_run does not need to
+    read the stored version.
+    """
+    global _last_version
+    with _version_lock:
+        _last_version = max(int(time() * 1e9), _last_version + 1, current + 1)
+        return _last_version
+
+
+def _flush_at_exit(ref):
+    db = ref()
+    if db is None:
+        return
+    try:
+        db.flush()
+    except Exception as err:
+        logger.warning(f'failed to write buffered runs - {err}')
+
+
+def new_layout(layout, levels=None):
+    if layout not in layouts:
+        raise ValueError(f'unknown file layout - {layout}')
+    if layout == 'flat':
+        return {'layout': layout, 'levels': 0}
+    if levels is None:
+        levels = int(config.httpdb.file_layout_levels)
+    if levels < 1:
+        raise ValueError(f'bad hashed layout levels - {levels}')
+    return {'layout': layout, 'levels': levels}
+
+
+def _levels(layout):
+    # Other layout paths of a flat directory use the configured levels
+    return layout['levels'] or int(config.httpdb.file_layout_levels)
+
+
+def _shard(name, levels):
+    """Hash directories of name, e.g. "ab/cd" for 2 levels"""
+    digest = md5(name.encode('utf-8')).hexdigest()
+    return path.join(*(digest[i * 2:i * 2 + 2] for i in range(levels)))
+
+
+def _save_layout(dirpath, layout):
+    makedirs(dirpath, exist_ok=True)
+    filepath = path.join(dirpath, layout_file)
+    with open(filepath + '.tmp', 'w') as fp:
+        json.dump(layout, fp)
+    replace(filepath + '.tmp', filepath)
+
+
+def _subdirs(dirpath):
+    if not path.isdir(dirpath):
+        return []
+    return [d for d in listdir(dirpath) if path.isdir(path.join(dirpath, d))]
+
+
+def _layout_files(dirpath):
+    """Object and log files under dirpath (not the manifest or index)"""
+    files = []
+    for root, dirs, names in walk(dirpath):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        files.extend(
+            path.join(root, name) for name in names
+            if not name.startswith('.'))
+    return files
+
+
+def _remove_empty_dirs(dirpath):
+    for root, _, _ in walk(dirpath, topdown=False):
+        if root != dirpath and not listdir(root):
+            rmdir(root)
+
+
+def _run_match(name, uid, state, iter, archived):
+    """Index fields match function of list_runs"""
+    def match(_, fields):
+        return (archived or not fields.get('archived')) and \
+            match_value(name, fields, 'name') and \
+            match_value(state, fields, 'state') and \
+            match_value(uid, fields, 'uid') and \
+            (iter or fields.get('iteration', 0) == 0)
+    return match
+
+
+def _index_run(fields, project):
+    """Run struct of the index fields of a run (for aggregate_runs_list)"""
+    return {
+        'metadata': {
+            'project': project,
+            'name': fields.get('name'),
+            'labels': fields.get('labels') or {},
+        },
+        'status': {
+            'state': fields.get('state'),
+            'start_time': fields.get('start_time'),
+            'last_update': fields.get('last_update'),
+        },
+    }
+
+
+def _artifact_key(relpath, levels):
+    """Artifact key (and iteration) of a path in the artifacts directory"""
+    parts = relpath.split(path.sep)
+    tree = 1
+    if levels and len(parts) > levels + 1 and \
+            path.join(*parts[:levels]) == _shard(parts[levels], levels):
+        tree = levels + 1
+    return path.splitext(path.join(*parts[tree:]))[0]
+
+
+def _in_tag(relpath, tag, levels):
+    return tag == '*' or relpath.startswith(tag + path.sep) or \
+        relpath.startswith(path.join(_shard(tag, levels), tag) + path.sep)
+
+
 def make_time_pred(since, until):
     if not (since or until):
         return lambda artifact: True
@@ -0,0 +1,172 @@
+# Copyright 2019 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Sidecar index of FileRunDB directories
+
+A directory of object files (e.g. runs/<project>) has an index file with a
+JSON line per change - {"path": "u1.yaml", <fields>} for a stored file and
+{"path": "u1.yaml", "deleted": true} for a deleted one, the last line of a
+path wins. Lines are only appended, a writer crashing mid line leaves a
+partial line which is skipped. List methods filter the index entries and
+read only the files they return.
+"""
+
+import json
+import os
+from os import path
+from threading import Lock
+
+index_file = '.index.jsonl'
+
+
+class FileIndex:
+    """Entries (relative path → fields) of a directory index file
+
+    The entries are read incrementally, only lines appended (by this or
+    other processes) since the last read are parsed.
+    """
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        self.filepath = path.join(dirpath, index_file)
+        self._lock = Lock()
+        self._reset()
+
+    def exists(self):
+        return path.isfile(self.filepath)
+
+    def put(self, relpath, fields):
+        self._append([dict(fields, path=relpath)])
+
+    def delete(self, relpath):
+        self._append([{'path': relpath, 'deleted': True}])
+
+    def entries(self, labels=None):
+        """(path, fields) of indexed files
+
+        labels "name=value" conditions select the entries by the label
+        index, other conditions (~=, != ...) are left to the caller.
+        """
+        with self._lock:
+            self._refresh()
+            paths = self._label_paths(labels)
+            if paths is None:
+                return list(self._entries.items())
+            return [(relpath, self._entries[relpath]) for relpath in paths]
+
+    def rebuild(self, entries):
+        """Replace the index with entries ((path, fields) pairs)
+
+        Appends by other processes during the rebuild are lost, run it when
+        the directory is idle.
+        """
+        os.makedirs(self.dirpath, exist_ok=True)
+        tmp = f'{self.filepath}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fp:
+            for relpath, fields in entries:
+                fp.write(_dumps(dict(fields, path=relpath)))
+        with self._lock:
+            os.replace(tmp, self.filepath)
+            self._refresh()
+
+    def compact(self):
+        """Rewrite the index without deleted and overwritten lines"""
+        self.rebuild(self.entries())
+
+    def stats(self):
+        with self._lock:
+            self._refresh()
+            return {'entries': len(self._entries), 'lines': self._lines}
+
+    def _label_paths(self, labels):
+        paths = None
+        for cond in labels or []:
+            if '~=' in cond or '!=' in cond or '=' not in cond:
+                continue
+            name, value = (part.strip() for part in cond.split('=', 1))
+            if not value:  # Matches objects without the label as well
+                continue
+            found = self._labels.get((name, value), set())
+            paths = found if paths is None else paths & found
+        return paths
+
+    def _append(self, records):
+        data = ''.join(_dumps(record) for record in records).encode()
+        os.makedirs(self.dirpath, exist_ok=True)
+        with self._lock:
+            with open(self.filepath, 'a+b') as fp:
+                fp.seek(0, os.SEEK_END)
+                if fp.tell():
+                    # Don't continue the partial line of a crashed writer
+                    fp.seek(-1, os.SEEK_END)
+                    if fp.read(1) != b'\n':
+                        data = b'\n' + data
+                fp.write(data)
+            self._refresh()
+
+    def _reset(self):
+        self._entries = {}
+        self._labels = {}  # (name, value) → paths
+        self._offset = 0  # of the first line not read yet
+        self._inode = None
+        self._lines = 0
+
+    def _refresh(self):
+        try:
+            stat = os.stat(self.filepath)
+        except FileNotFoundError:
+            self._reset()
+            return
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            self._reset()  # Rebuilt
+            self._inode = stat.st_ino
+        if stat.st_size == self._offset:
+            return
+        with open(self.filepath, 'rb') as fp:
+            fp.seek(self._offset)
+            data = fp.read()
+        end = data.rfind(b'\n') + 1  # A partial last line is read later
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:  # Partial line of a crashed writer
+                continue
+            self._apply(record)
+        self._offset += end
+
+    def _apply(self, record):
+        relpath = record.pop('path', None)
+        if relpath is None:
+            return
+        self._lines += 1
+        old = self._entries.pop(relpath, None)
+        if old:
+            for key in _label_keys(old):
+                self._labels[key].discard(relpath)
+        if record.get('deleted'):
+            return
+        self._entries[relpath] = record
+        for key in _label_keys(record):
+            self._labels.setdefault(key, set()).add(relpath)
+
+
+def _label_keys(fields):
+    labels = fields.get('labels') or {}
+    return [
+        (name, value) for name, value in labels.items()
+        if isinstance(value, str)
+    ]
+
+
+def _dumps(record):
+    return json.dumps(record, default=str) + '\n'
@@ -0,0 +1,93 @@
+# Copyright 2019 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Advisory locks of the objects in a FileRunDB directory
+
+An object name hashes to one of the slots of the directory .lock file, a
+lock is an fcntl record lock of its slot byte (honored by other processes,
+on NFS as well). Record locks belong to the process so each slot has a
+thread lock as well, and the .lock file is kept open.
+"""
+
+import os
+from contextlib import contextmanager
+from os import path
+from threading import Lock
+from zlib import crc32
+
+try:
+    import fcntl
+except ImportError:  # Windows, threads of this process are locked out only
+    fcntl = None
+
+lock_file = '.lock'
+slots = 1024
+_registry = {}  # absolute directory path → ObjectLocks
+_registry_lock = Lock()
+
+
+def _after_fork():
+    # Locks held by other threads at fork time are never released in the
+    # child, and record locks are not inherited
+    global _registry_lock
+    _registry.clear()
+    _registry_lock = Lock()
+
+
+if hasattr(os, 'register_at_fork'):  # Python 3.7+
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def object_locks(dirpath, records=True):
+    """ObjectLocks of dirpath, shared by the db instances of the process"""
+    key = path.abspath(dirpath) if records else dirpath
+    with _registry_lock:
+        locks = _registry.get(key)
+        if locks is None:
+            locks = _registry[key] = ObjectLocks(dirpath, records)
+        return locks
+
+
+class ObjectLocks:
+    def __init__(self, dirpath, records=True):
+        # records is False for non local directories (thread locks only)
+        self.dirpath = dirpath
+        self.records = records and fcntl is not None
+        self._locks = [Lock() for _ in range(slots)]
+        self._fd = None
+        self._fd_lock = Lock()
+
+    @contextmanager
+    def lock(self, name):
+        """Hold the lock of object name (e.g. run file name)"""
+        slot = crc32(name.encode('utf-8')) % slots
+        with self._locks[slot]:
+            fd = self._lock_fd()
+            if fd is None:
+                yield
+                return
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, slot, os.SEEK_SET)
+            try:
+                yield
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, slot, os.SEEK_SET)
+
+    def _lock_fd(self):
+        if not self.records:
+            return None
+        with self._fd_lock:
+            if self._fd is None:
+                os.makedirs(self.dirpath, exist_ok=True)
+                filepath = path.join(self.dirpath, lock_file)
+                self._fd = os.open(filepath, os.O_RDWR | os.O_CREAT)
+            return self._fd
@@ -0,0 +1,141 @@
+# Copyright 2019 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Serialization formats of FileRunDB files
+
+A format is a file extension with an encode (object → str or bytes) and a
+decode function. Files are decoded by their extension, a directory may
+hold files of several formats (e.g. while converting a db).
+
+    .yaml     - YAML, using the LibYAML C loader/dumper when PyYAML is
+                built with it
+    .json     - JSON, using orjson when installed
+    .msgpack  - MessagePack (needs msgpack)
+"""
+
+import json
+from datetime import date, datetime
+
+import yaml
+from yaml.representer import RepresenterError
+
+from ..utils import MyEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_yaml_loader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+_yaml_dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+class Format:
+    """File format, requires is the name of a missing package it needs"""
+
+    def __init__(self, ext, encode, decode, requires=''):
+        self.ext = ext
+        self.encode = encode
+        self.decode = decode
+        self.requires = requires
+
+    def dumps(self, obj):
+        # Model objects (to_yaml/to_json methods) are encoded as dicts
+        to_dict = getattr(obj, 'to_dict', None)
+        if to_dict:
+            obj = to_dict()
+        return self.encode(obj)
+
+
+formats = {}  # extension → Format
+
+
+def register_format(fmt):
+    formats[fmt.ext] = fmt
+
+
+def get_format(ext):
+    fmt = formats.get(ext)
+    if fmt is None:
+        raise ValueError(f'unsupported format - {ext}')
+    if fmt.requires:
+        raise ValueError(f'{ext} format requires the {fmt.requires} package')
+    return fmt
+
+
+def is_format(ext):
+    """True if ext is the extension of a (usable) format"""
+    fmt = formats.get(ext)
+    return fmt is not None and not fmt.requires
+
+
+def yaml_dumps(obj):
+    try:
+        return yaml.dump(
+            obj, Dumper=_yaml_dumper, default_flow_style=False,
+            sort_keys=False)
+    except RepresenterError as e:
+        raise ValueError(
+            'error: data result cannot be serialized to YAML, {} '.format(e))
+
+
+def yaml_loads(data):
+    return yaml.load(data, Loader=_yaml_loader)
+
+
+class _JSONEncoder(MyEncoder):
+    def default(self, obj):
+        if isinstance(obj, (datetime, date)):
+            return obj.isoformat()
+        return super().default(obj)
+
+
+def _default(obj):
+    return _JSONEncoder().default(obj)
+
+
+def json_dumps(obj):
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                obj, default=_default,
+                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+        except TypeError:  # e.g. int over 64 bit, the json module can
+            pass
+    return json.dumps(obj, cls=_JSONEncoder)
+
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def msgpack_dumps(obj):
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+register_format(Format('.yaml', yaml_dumps, yaml_loads))
+register_format(Format('.json', json_dumps, json_loads))
+register_format(Format(
+    '.msgpack', msgpack_dumps, msgpack_loads,
+    requires='' if msgpack else 'msgpack'))
@@ -33,9 +33,13 @@ from kfp import Client as kfclient
 from mlrun.builder import build_runtime
 from mlrun.config import config
 from mlrun.datastore import get_object_stat, StoreManager
-from mlrun.db import RunDBError, RunDBInterface, periodic
+from mlrun.db import (
+    CachedRunDB, RunDBConflictError, RunDBError, RunDBInterface, periodic
+)
+from mlrun.db.base import default_percentiles, label_kinds
 from mlrun.db.filedb import FileRunDB
-from mlrun.db.sqldb import SQLDB, to_dict as db2dict, table2cls
+from mlrun.db.shardeddb import ShardedSQLDB
+from mlrun.db.sqldb import SQLDB, to_dict as db2dict
 from mlrun.k8s_utils import K8sHelper
 from mlrun.run import import_function, new_function, list_piplines
 from mlrun.runtimes import runtime_resources_map
@@ -128,6 +132,8 @@ def catch_err(fn):
     def wrapper(*args, **kw):
         try:
             return fn(*args, **kw)
+        except RunDBConflictError as err:
+            return json_error(HTTPStatus.CONFLICT, ok=False, reason=str(err))
         except RunDBError as err:
             return json_error(
                 HTTPStatus.INTERNAL_SERVER_ERROR, ok=False, reason=str(err))
@@ -635,6 +641,24 @@ def update_run(project, uid):
     return jsonify(ok=True)
 
 
+# curl -d '{"ops": [{"op": "inc", "key": "status.retries"}], "version": 3}' \
+#   http://localhost:8080/run/p1/3/patch
+@app.route('/api/run/<project>/<uid>/patch', methods=['POST'])
+@catch_err
+def patch_run(project, uid):
+    try:
+        data = request.get_json(force=True)
+    except ValueError:
+        return json_error(HTTPStatus.BAD_REQUEST, reason='bad JSON body')
+
+    if not isinstance(data, dict) or 'ops' not in data:
+        return json_error(HTTPStatus.BAD_REQUEST, reason='missing ops')
+    iter = int(request.args.get('iter', '0'))
+    version = _db.patch_run(
+        data['ops'], uid, project, iter=iter, version=data.get('version'))
+    return jsonify(ok=True, version=version)
+
+
 # curl http://localhost:8080/run/p1/3
 @app.route('/api/run/<project>/<uid>', methods=['GET'])
 @catch_err
@@ -654,6 +678,8 @@ def del_run(project, uid):
 
 
 # curl http://localhost:8080/runs?project=p1&name=x&label=l1&label=l2&sort=no
+# with archived runs: curl http://localhost:8080/runs?project=p1&archived=yes
+# paged: curl http://localhost:8080/runs?project=p1&page_size=100&cursor=...
 @app.route('/api/runs', methods=['GET'])
 @catch_err
 def list_runs():
@@ -665,6 +691,22 @@ def list_runs():
     sort = strtobool(request.args.get('sort', 'on'))
     iter = strtobool(request.args.get('iter', 'on'))
     last = int(request.args.get('last', '0'))
+    archived = strtobool(request.args.get('archived', 'no'))
+    page_size = int(request.args.get('page_size', '0'))
+
+    if page_size:
+        runs, cursor = _db.list_runs_page(
+            name=name or None,
+            uid=uid or None,
+            project=project or None,
+            labels=labels,
+            state=state or None,
+            iter=iter,
+            page_size=page_size,
+            cursor=request.args.get('cursor') or None,
+            archived=archived,
+        )
+        return jsonify(ok=True, runs=runs, next_cursor=cursor)
 
     runs = _db.list_runs(
         name=name or None,
@@ -675,9 +717,67 @@ def list_runs():
         sort=sort,
         last=last,
         iter=iter,
+        archived=archived,
     )
     return jsonify(ok=True, runs=runs)
 
+
+# curl 'http://localhost:8080/api/runs/aggregate?group_by=state&bucket=hour'
+@app.route('/api/runs/aggregate', methods=['GET'])
+@catch_err
+def aggregate_runs():
+    group_by = request.args.getlist('group_by')
+    group_by = [key for value in group_by for key in value.split(',') if key]
+    percentiles = request.args.get('percentiles')
+    if percentiles is None:
+        percentiles = default_percentiles
+    else:
+        percentiles = [float(p) for p in percentiles.split(',') if p]
+        percentiles = [int(p) if p.is_integer() else p for p in percentiles]
+
+    groups = _db.aggregate_runs(
+        project=request.args.get('project') or None,
+        group_by=group_by,
+        bucket=request.args.get('bucket') or None,
+        since=request.args.get('since') or None,
+        until=request.args.get('until') or None,
+        name=request.args.get('name') or None,
+        labels=request.args.getlist('label'),
+        state=request.args.get('state') or None,
+        iter=strtobool(request.args.get('iter', 'off')),
+        percentiles=percentiles,
+    )
+    return jsonify(ok=True, groups=groups)
+
+
+# curl 'http://localhost:8080/api/runs/results?where=accuracy>0.9'
+@app.route('/api/runs/results', methods=['GET'])
+@catch_err
+def query_results():
+    runs = _db.query_results(
+        project=request.args.get('project') or None,
+        where=request.args.getlist('where'),
+        order_by=request.args.get('order_by') or None,
+        desc=strtobool(request.args.get('desc', 'on')),
+        limit=int(request.args.get('limit', '10')),
+        iter=strtobool(request.args.get('iter', 'on')),
+    )
+    return jsonify(ok=True, runs=runs)
+
+
+# curl 'http://localhost:8080/api/labels?project=p1&kind=artifacts'
+@app.route('/api/labels', methods=['GET'])
+@catch_err
+def label_stats():
+    kind = request.args.get('kind', 'runs')
+    if kind not in label_kinds:
+        return json_error(
+            HTTPStatus.BAD_REQUEST, reason=f'bad kind: {kind!r}')
+    labels = _db.label_stats(
+        project=request.args.get('project') or None, kind=kind)
+    return jsonify(ok=True, labels=labels)
+
+
 # curl -X DELETE http://localhost:8080/runs?project=p1&name=x&days_ago=3
 @app.route('/api/runs', methods=['DELETE'])
 @catch_err
@@ -688,10 +788,28 @@ def del_runs():
     state = request.args.get('state', '')
     days_ago = int(request.args.get('days_ago', '0'))
 
-    _db.del_runs(name, project, labels, state, days_ago)
+    _db.del_runs(name or None, project, labels, state or None, days_ago)
     return jsonify(ok=True)
 
 
+# curl -d '{"ops": [{"op": "update_run", "uid": "3", "updates": {...}}]}' \
+#   http://localhost:8080/api/batch
+@app.route('/api/batch', methods=['POST'])
+@catch_err
+def batch():
+    try:
+        data = request.get_json(force=True)
+    except ValueError:
+        return json_error(HTTPStatus.BAD_REQUEST, reason='bad JSON body')
+
+    ops = data.get('ops') if isinstance(data, dict) else None
+    if not isinstance(ops, list):
+        return json_error(HTTPStatus.BAD_REQUEST, reason='missing ops list')
+
+    _db.batch(ops)
+    return jsonify(ok=True, count=len(ops))
+
+
 # curl -d@/path/to/artifcat http://localhost:8080/artifact/p1/7&key=k
 @app.route('/api/artifact/<project>/<uid>/<path:key>', methods=['POST'])
 @catch_err
@@ -748,6 +866,13 @@ def list_artifacts():
     project = request.args.get('project', config.default_project)
     tag = request.args.get('tag') or None
     labels = request.args.getlist('label')
+    page_size = int(request.args.get('page_size', '0'))
+
+    if page_size:
+        artifacts, cursor = _db.list_artifacts_page(
+            name, project, tag, labels, page_size=page_size,
+            cursor=request.args.get('cursor') or None)
+        return jsonify(ok=True, artifacts=artifacts, next_cursor=cursor)
 
     artifacts = _db.list_artifacts(name, project, tag, labels)
     return jsonify(ok=True, artifacts=artifacts)
@@ -798,6 +923,13 @@ def list_functions():
     project = request.args.get('project', config.default_project)
     tag = request.args.get('tag') or None
     labels = request.args.getlist('label')
+    page_size = int(request.args.get('page_size', '0'))
+
+    if page_size:
+        funcs, cursor = _db.list_functions_page(
+            name, project, tag, labels, page_size=page_size,
+            cursor=request.args.get('cursor') or None)
+        return jsonify(ok=True, funcs=list(funcs), next_cursor=cursor)
 
     out = _db.list_functions(name, project, tag, labels)
     return jsonify(
@@ -905,21 +1037,12 @@ def tag_objects(project, name):
     except ValueError:
         return json_error(HTTPStatus.BAD_REQUEST, reason='bad JSON body')
 
-    objs = []
-    for typ, query in data.items():
-        cls = table2cls(typ)
-        if cls is None:
-            err = f'unknown type - {typ}'
-            return json_error(HTTPStatus.BAD_REQUEST, reason=err)
-        # {'name': 'bugs'} -> [Function.name=='bugs']
-        db_query = [
-            getattr(cls, key) == value for key, value in query.items()
-        ]
-        # TODO: Change _query to query?
-        # TODO: Not happy about exposing db internals to API
-        objs.extend(_db.session.query(cls).filter(*db_query))
-    _db.tag_objects(objs, project, name)
-    return jsonify(ok=True, project=project, name=name, count=len(objs))
+    # {'functions': {'name': 'bugs'}} tags the functions named bugs
+    try:
+        count = _db.tag_query(project, name, data)
+    except ValueError as err:
+        return json_error(HTTPStatus.BAD_REQUEST, reason=str(err))
+    return jsonify(ok=True, project=project, name=name, count=count)
 
 
 @app.route('/api/<project>/tag/<name>', methods=['DELETE'])
@@ -951,6 +1074,55 @@ def get_tagged(project, name):
     )
 
 
+# curl http://localhost:8080/api/db/pool
+@app.route('/api/db/pool', methods=['GET'])
+@catch_err
+def db_pool_stats():
+    db = _sqldb()
+    if not db:
+        return json_error(
+            HTTPStatus.BAD_REQUEST, reason='pool stats require SQLDB')
+    return jsonify(ok=True, stats=db.pool_stats())
+
+
+# curl http://localhost:8080/api/db/cache
+@app.route('/api/db/cache', methods=['GET'])
+@catch_err
+def db_cache_stats():
+    if not isinstance(_db, CachedRunDB):
+        return json_error(HTTPStatus.BAD_REQUEST, reason='db cache disabled')
+    return jsonify(ok=True, stats=_db.cache_stats())
+
+
+# curl http://localhost:8080/api/db/storage
+@app.route('/api/db/storage', methods=['GET'])
+@catch_err
+def db_storage_stats():
+    storage_stats = getattr(_db, 'storage_stats', None)
+    if not storage_stats:
+        return json_error(
+            HTTPStatus.BAD_REQUEST, reason='storage stats not supported')
+    return jsonify(ok=True, stats=storage_stats())
+
+
+@app.teardown_request
+def close_db_session(exc):
+    db = _sqldb()
+    if db:
+        db.close_session()
+
+
+def _backend():
+    """DB used by the server, without the cache"""
+    return _db.db if isinstance(_db, CachedRunDB) else _db
+
+
+def _sqldb():
+    """SQLDB used by the server (None if not using SQLDB)"""
+    db = _backend()
+    return db if isinstance(db, (SQLDB, ShardedSQLDB)) else None
+
+
 @app.route('/api/healthz', methods=['GET'])
 def health():
     return jsonify(ok=True, version=config.version)
@@ -961,13 +1133,18 @@ def init_app():
     global _db, _logs_dir, _k8s, _scheduler
 
     logger.info('configuration dump\n%s', config.dump_yaml())
-    if config.httpdb.db_type == 'sqldb':
+    if config.httpdb.db_type == 'sqldb' and config.httpdb.shards:
+        logger.info('using ShardedSQLDB')
+        _db = ShardedSQLDB(config.httpdb.dsn)
+    elif config.httpdb.db_type == 'sqldb':
         logger.info('using SQLDB')
         _db = SQLDB(config.httpdb.dsn)
     else:
         logger.info('using FileRunDB')
         _db = FileRunDB(config.httpdb.dirpath)
     _db.connect()
+    if config.httpdb.cache_size:
+        _db = CachedRunDB(_db)
     _logs_dir = Path(config.httpdb.logs_path)
 
     try:
@@ -979,6 +1156,14 @@ def init_app():
     task = periodic.Task()
     periodic.schedule(task, 60)
 
+    if _sqldb() and periodic.retention_enabled():
+        task = periodic.RetentionTask(_sqldb())
+        periodic.schedule(task, config.httpdb.retention_interval)
+
+    if periodic.archive_enabled():
+        task = periodic.ArchiveTask(_backend())
+        periodic.schedule(task, config.httpdb.archive_interval)
+
     _scheduler = Scheduler()
     for data in _db.list_schedules():
         if 'schedule' not in data:
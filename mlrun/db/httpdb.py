@@ -15,6 +15,7 @@
 import json
 import tempfile
 import time
+from http import HTTPStatus
 from os import path, remove
 
 import kfp
@@ -23,7 +24,9 @@ from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
 from ..utils import dict_to_json, logger, new_pipe_meta
-from .base import RunDBError, RunDBInterface
+from .base import (
+    RunDBConflictError, RunDBError, RunDBInterface, default_percentiles
+)
 from ..lists import RunList, ArtifactList
 from ..config import config
 
@@ -97,6 +100,9 @@ class HTTPRunDB(RunDBInterface):
                     reason = ''
             if reason:
                 error = error or '{} {}, error: {}'.format(method, url, reason)
+                if resp.status_code == HTTPStatus.CONFLICT:
+                    error = f'{error} - {reason}'
+                    raise RunDBConflictError(error)
                 raise RunDBError(error)
 
             try:
@@ -178,6 +184,14 @@ class HTTPRunDB(RunDBInterface):
         body = _as_json(updates)
         self.api_call('PATCH', path, error, params=params, body=body)
 
+    def patch_run(self, ops, uid, project='', iter=0, version=None):
+        path = self._path_of('run', project, uid) + '/patch'
+        params = {'iter': iter}
+        error = f'patch run {project}/{uid}'
+        body = _as_json({'ops': ops, 'version': version})
+        resp = self.api_call('POST', path, error, params=params, body=body)
+        return resp.json()['version']
+
     def read_run(self, uid, project='', iter=0):
         path = self._path_of('run', project, uid)
         params = {'iter': iter}
@@ -192,7 +206,7 @@ class HTTPRunDB(RunDBInterface):
         self.api_call('DELETE', path, error, params=params)
 
     def list_runs(self, name='', uid=None, project='', labels=None,
-                  state='', sort=True, last=0, iter=False):
+                  state='', sort=True, last=0, iter=False, archived=False):
 
         project = project or default_project
         params = {
@@ -203,11 +217,72 @@ class HTTPRunDB(RunDBInterface):
             'state': state,
             'sort': bool2str(sort),
             'iter': bool2str(iter),
+            'last': last,
+            'archived': bool2str(archived),
         }
         error = 'list runs'
         resp = self.api_call('GET', 'runs', error, params=params)
         return RunList(resp.json()['runs'])
 
+    def list_runs_page(self, name='', uid=None, project='', labels=None,
+                       state='', iter=False, page_size=100, cursor=None,
+                       archived=False):
+        params = {
+            'name': name,
+            'uid': uid,
+            'project': project or default_project,
+            'label': labels or [],
+            'state': state,
+            'iter': bool2str(iter),
+            'page_size': page_size,
+            'cursor': cursor,
+            'archived': bool2str(archived),
+        }
+        error = 'list runs'
+        resp = self.api_call('GET', 'runs', error, params=params).json()
+        return RunList(resp['runs']), resp.get('next_cursor')
+
+    def aggregate_runs(
+            self, project='', group_by=None, bucket=None, since=None,
+            until=None, name='', labels=None, state='', iter=False,
+            percentiles=default_percentiles):
+        params = {
+            'project': project or default_project,
+            'group_by': list(group_by or []),
+            'bucket': bucket,
+            'since': _iso(since),
+            'until': _iso(until),
+            'name': name,
+            'label': labels or [],
+            'state': state,
+            'iter': bool2str(iter),
+            'percentiles': ','.join(str(p) for p in percentiles or []),
+        }
+        error = 'aggregate runs'
+        resp = self.api_call('GET', 'runs/aggregate', error, params=params)
+        return resp.json()['groups']
+
+    def query_results(
+            self, project='', where=None, order_by=None, desc=True, limit=10,
+            iter=True):
+        params = {
+            'project': project or default_project,
+            'where': where or [],
+            'order_by': order_by,
+            'desc': bool2str(desc),
+            'limit': limit,
+            'iter': bool2str(iter),
+        }
+        error = 'query results'
+        resp = self.api_call('GET', 'runs/results', error, params=params)
+        return RunList(resp.json()['runs'])
+
+    def label_stats(self, project='', kind='runs'):
+        params = {'project': project or default_project, 'kind': kind}
+        error = f'label stats {kind}'
+        resp = self.api_call('GET', 'labels', error, params=params)
+        return resp.json()['labels']
+
     def del_runs(self, name='', project='', labels=None, state='', days_ago=0):
         project = project or default_project
         params = {
@@ -220,6 +295,14 @@ class HTTPRunDB(RunDBInterface):
         error = 'del runs'
         self.api_call('DELETE', 'runs', error, params=params)
 
+    def batch(self, ops):
+        if not ops:
+            return
+        error = f'batch of {len(ops)} operations'
+        body = dict_to_json({'ops': [_op_dict(op) for op in ops]})
+        timeout = max(20, len(ops) // 10)
+        self.api_call('POST', 'batch', error, body=body, timeout=timeout)
+
     def store_artifact(self, key, artifact, uid, iter=None, tag='', project=''):
         path = self._path_of('artifact', project, uid) + '/' + key
         params = {
@@ -267,6 +350,23 @@ class HTTPRunDB(RunDBInterface):
         values.tag = tag
         return values
 
+    def list_artifacts_page(self, name='', project='', tag='', labels=None,
+                            since=None, until=None, page_size=100,
+                            cursor=None):
+        params = {
+            'name': name,
+            'project': project or default_project,
+            'tag': tag,
+            'label': labels or [],
+            'page_size': page_size,
+            'cursor': cursor,
+        }
+        error = 'list artifacts'
+        resp = self.api_call('GET', 'artifacts', error, params=params).json()
+        values = ArtifactList(resp['artifacts'])
+        values.tag = tag
+        return values, resp.get('next_cursor')
+
     def del_artifacts(
             self, name='', project='', tag='', labels=None, days_ago=0):
         project = project or default_project
@@ -308,6 +408,20 @@ class HTTPRunDB(RunDBInterface):
         resp = self.api_call('GET', 'funcs', error, params=params)
         return resp.json()['funcs']
 
+    def list_functions_page(self, name, project='', tag='', labels=None,
+                            page_size=100, cursor=None):
+        params = {
+            'project': project or default_project,
+            'name': name,
+            'tag': tag,
+            'label': labels or [],
+            'page_size': page_size,
+            'cursor': cursor,
+        }
+        error = 'list functions'
+        resp = self.api_call('GET', 'funcs', error, params=params).json()
+        return resp['funcs'], resp.get('next_cursor')
+
     def remote_builder(self, func, with_mlrun):
         try:
             req = {'function': func.to_dict(),
@@ -448,8 +562,22 @@ class HTTPRunDB(RunDBInterface):
         return resp['id']
 
 
+def _op_dict(op):
+    fn = getattr(op.get('artifact'), 'to_dict', None)
+    if fn:
+        op = dict(op, artifact=fn())
+    fn = getattr(op.get('struct'), 'to_dict', None)
+    if fn:
+        op = dict(op, struct=fn())
+    return op
+
+
 def _as_json(obj):
     fn = getattr(obj, 'to_json', None)
     if fn:
         return fn()
     return dict_to_json(obj)
+
+
+def _iso(ts):
+    return ts.isoformat() if hasattr(ts, 'isoformat') else ts
@@ -15,6 +15,7 @@
 from threading import Thread
 from time import monotonic, sleep
 
+from ..config import config
 from ..utils import logger
 
 
@@ -28,6 +29,79 @@ class Task:
         pass
 
 
+class RetentionTask(Task):
+    """Delete runs out of the retention policy (see config.httpdb)"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def run(self):
+        cfg = config.httpdb
+        policies = retention_policies(cfg.retention_projects)
+        default = (cfg.retention_days, cfg.retention_runs)
+        try:
+            for project in self.db.list_projects():
+                days, runs = policies.get(project.name, default)
+                if not (days or runs):
+                    continue
+                counts = self.db.apply_retention(
+                    project.name, days, runs,
+                    cfg.retention_batch_size, cfg.retention_batch_delay,
+                )
+                if any(counts.values()):
+                    logger.info(
+                        'retention: %s deleted %s', project.name, counts)
+            self.db.delete_orphan_labels(
+                cfg.retention_batch_size, cfg.retention_batch_delay)
+        finally:
+            self.db.close_session()
+
+
+class ArchiveTask(Task):
+    """Move runs older than archive_days to the archive"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def run(self):
+        cfg = config.httpdb
+        try:
+            counts = self.db.archive_runs(
+                cfg.archive_days, batch_size=cfg.archive_batch_size)
+            if any(counts.values()):
+                logger.info('archive: archived %s', counts)
+        finally:
+            if hasattr(self.db, 'close_session'):  # FileRunDB has no session
+                self.db.close_session()
+
+
+def retention_policies(text):
+    """Parse "project:days:runs,..." to {project: (days, runs)}"""
+    policies = {}
+    for policy in (text or '').split(','):
+        if not policy.strip():
+            continue
+        try:
+            name, days, runs = policy.strip().rsplit(':', 2)
+            policies[name] = (int(days or 0), int(runs or 0))
+        except ValueError:
+            raise ValueError(f'bad retention policy - {policy!r}')
+    return policies
+
+
+def retention_enabled():
+    cfg = config.httpdb
+    if cfg.retention_days or cfg.retention_runs:
+        return True
+    policies = retention_policies(cfg.retention_projects)
+    return any(days or runs for days, runs in policies.values())
+
+
+def archive_enabled():
+    cfg = config.httpdb
+    return bool(cfg.archive_path and cfg.archive_days)
+
+
 def _schedule(task: Task, delay_seconds):
     while True:
         start = monotonic()
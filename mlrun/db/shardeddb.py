@@ -0,0 +1,497 @@
+# Copyright 2019 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Projects in separate databases (shards) routed by a routing table
+
+    db = ShardedSQLDB(
+        'sqlite:////data/mlrun.db', {'hot': 'sqlite:////data/hot.db'})
+    db.connect()
+    db.move_project('iris', 'hot')
+
+The dsn database is the "default" shard, it holds the routing table
+(project_shards) and the schedules. Projects without a route are in
+default_shard. Each shard has its own engine, sessions and (SQLite) write
+lock so writes to projects in different shards don't wait for each other.
+"""
+
+from threading import Lock
+from time import monotonic, sleep
+
+from sqlalchemy import inspect, select
+
+from ..config import config
+from ..lists import RunList
+from .base import RunDBError, RunDBInterface
+from .sqldb import (
+    SQLDB, BodyDict, Log, LogChunk, NoLock, Project, ProjectShard, Run,
+    RunResult, User, _latest, _tagged
+)
+
+main_shard = 'default'
+# Columns set from the parent object when copying rows
+_ref_columns = ('id', 'parent', 'obj_id', 'run_id', 'log_id')
+
+
+def parse_shards(text):
+    """Parse "name=dsn,..." to {name: dsn}"""
+    shards = {}
+    for shard in (text or '').split(','):
+        if not shard.strip():
+            continue
+        name, sep, dsn = shard.strip().partition('=')
+        if not (sep and name and dsn):
+            raise ValueError(f'bad shard - {shard!r}')
+        shards[name] = dsn
+    return shards
+
+
+class ShardedSQLDB(RunDBInterface):
+    """SQLDB per shard, calls are routed by project
+
+    Cross project calls (project "*", list_projects, maintenance) fan out
+    to all shards. A batch with projects in several shards is committed
+    per shard.
+    """
+    kind = 'sql'
+
+    def __init__(self, dsn, shards=None, default_shard=None, routes_ttl=None):
+        cfg = config.httpdb
+        shards = parse_shards(cfg.shards) if shards is None else shards
+        if main_shard in shards:
+            raise ValueError(f'{main_shard!r} is the dsn shard')
+        self.dsn = dsn
+        self.shards = {main_shard: SQLDB(dsn)}
+        for name, shard_dsn in shards.items():
+            self.shards[name] = SQLDB(shard_dsn)
+        self.default_shard = default_shard or cfg.shard_default or main_shard
+        if self.default_shard not in self.shards:
+            raise ValueError(f'unknown default shard - {self.default_shard}')
+        # Other processes see route changes after routes_ttl seconds
+        self.routes_ttl = cfg.shard_routes_ttl if routes_ttl is None \
+            else routes_ttl
+        self._routes = {}  # project → (shard, target)
+        self._routes_time = None
+        self._lock = Lock()
+
+    @property
+    def main(self):
+        """Shard holding the routing table"""
+        return self.shards[main_shard]
+
+    def connect(self, secrets=None):
+        for db in self.shards.values():
+            db.connect(secrets)
+        self._load_routes()
+        return self
+
+    def close_session(self):
+        for db in self.shards.values():
+            db.close_session()
+
+    def route(self, project):
+        """Shard name of project"""
+        project = project or config.default_project
+        shard, _ = self._get_routes().get(project, (self.default_shard, None))
+        return shard
+
+    def routes(self):
+        """project → shard of projects with a route"""
+        return {
+            project: shard
+            for project, (shard, _) in self._get_routes().items()
+        }
+
+    def set_route(self, project, shard):
+        """Route project to shard, without moving it (see move_project)"""
+        if shard not in self.shards:
+            raise RunDBError(f'unknown shard - {shard}')
+        self._save_route(project, shard)
+
+    def move_project(self, project, shard, batch_size=500):
+        """Move project rows to shard and route it there
+
+        Writes to the project fail while it's copied, reads are served from
+        the old shard. Returns copied row count per table.
+        """
+        project = project or config.default_project
+        if shard not in self.shards:
+            raise RunDBError(f'unknown shard - {shard}')
+        source = self.route(project)
+        if source == shard:
+            return {}
+        self._save_route(project, source, target=shard)
+        # Let other processes see the project is moving
+        sleep(self.routes_ttl)
+        src, dst = self.shards[source], self.shards[shard]
+        try:
+            delete_project(dst, project)  # Interrupted move leftovers
+            counts = copy_project(src, dst, project, batch_size)
+        except Exception:
+            self._save_route(project, source)
+            raise
+        self._save_route(project, shard)
+        delete_project(src, project)
+        return counts
+
+    def store_log(self, uid, project='', body=b'', append=False):
+        return self._shard(project, True).store_log(uid, project, body, append)
+
+    def get_log(self, uid, project='', offset=0, size=0):
+        return self._shard(project).get_log(uid, project, offset, size)
+
+    def get_log_size(self, uid, project=''):
+        return self._shard(project).get_log_size(uid, project)
+
+    def store_run(self, struct, uid, project='', iter=0):
+        return self._shard(project, True).store_run(struct, uid, project, iter)
+
+    def update_run(self, updates: dict, uid, project='', iter=0):
+        return self._shard(project, True).update_run(
+            updates, uid, project, iter)
+
+    def patch_run(self, ops, uid, project='', iter=0, version=None):
+        return self._shard(project, True).patch_run(
+            ops, uid, project, iter, version)
+
+    def read_run(self, uid, project=None, iter=0):
+        return self._shard(project).read_run(uid, project, iter)
+
+    def list_runs(
+            self, name=None, uid=None, project=None, labels=None,
+            state=None, sort=True, last=0, iter=None, archived=False):
+        args = (name, uid, project, labels, state, sort, last, iter, archived)
+        if project != '*':
+            return self._shard(project).list_runs(*args)
+        # Base class fan out methods (e.g. aggregate_runs) pass "" filters
+        args = (name or None, uid or None, project, labels, state or None,
+                sort, last, iter, archived)
+        runs = RunList()
+        for db in self.shards.values():
+            runs.extend(db.list_runs(*args))
+        if sort or last:
+            runs.sort(
+                key=lambda run: str(run['status'].get('start_time') or ''),
+                reverse=True)
+        return RunList(runs[:last]) if last else runs
+
+    def list_runs_page(
+            self, name=None, uid=None, project=None, labels=None,
+            state=None, iter=False, page_size=100, cursor=None,
+            archived=False):
+        if project == '*':
+            return super().list_runs_page(
+                name, uid, project, labels, state, iter, page_size, cursor,
+                archived)
+        return self._shard(project).list_runs_page(
+            name, uid, project, labels, state, iter, page_size, cursor,
+            archived)
+
+    def aggregate_runs(self, project='', *args, **kw):
+        if project == '*' and len(self.shards) > 1:
+            # Percentiles don't merge, aggregate the runs of all shards
+            return super().aggregate_runs(project, *args, **kw)
+        return self._shard(project).aggregate_runs(project, *args, **kw)
+
+    def query_results(self, project='', *args, **kw):
+        if project == '*':
+            return super().query_results(project, *args, **kw)
+        return self._shard(project).query_results(project, *args, **kw)
+
+    def label_stats(self, project='', kind='runs'):
+        return self._shard(project).label_stats(project, kind)
+
+    def del_run(self, uid, project='', iter=0):
+        return self._shard(project, True).del_run(uid, project, iter)
+
+    def del_runs(
+            self, name=None, project=None, labels=None, state=None,
+            days_ago=0):
+        return self._shard(project, True).del_runs(
+            name, project, labels, state, days_ago)
+
+    def batch(self, ops):
+        groups = {}
+        for op in ops:
+            shard = self._shard(op.get('project'), True)
+            groups.setdefault(id(shard), (shard, []))[1].append(op)
+        for shard, shard_ops in groups.values():
+            shard.batch(shard_ops)
+
+    def store_artifact(
+            self, key, artifact, uid, iter=None, tag='', project=''):
+        return self._shard(project, True).store_artifact(
+            key, artifact, uid, iter, tag, project)
+
+    def read_artifact(self, key, tag='', iter=None, project=''):
+        return self._shard(project).read_artifact(key, tag, iter, project)
+
+    def list_artifacts(self, name=None, project=None, *args, **kw):
+        return self._shard(project).list_artifacts(name, project, *args, **kw)
+
+    def list_artifacts_page(self, name=None, project=None, *args, **kw):
+        return self._shard(project).list_artifacts_page(
+            name, project, *args, **kw)
+
+    def del_artifact(self, key, tag='', project=''):
+        return self._shard(project, True).del_artifact(key, tag, project)
+
+    def del_artifacts(self, name='', project='', tag='', labels=None):
+        return self._shard(project, True).del_artifacts(
+            name, project, tag, labels)
+
+    def list_artifact_tags(self, project):
+        return self._shard(project).list_artifact_tags(project)
+
+    def store_function(self, func, name, project='', tag=''):
+        return self._shard(project, True).store_function(
+            func, name, project, tag)
+
+    def get_function(self, name, project='', tag=''):
+        return self._shard(project).get_function(name, project, tag)
+
+    def list_functions(self, name, project='', *args, **kw):
+        return self._shard(project).list_functions(name, project, *args, **kw)
+
+    def list_functions_page(self, name=None, project='', *args, **kw):
+        return self._shard(project).list_functions_page(
+            name, project, *args, **kw)
+
+    def store_schedule(self, data):
+        return self.main.store_schedule(data)
+
+    def list_schedules(self):
+        return self.main.list_schedules()
+
+    def tag_objects(self, objs, project: str, name: str):
+        return self._shard(project, True).tag_objects(objs, project, name)
+
+    def tag_query(self, project: str, name: str, queries: dict):
+        return self._shard(project, True).tag_query(project, name, queries)
+
+    def del_tag(self, project: str, name: str):
+        return self._shard(project, True).del_tag(project, name)
+
+    def find_tagged(self, project: str, name: str):
+        return self._shard(project).find_tagged(project, name)
+
+    def list_tags(self, project: str):
+        return self._shard(project).list_tags(project)
+
+    def add_project(self, project: dict, exist_ok=False):
+        return self._shard(project.get('name'), True).add_project(
+            project, exist_ok)
+
+    def update_project(self, name, data: dict):
+        return self._shard(name, True).update_project(name, data)
+
+    def get_project(self, name=None, project_id=None):
+        if not name:  # ids are per shard
+            return self.main.get_project(project_id=project_id)
+        return self._shard(name).get_project(name, project_id)
+
+    def list_projects(self, owner=None):
+        projects = []
+        for shard, db in self.shards.items():
+            projects.extend(
+                project for project in db.list_projects(owner)
+                if self.route(project.name) == shard)
+        return projects
+
+    def apply_retention(self, project, *args, **kw):
+        return self._shard(project, True).apply_retention(project, *args, **kw)
+
+    def archive_runs(self, days, project=None, batch_size=500):
+        if project:
+            return self._shard(project, True).archive_runs(
+                days, project, batch_size)
+        return _sum_counts(
+            db.archive_runs(days, None, batch_size)
+            for db in self.shards.values())
+
+    def delete_orphan_labels(self, batch_size=500, delay=0.0):
+        return sum(
+            db.delete_orphan_labels(batch_size, delay)
+            for db in self.shards.values())
+
+    def pool_stats(self):
+        """Connection pool statistics per shard"""
+        return {name: db.pool_stats() for name, db in self.shards.items()}
+
+    def storage_stats(self):
+        """Storage statistics per table, summed over shards"""
+        stats = {}
+        for db in self.shards.values():
+            for table, table_stats in db.storage_stats().items():
+                total = stats.setdefault(table, {'dict_id': None})
+                for key, value in table_stats.items():
+                    if key != 'dict_id':
+                        total[key] = total.get(key, 0) + value
+        return stats
+
+    def _shard(self, project, write=False):
+        project = project or config.default_project
+        shard, target = self._get_routes().get(
+            project, (self.default_shard, None))
+        if write and target:
+            raise RunDBError(f'project {project} is moving to {target}')
+        if shard not in self.shards:
+            raise RunDBError(f'project {project} in unknown shard {shard}')
+        return self.shards[shard]
+
+    def _get_routes(self):
+        with self._lock:
+            fresh = self._routes_time is not None and \
+                monotonic() - self._routes_time < self.routes_ttl
+        if not fresh:
+            self._load_routes()
+        return self._routes
+
+    def _load_routes(self):
+        # Own connection, not the thread session the caller might be using
+        table = ProjectShard.__table__
+        with self.main.engine.connect() as conn:
+            rows = conn.execute(select([
+                table.c.project, table.c.shard, table.c.target]))
+            routes = {project: (shard, target)
+                      for project, shard, target in rows}
+        with self._lock:
+            self._routes, self._routes_time = routes, monotonic()
+
+    def _save_route(self, project, shard, target=None):
+        table = ProjectShard.__table__
+        values = {'shard': shard, 'target': target}
+        with self.main._write_lock or NoLock(), \
+                self.main.engine.begin() as conn:
+            updated = conn.execute(table.update().where(
+                table.c.project == project).values(**values))
+            if not updated.rowcount:
+                conn.execute(table.insert().values(project=project, **values))
+        self._load_routes()
+
+
+def _sum_counts(counts):
+    out = {}
+    for item in counts:
+        for key, count in item.items():
+            out[key] = out.get(key, 0) + count
+    return out
+
+
+def copy_row(obj, **kw):
+    """New object with the columns of obj (ids are not copied)"""
+    cls = type(obj)
+    values = {
+        attr.key: getattr(obj, attr.key)
+        for attr in inspect(cls).column_attrs
+        if attr.columns[0].name not in _ref_columns
+    }
+    values.update(kw)
+    return cls(**values)
+
+
+def _batches(query, cls, batch_size):
+    last_id = 0
+    while True:
+        objs = query.filter(cls.id > last_id).order_by(cls.id).limit(
+            batch_size).all()
+        if not objs:
+            return
+        yield objs
+        last_id = objs[-1].id
+
+
+def copy_project(src, dst, project, batch_size=500):
+    """Copy project rows from src to dst SQLDB, return row count per table"""
+    counts = {}
+    with dst._transaction():
+        prj = src._query(Project, name=project).one_or_none()
+        if prj:
+            new = copy_row(prj)
+            for user in prj.users:
+                dst_user = dst._query(User, name=user.name).one_or_none()
+                new.users.append(dst_user or User(name=user.name))
+            dst.session.add(new)
+        # Compressed bodies need their dictionaries
+        known = {dict_id for dict_id, in dst.session.query(BodyDict.dict_id)}
+        for bdict in src.session.query(BodyDict):
+            if bdict.dict_id not in known:
+                dst.session.add(copy_row(bdict))
+
+    ids = {}  # (class, src id) → dst id
+    for cls in _tagged + [Log]:
+        count = 0
+        for objs in _batches(src._query(cls, project=project), cls,
+                             batch_size):
+            with dst._transaction():
+                new_objs = []
+                for obj in objs:
+                    new = copy_row(obj)
+                    if hasattr(cls, 'labels'):
+                        new.labels = [copy_row(lbl) for lbl in obj.labels]
+                    if cls is Run:
+                        new.results = [copy_row(res) for res in obj.results]
+                    dst.session.add(new)
+                    new_objs.append(new)
+                dst.session.flush()
+                for obj, new in zip(objs, new_objs):
+                    ids[(cls, obj.id)] = new.id
+                    if cls is not Log:
+                        continue
+                    for chunk in src._query(LogChunk, log_id=obj.id):
+                        dst.session.add(copy_row(chunk, log_id=new.id))
+            count += len(objs)
+        counts[cls.__tablename__] = count
+
+    with dst._transaction():
+        pointers = [(cls.Tag, cls) for cls in _tagged]
+        pointers += [(latest_cls, cls) for cls, (latest_cls, _) in
+                     _latest.items()]
+        for ptr_cls, cls in pointers:
+            for ptr in src._query(ptr_cls, project=project):
+                obj_id = ids.get((cls, ptr.obj_id))
+                if obj_id:
+                    dst.session.add(copy_row(ptr, obj_id=obj_id))
+    dst._projects.add(project)
+    src.close_session()
+    dst.close_session()
+    return counts
+
+
+def delete_project(db, project):
+    """Delete all rows of project from db (SQLDB)"""
+    session = db.session
+    with db._transaction():
+        for cls in _tagged:
+            ids = session.query(cls.id).filter(cls.project == project)
+            session.query(cls.Label).filter(cls.Label.parent.in_(ids)).delete(
+                synchronize_session=False)
+            session.query(cls.Tag).filter(cls.Tag.project == project).delete(
+                synchronize_session=False)
+        for latest_cls, _ in _latest.values():
+            session.query(latest_cls).filter(
+                latest_cls.project == project).delete(
+                    synchronize_session=False)
+        session.query(RunResult).filter(RunResult.project == project).delete(
+            synchronize_session=False)
+        log_ids = session.query(Log.id).filter(Log.project == project)
+        session.query(LogChunk).filter(LogChunk.log_id.in_(log_ids)).delete(
+            synchronize_session=False)
+        for cls in _tagged + [Log]:
+            session.query(cls).filter(cls.project == project).delete(
+                synchronize_session=False)
+        prj = db._query(Project, name=project).one_or_none()
+        if prj:
+            session.delete(prj)
+    db._projects.discard(project)
+    db._tag_cache.clear()
+    db.close_session()
@@ -12,40 +12,167 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
 import pickle
+import re
 import warnings
-from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from itertools import groupby
+from threading import Lock, RLock, local
+from time import monotonic, sleep
 
 from dateutil import parser
 from sqlalchemy import (
-    BLOB, TIMESTAMP, Column, ForeignKey, Integer, String, Table,
-    UniqueConstraint, and_, create_engine, func
+    BLOB, TIMESTAMP, BigInteger, Column, Float, ForeignKey, Index, Integer,
+    String, Table, UniqueConstraint, and_, bindparam, case, create_engine,
+    event, func, inspect, or_, text
 )
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DisconnectionError, SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import (
+    aliased, relationship, scoped_session, sessionmaker
+)
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import QueuePool
 
 from ..config import config
 from ..lists import ArtifactList, FunctionList, RunList
-from ..utils import get_in, update_in, logger
-from .base import RunDBError, RunDBInterface
-
-from threading import RLock
+from ..utils import MyEncoder, get_in, update_in, logger
+from .archive import RunArchive, decode_struct, encode_struct, month
+from .cachedb import LRUCache
+from .compress import (
+    Compressor, add_dict, decompress, set_dict_loader, train_dict
+)
+from .base import (
+    RunDBConflictError, RunDBError, RunDBInterface, aggregate_group,
+    check_aggregate, check_label_kind, decode_cursor, default_percentiles,
+    duration_stats, encode_cursor, failed_states, numeric_results,
+    parse_result_filter, patch_struct, result_ops, time_buckets
+)
 
+# SQLite allows a single writer per file, other databases don't need the
+# lock. sql_lock is the lock of in memory databases.
 sql_lock = RLock()
+_sqlite_locks = {'': sql_lock, ':memory:': sql_lock}
 Base = declarative_base()
 NULL = None  # Avoid flake8 issuing warnings when comparing in filter
 run_time_fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
+body_formats = ('pickle', 'json')
+patch_retries = 5  # patch_run attempts on concurrent update (no version)
+delete_chunk_size = 500  # ids per "DELETE .. IN", SQLite allows 999 params
+_pickle_magic = b'\x80'  # pickle protocol 2+ opcode
+
+
+class BodyEncoder(MyEncoder):
+    def default(self, obj):
+        if isinstance(obj, (datetime, date)):
+            return obj.isoformat()
+        return super().default(obj)
+
+
+def encode_body(value, fmt='pickle'):
+    if fmt == 'json':
+        return json.dumps(value, cls=BodyEncoder).encode('utf-8')
+    if fmt == 'pickle':
+        return pickle.dumps(value)
+    raise ValueError(f'unsupported body format - {fmt}')
+
+
+def decode_body(data):
+    """Decode a stored body, the format is detected from the data"""
+    if data is None:
+        return None
+    if data[:1] == _pickle_magic:
+        return pickle.loads(data)
+    return json.loads(data)
+
+
+class NoLock:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class PoolStats:
+    """Connection pool usage counters"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def add_wait(self, duration, timeout=False):
+        with self._lock:
+            if timeout:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += duration
+            self.wait_max = max(self.wait_max, duration)
+
+    def to_dict(self):
+        with self._lock:
+            count = self.checkouts + self.timeouts
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_total': self.wait_total,
+                'wait_max': self.wait_max,
+                'wait_avg': self.wait_total / count if count else 0.0,
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording how long callers wait for a connection"""
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = monotonic()
+        try:
+            conn = super()._do_get()
+        except SQLAlchemyError:
+            self.stats.add_wait(monotonic() - start, timeout=True)
+            raise
+        self.stats.add_wait(monotonic() - start)
+        return conn
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
 
 
 class HasStruct:
+    codec = Column(String)  # body compression, NULL is not compressed
+    raw_size = Column(Integer)  # body size before compression
+
     @property
     def struct(self):
-        return pickle.loads(self.body)
+        return decode_body(decompress(self.body, self.codec))
 
     @struct.setter
     def struct(self, value):
-        self.body = pickle.dumps(value)
+        self.set_struct(value)
+
+    def set_struct(self, value, fmt='pickle', compressor=None):
+        body = encode_body(value, fmt)
+        self.raw_size = len(body)
+        self.body, self.codec = body, None
+        if compressor:
+            self.body, self.codec = compressor.compress(
+                body, self.__tablename__)
 
 
 def make_label(table):
@@ -53,6 +180,8 @@ def make_label(table):
         __tablename__ = f'{table}_labels'
         __table_args__ = (
             UniqueConstraint('name', 'parent', name=f'_{table}_labels_uc'),
+            Index(f'idx_{table}_labels_parent', 'parent'),
+            Index(f'idx_{table}_labels_name_value', 'name', 'value', 'parent'),
         )
 
         id = Column(Integer, primary_key=True)
@@ -69,6 +198,7 @@ def make_tag(table):
         __table_args__ = (
             UniqueConstraint(
                 'project', 'name', 'obj_id', name=f'_{table}_tags_uc'),
+            Index(f'idx_{table}_tags_obj_id', 'obj_id'),
         )
 
         id = Column(Integer, primary_key=True)
@@ -87,6 +217,10 @@ with warnings.catch_warnings():
         __tablename__ = 'artifacts'
         __table_args__ = (
             UniqueConstraint('uid', 'project', 'key', name='_artifacts_uc'),
+            # latest (max updated) per (project, key)
+            Index('idx_artifacts_project_key_updated',
+                  'project', 'key', 'updated'),
+            Index('idx_artifacts_project_updated', 'project', 'updated'),
         )
 
         Label = make_label(__tablename__)
@@ -97,13 +231,18 @@ with warnings.catch_warnings():
         project = Column(String)
         uid = Column(String)
         updated = Column(TIMESTAMP)
+        kind = Column(String, index=True)
+        iteration = Column(Integer)
         body = Column(BLOB)
-        labels = relationship(Label)
+        archive = Column(String)  # archive file key, body is NULL
+        labels = relationship(Label, cascade='all, delete-orphan')
 
     class Function(Base, HasStruct):
         __tablename__ = 'functions'
         __table_args__ = (
             UniqueConstraint('name', 'project', 'uid', name='_functions_uc'),
+            Index('idx_functions_project_name_updated',
+                  'project', 'name', 'updated'),
         )
 
         Label = make_label(__tablename__)
@@ -115,20 +254,62 @@ with warnings.catch_warnings():
         uid = Column(String)
         body = Column(BLOB)
         updated = Column(TIMESTAMP)
-        labels = relationship(Label)
+        kind = Column(String, index=True)
+        state = Column(String)
+        labels = relationship(Label, cascade='all, delete-orphan')
 
     class Log(Base):
         __tablename__ = 'logs'
+        __table_args__ = (
+            Index('idx_logs_project_uid', 'project', 'uid'),
+        )
 
         id = Column(Integer, primary_key=True)
         uid = Column(String)
         project = Column(String)
+        body = Column(BLOB)  # logs stored before chunking (size is NULL)
+        size = Column(Integer)
+        archive = Column(String)  # archive file key, no chunks
+
+    class LogChunk(Base):
+        __tablename__ = 'log_chunks'
+        __table_args__ = (
+            # range reads by (log_id, start)
+            UniqueConstraint('log_id', 'start', name='_log_chunks_uc'),
+        )
+
+        id = Column(Integer, primary_key=True)
+        log_id = Column(Integer, ForeignKey('logs.id'))
+        start = Column(Integer)  # byte offset of chunk in log
         body = Column(BLOB)
+        codec = Column(String)  # only full chunks are compressed
+        raw_size = Column(Integer)
+
+    class RunResult(Base):
+        """Numeric run result (status.results), for queries by results"""
+        __tablename__ = 'run_results'
+        __table_args__ = (
+            UniqueConstraint('run_id', 'key', name='_run_results_uc'),
+            # filter and order by value of a key
+            Index('idx_run_results_project_key_value',
+                  'project', 'key', 'value'),
+        )
+
+        id = Column(Integer, primary_key=True)
+        run_id = Column(Integer, ForeignKey('runs.id'))
+        project = Column(String)
+        key = Column(String)
+        value = Column(Float)
 
     class Run(Base, HasStruct):
         __tablename__ = 'runs'
         __table_args__ = (
             UniqueConstraint('uid', 'project', 'iteration', name='_runs_uc'),
+            # list_runs filters by project and sorts by start_time
+            Index('idx_runs_project_start_time', 'project', 'start_time'),
+            Index('idx_runs_project_name_start_time',
+                  'project', 'name', 'start_time'),
+            Index('idx_runs_project_state', 'project', 'state'),
         )
 
         Label = make_label(__tablename__)
@@ -137,11 +318,73 @@ with warnings.catch_warnings():
         id = Column(Integer, primary_key=True)
         uid = Column(String)
         project = Column(String)
+        name = Column(String)
         iteration = Column(Integer)
         state = Column(String)
         body = Column(BLOB)
         start_time = Column(TIMESTAMP)
-        labels = relationship(Label)
+        last_update = Column(TIMESTAMP, index=True)
+        kind = Column(String, index=True)
+        owner = Column(String, index=True)
+        duration = Column(Float)  # seconds, start_time to last_update
+        # compare and swap on every update (see patch_run)
+        version = Column(Integer, nullable=False, default=0)
+        archive = Column(String)  # archive file key, body is NULL
+        labels = relationship(Label, cascade='all, delete-orphan')
+        results = relationship(RunResult, cascade='all, delete-orphan')
+
+        __mapper_args__ = {'version_id_col': version}
+
+    class ArtifactLatest(Base):
+        """Pointer to latest (by updated) artifact per (project, key)"""
+        __tablename__ = 'artifacts_latest'
+        __table_args__ = (
+            UniqueConstraint('project', 'key', name='_artifacts_latest_uc'),
+        )
+
+        id = Column(Integer, primary_key=True)
+        project = Column(String)
+        key = Column(String)
+        updated = Column(TIMESTAMP)
+        obj_id = Column(Integer, ForeignKey('artifacts.id'), index=True)
+
+    class FunctionLatest(Base):
+        """Pointer to latest (by updated) function per (project, name)"""
+        __tablename__ = 'functions_latest'
+        __table_args__ = (
+            UniqueConstraint('project', 'name', name='_functions_latest_uc'),
+        )
+
+        id = Column(Integer, primary_key=True)
+        project = Column(String)
+        name = Column(String)
+        updated = Column(TIMESTAMP)
+        obj_id = Column(Integer, ForeignKey('functions.id'), index=True)
+
+    class ProjectShard(Base):
+        """Project → shard routing (see ShardedSQLDB), in default shard"""
+        __tablename__ = 'project_shards'
+        __table_args__ = (
+            UniqueConstraint('project', name='_project_shards_uc'),
+        )
+
+        id = Column(Integer, primary_key=True)
+        project = Column(String)
+        shard = Column(String)
+        target = Column(String)  # shard the project is being moved to
+
+    class BodyDict(Base):
+        """Compression dictionary trained on bodies of a table"""
+        __tablename__ = 'body_dicts'
+        __table_args__ = (
+            UniqueConstraint('dict_id', name='_body_dicts_uc'),
+        )
+
+        id = Column(Integer, primary_key=True)
+        table = Column(String)
+        dict_id = Column(BigInteger)  # zstd dictionary id (in frames)
+        created = Column(TIMESTAMP, default=datetime.utcnow)
+        data = Column(BLOB)
 
     class Schedule(Base, HasStruct):
         __tablename__ = 'schedules'
@@ -195,36 +438,107 @@ with warnings.catch_warnings():
 # Must be after all table definitions
 _tagged = [cls for cls in Base.__subclasses__() if hasattr(cls, 'Tag')]
 _table2cls = {cls.__table__.name: cls for cls in Base.__subclasses__()}
+_with_struct = [
+    cls for cls in Base.__subclasses__() if issubclass(cls, HasStruct)]
+# class → (latest pointer class, key column)
+_latest = {
+    Artifact: (ArtifactLatest, 'key'),
+    Function: (FunctionLatest, 'name'),
+}
 
 
 class SQLDB(RunDBInterface):
-    def __init__(self, dsn):
+    def __init__(self, dsn, body_format=None):
         self.dsn = dsn
+        self.body_format = body_format or config.httpdb.body_format
+        if self.body_format not in body_formats:
+            raise ValueError(f'unsupported body format - {self.body_format}')
         self.session = None
+        self.engine = None
+        self._write_lock = None
+        self._local = local()  # per thread batch state
         self._projects = set()  # project cache
+        self.native_upsert = False  # set by connect from dialect
+        self.archive = None  # RunArchive, set by connect from archive_path
+        cfg = config.httpdb
+        self.compressor = Compressor(
+            cfg.compression, int(cfg.compression_level),
+            int(cfg.compression_min_size))
+        # (table, project, tag) → uid, other processes might tag objects
+        self._tag_cache = LRUCache(
+            config.httpdb.tag_cache_size, config.httpdb.tag_cache_ttl)
 
     def connect(self, secrets=None):
-        engine = create_engine(self.dsn)
-        Base.metadata.create_all(engine)
-        cls = sessionmaker(bind=engine)
-        # TODO: One session per call?
-        self.session = cls()
+        url = make_url(self.dsn)
+        self.engine = create_engine(url, **engine_options(url))
+        if url.get_backend_name() == 'sqlite':
+            self._write_lock = sqlite_lock(url.database)
+        guard_pool_pid(self.engine)
+        self.native_upsert = bool(config.httpdb.native_upsert) and \
+            has_upsert(self.engine.dialect)
+        Base.metadata.create_all(self.engine)
+        added = upgrade_schema(self.engine)
+        if ('runs', 'version') in added:
+            with self.engine.begin() as conn:
+                conn.execute(text('UPDATE runs SET version = 0'))
+        # session per thread, see close_session
+        self.session = scoped_session(sessionmaker(bind=self.engine))
 
         for project in self.list_projects():
             self._projects.add(project.name)
+        self._load_dicts()
+        if config.httpdb.archive_path:
+            self.archive = RunArchive(config.httpdb.archive_path, secrets)
+        for cls, (latest_cls, _) in _latest.items():
+            # First run after upgrade from a version without pointers
+            has_objs = self.session.query(cls.id).first() is not None
+            if has_objs and self.session.query(latest_cls.id).first() is None:
+                self.rebuild_latest(cls)
+        self.close_session()
+        return self
+
+    def close_session(self):
+        """Release the current thread session (e.g. at end of request)"""
+        self.session.remove()
+
+    def pool_stats(self):
+        """Return connection pool statistics"""
+        pool = self.engine.pool
+        stats = {'pool': pool.__class__.__name__}
+        if isinstance(pool, QueuePool):
+            stats.update(
+                size=pool.size(),
+                checked_in=pool.checkedin(),
+                checked_out=pool.checkedout(),
+                overflow=pool.overflow(),
+            )
+        if isinstance(pool, TimedQueuePool):
+            stats.update(pool.stats.to_dict())
+        return stats
+
+    def batch(self, ops):
+        with self._transaction():
+            super().batch(ops)
 
     def store_log(self, uid, project='', body=b'', append=False):
         project = project or config.default_project
         self._create_project_if_not_exists(project)
-        log = self._query(Log, uid=uid, project=project).one_or_none()
-        if not log:
-            log = Log(uid=uid, project=project, body=body)
-        elif body:
-            if append:
-                log.body += body
-            else:
-                log.body = body
-        self._upsert(log)
+        with self._transaction():
+            log = self._query(Log, uid=uid, project=project).one_or_none()
+            if not log:
+                log = Log(uid=uid, project=project, size=0)
+                self.session.add(log)
+                self.session.flush()  # Get log.id for chunks
+            elif not append:
+                self._query(LogChunk, log_id=log.id).delete()
+                log.body, log.size, log.archive = None, 0, None
+            elif log.archive:
+                archived, log.archive, log.size = self._log_data(log), None, 0
+                self._append_log(log, archived)
+            elif log.size is None:
+                legacy, log.body, log.size = log.body, None, 0
+                self._append_log(log, legacy or b'')
+            self._append_log(log, body or b'')
 
     def get_log(self, uid, project='', offset=0, size=0):
         project = project or config.default_project
@@ -232,10 +546,41 @@ class SQLDB(RunDBInterface):
         if not log:
             return None, None
         end = None if size == 0 else offset + size
-        return '', log.body[offset:end]
+        if log.size is None or log.archive:  # Not chunked
+            return '', self._log_data(log)[offset:end]
+
+        end = log.size if end is None else min(end, log.size)
+        if offset >= end:
+            return '', b''
+        # Chunk containing offset and the ones after it up to end
+        first = self.session.query(func.max(LogChunk.start)).filter(
+            LogChunk.log_id == log.id, LogChunk.start <= offset).scalar()
+        first = first or 0
+        query = self.session.query(LogChunk.body, LogChunk.codec).filter(
+            LogChunk.log_id == log.id,
+            LogChunk.start >= first,
+            LogChunk.start < end,
+        ).order_by(LogChunk.start)
+        data = b''.join(decompress(body, codec) for body, codec in query)
+        return '', data[offset - first:end - first]
+
+    def get_log_size(self, uid, project=''):
+        """Return log size in bytes (None if log not found)"""
+        project = project or config.default_project
+        log = self._query(Log, uid=uid, project=project).one_or_none()
+        if not log:
+            return None
+        if log.size is None or log.archive:
+            return len(self._log_data(log))
+        return log.size
 
     def store_run(self, struct, uid, project='', iter=0):
         project = project or config.default_project
+        # Without start time a new run starts now and an updated one keeps
+        # its start time, the ORM path handles that
+        if self.native_upsert and run_start_time(struct):
+            return self._store_run_native(struct, uid, project, iter)
+
         self._create_project_if_not_exists(project)
         run = self._get_run(uid, project, iter)
         if not run:
@@ -243,50 +588,103 @@ class SQLDB(RunDBInterface):
                 uid=uid,
                 project=project,
                 iteration=iter,
-                state=run_state(struct),
                 start_time=run_start_time(struct) or datetime.now(),
             )
         labels = run_labels(struct)
         update_labels(run, labels)
-        run.struct = struct
+        update_run_fields(run, struct)
+        run.set_struct(struct, self.body_format, self.compressor)
+        run.archive = None
         self._upsert(run, ignore=True)
 
+    def _store_run_native(self, struct, uid, project, iter):
+        values = run_fields(struct)
+        values.update(
+            uid=uid,
+            project=project,
+            iteration=iter or 0,
+            duration=duration_seconds(
+                values['start_time'], values['last_update']),
+            version=1,
+            archive=None,
+            **self._body_values(struct, Run),
+        )
+        keys = ['uid', 'project', 'iteration']
+        update = [col for col in values if col not in keys + ['version']]
+        if values['state'] is None:
+            update.remove('state')  # keep current state
+        results = [
+            {'run_id': None, 'key': key, 'project': project, 'value': value}
+            for key, value in numeric_results(struct).items()
+        ]
+        with self._transaction():
+            self._create_project_if_not_exists(project)
+            run_id = self._upsert_obj(
+                Run, keys, values, run_labels(struct), update, ['version'])
+            for row in results:
+                row['run_id'] = run_id
+            self._sync_children(RunResult, 'run_id', run_id, 'key', results)
+
     def update_run(self, updates: dict, uid, project='', iter=0):
+        self.patch_run(updates, uid, project, iter)
+
+    def patch_run(self, ops, uid, project='', iter=0, version=None):
         project = project or config.default_project
-        run = self._get_run(uid, project, iter)
-        if not run:
-            raise RunDBError(f'run {uid}:{project} not found')
-        struct = run.struct
-        for key, val in updates.items():
-            update_in(struct, key, val)
-        run.struct = struct
-        new_state = run_state(struct)
-        if new_state:
-            run.state = new_state
-        start_time = run_start_time(struct)
-        if start_time:
-            run.start_time = start_time
-        run.labels.clear()
-        for name, value in run_labels(struct).items():
-            lbl = Run.Label(name=name, value=value, parent=run.id)
-            run.labels.append(lbl)
-        self.session.merge(run)
-        self.session.commit()
-        self._delete_empty_labels(Run.Label)
+        # Without version we retry on concurrent updates, since the patch
+        # is re-applied on the new run there's no lost update. Can't retry
+        # inside a batch, the batch is rolled back.
+        attempts = patch_retries
+        if version is not None or getattr(self._local, 'in_batch', False):
+            attempts = 1
+        for attempt in range(attempts):
+            try:
+                return self._patch_run(ops, uid, project, iter, version)
+            except RunDBConflictError:
+                if attempt == attempts - 1:
+                    raise
+                self.session.expire_all()
+
+    def _patch_run(self, ops, uid, project, iter, version):
+        with self._transaction():
+            run = self._get_run(uid, project, iter)
+            if not run:
+                raise RunDBError(f'run {uid}:{project} not found')
+            if version is not None and run.version != version:
+                raise RunDBConflictError(
+                    f'run {uid}:{project} version is {run.version} '
+                    f'(expected {version})')
+            if not ops:
+                return run.version
+
+            # Patching an archived run brings it back
+            struct = patch_struct(self._struct(run), ops)
+            run.set_struct(struct, self.body_format, self.compressor)
+            run.archive = None
+            update_run_fields(run, struct)
+            labels = run_labels(struct) or {}
+            if labels != {lbl.name: lbl.value for lbl in run.labels}:
+                update_labels(run, labels)
+            try:
+                self._commit()
+            except StaleDataError as err:
+                raise RunDBConflictError(
+                    f'run {uid}:{project} changed concurrently') from err
+        return run.version
 
     def read_run(self, uid, project=None, iter=None):
         project = project or config.default_project
         run = self._get_run(uid, project, iter)
         if not run:
             raise RunDBError(f'Run {uid}:{project} not found')
-        return run.struct
+        return self._struct(run)
 
     def list_runs(
             self, name=None, uid=None, project=None, labels=None,
-            state=None, sort=True, last=0, iter=None):
-        # FIXME: Run has no "name"
+            state=None, sort=True, last=0, iter=None, archived=False):
         project = project or config.default_project
-        query = self._find_runs(uid, project, labels, state)
+        if project == '*':
+            project = None
+        query = self._find_runs(uid, project, labels, state, name, archived)
         if sort:
             query = query.order_by(Run.start_time.desc())
         if last:
@@ -296,10 +694,132 @@ class SQLDB(RunDBInterface):
 
         runs = RunList()
         for run in query:
-            runs.append(run.struct)
+            runs.append(self._struct(run))
 
         return runs
 
+    def list_runs_page(
+            self, name=None, uid=None, project=None, labels=None,
+            state=None, iter=False, page_size=100, cursor=None,
+            archived=False):
+        project = project or config.default_project
+        query = self._find_runs(uid, project, labels, state, name, archived)
+        if not iter:
+            query = query.filter(Run.iteration == 0)
+        objs, cursor = self._keyset_page(
+            query, Run.start_time, Run.id, page_size, cursor)
+        return RunList(self._struct(obj) for obj in objs), cursor
+
+    def aggregate_runs(
+            self, project='', group_by=None, bucket=None, since=None,
+            until=None, name=None, labels=None, state=None, iter=False,
+            percentiles=default_percentiles):
+        group_by = list(group_by or [])
+        check_aggregate(group_by, bucket)
+        project = project or config.default_project
+        if project == '*':
+            project = None
+        query = self._find_runs(
+            None, project, labels, state or None, name, archived=True)
+        if not iter:
+            query = query.filter(Run.iteration == 0)
+        if since:
+            query = query.filter(Run.start_time >= parse_time(since))
+        if until:
+            query = query.filter(Run.start_time <= parse_time(until))
+
+        cols = []
+        for key in group_by:
+            if key.startswith('label.'):
+                label = aliased(Run.Label)
+                query = query.outerjoin(label, and_(
+                    label.parent == Run.id,
+                    label.name == key[len('label.'):],
+                ))
+                cols.append(label.value)
+            else:
+                cols.append(getattr(Run, key))
+        if bucket:
+            cols.append(self._time_bucket(Run.start_time, bucket))
+
+        failed = func.sum(case([(Run.state.in_(failed_states), 1)], else_=0))
+        stats = query.with_entities(
+            *cols,
+            func.count(Run.id),
+            failed,
+            func.avg(Run.duration),
+            func.min(Run.duration),
+            func.max(Run.duration),
+        ).group_by(*cols).order_by(*cols)
+
+        durations = {}
+        if percentiles:
+            # Only the duration column of the runs, sorted per group
+            rows = query.with_entities(*cols, Run.duration).filter(
+                Run.duration.isnot(None)).order_by(*cols, Run.duration)
+            for *key, duration in rows:
+                durations.setdefault(tuple(key), []).append(duration)
+
+        out = []
+        ncols = len(cols)
+        for row in stats:
+            key = tuple(row[:ncols])
+            count, failed, avg, min_, max_ = row[ncols:]
+            duration = {}
+            if avg is not None:
+                duration = duration_stats(durations.get(key, []), percentiles)
+                duration.update(avg=float(avg), min=min_, max=max_)
+            if bucket:
+                key = key[:-1] + (bucket_str(key[-1]),)
+            out.append(aggregate_group(
+                group_by, bucket, key, count, int(failed or 0), duration))
+        return out
+
+    def query_results(
+            self, project='', where=None, order_by=None, desc=True, limit=10,
+            iter=True):
+        project = project or config.default_project
+        # Archived runs have no results rows (and no body)
+        query = self._query(Run, project=project).filter(
+            Run.archive.is_(None))
+        if not iter:
+            query = query.filter(Run.iteration == 0)
+        for expr in where or []:
+            key, op, value = parse_result_filter(expr)
+            res = aliased(RunResult)
+            query = query.join(res, and_(
+                res.run_id == Run.id, res.project == project, res.key == key))
+            query = query.filter(result_ops[op](res.value, value))
+        if order_by:
+            res = aliased(RunResult)
+            query = query.join(res, and_(
+                res.run_id == Run.id, res.project == project,
+                res.key == order_by))
+            value = res.value.desc() if desc else res.value.asc()
+            query = query.order_by(value, Run.id)
+        if limit:
+            query = query.limit(limit)
+        return RunList(self._struct(run) for run in query)
+
+    def label_stats(self, project='', kind='runs'):
+        check_label_kind(kind)
+        project = project or config.default_project
+        cls = {'runs': Run, 'artifacts': Artifact, 'functions': Function}[kind]
+        label_cls = cls.Label
+        query = self.session.query(
+            label_cls.name, label_cls.value, func.count(label_cls.parent),
+        ).join(cls, cls.id == label_cls.parent).filter(cls.project == project)
+        if cls is Run:
+            query = query.filter(Run.iteration == 0)
+        else:
+            latest_cls, _ = _latest[cls]
+            query = query.join(latest_cls, latest_cls.obj_id == cls.id)
+        query = query.group_by(label_cls.name, label_cls.value)
+        stats = {}
+        for name, value, count in query:
+            stats.setdefault(name, {})[str(value)] = count
+        return stats
+
     def del_run(self, uid, project=None, iter=None):
         project = project or config.default_project
         # We currently delete *all* iterations
@@ -308,15 +828,13 @@ class SQLDB(RunDBInterface):
     def del_runs(
         self, name=None, project=None, labels=None,
             state=None, days_ago=0):
-        # FIXME: Run has no `name`
         project = project or config.default_project
-        query = self._find_runs(None, project, labels, state)
+        query = self._find_runs(
+            None, project, labels, state, name, archived=True)
         if days_ago:
             since = datetime.now() - timedelta(days=days_ago)
             query = query.filter(Run.start_time >= since)
-        for run in query:  # Can't use query.delete with join
-            self.session.delete(run)
-        self.session.commit()
+        self._delete_query(Run, query)
 
     def store_artifact(
             self, key, artifact, uid, iter=None, tag='', project=''):
@@ -328,41 +846,60 @@ class SQLDB(RunDBInterface):
             updated = artifact['updated'] = datetime.now(timezone.utc)
         if iter:
             key = '{}-{}'.format(iter, key)
-        art = self._get_artifact(uid, project, key)
         labels = artifact.get('labels', {})
-        if not art:
-            art = Artifact(
-                key=key,
-                uid=uid,
-                updated=updated,
-                project=project)
-        update_labels(art, labels)
-        art.struct = artifact
-        self._upsert(art)
-        if tag:
-            self.tag_objects([art], project, tag)
+        with self._transaction():
+            if self.native_upsert:
+                values = {
+                    'key': key,
+                    'uid': uid,
+                    'project': project,
+                    'updated': parse_time(updated),
+                    'kind': artifact.get('kind'),
+                    'iteration': iter or 0,
+                    'archive': None,
+                    **self._body_values(artifact, Artifact),
+                }
+                art_id = self._upsert_obj(
+                    Artifact, ['uid', 'project', 'key'], values, labels)
+                art = self.session.query(Artifact).get(art_id)
+            else:
+                art = self._get_artifact(uid, project, key)
+                if not art:
+                    art = Artifact(key=key, uid=uid, project=project)
+                art.updated = parse_time(updated)
+                update_artifact_fields(art, artifact)
+                art.iteration = iter or 0
+                update_labels(art, labels)
+                art.set_struct(artifact, self.body_format, self.compressor)
+                art.archive = None
+                self._upsert(art)
+            self._set_latest(art)
+            if tag:
+                self.tag_objects([art], project, tag)
 
     def read_artifact(self, key, tag='', iter=None, project=''):
         project = project or config.default_project
-        uid = self._resolve_tag(Artifact, project, tag)
         if iter:
             key = '{}-{}'.format(iter, key)
 
         query = self._query(
             Artifact, key=key, project=project)
-        if uid:
-            query = query.filter(Artifact.uid == uid)
+        if tag:
+            # tag name or uid, in one query
+            query = query.outerjoin(Artifact.Tag, and_(
+                Artifact.Tag.obj_id == Artifact.id,
+                Artifact.Tag.project == project,
+                Artifact.Tag.name == tag,
+            )).filter(or_(
+                Artifact.Tag.id.isnot(None), Artifact.uid == tag,
+            )).order_by(Artifact.Tag.id.desc())
         else:
-            # Select by last updated
-            max_updated = self.session.query(
-                func.max(Artifact.updated)).filter(
-                    Artifact.project == project, Artifact.key == key)
-            query = query.filter(Artifact.updated.in_(max_updated))
+            query = self._latest_filter(query)
 
-        art = query.one_or_none()
+        art = query.first()
         if not art:
             raise RunDBError(f'Artifact {key}:{tag}:{project} not found')
-        return art.struct
+        return self._struct(art)
 
     def list_artifacts(
         self, name=None, project=None, tag=None, labels=None,
@@ -378,6 +915,21 @@ class SQLDB(RunDBInterface):
         )
         return arts
 
+    def list_artifacts_page(
+            self, name=None, project=None, tag=None, labels=None,
+            since=None, until=None, page_size=100, cursor=None):
+        project = project or config.default_project
+        uid = 'latest'
+        if tag:
+            uid = self._resolve_tag(Artifact, project, tag)
+
+        query = self._find_artifacts(project, uid, labels, since, until)
+        objs, cursor = self._keyset_page(
+            query, Artifact.updated, Artifact.id, page_size, cursor)
+        arts = ArtifactList(obj.struct for obj in objs)
+        arts.tag = tag
+        return arts, cursor
+
     def del_artifact(self, key, tag='', project=''):
         project = project or config.default_project
         kw = {
@@ -385,16 +937,16 @@ class SQLDB(RunDBInterface):
             'project': project,
         }
         if tag:
-            kw['tag'] = tag
+            kw['uid'] = self._resolve_tag(Artifact, project, tag)
 
         self._delete(Artifact, **kw)
 
     def del_artifacts(
             self, name='', project='', tag='', labels=None):
         project = project or config.default_project
-        for obj in self._find_artifacts(project, tag, labels, None, None):
-            self.session.delete(obj)
-        self.session.commit()
+        query = self._find_artifacts(
+            project, tag, labels, None, None, archived=True)
+        self._delete_query(Artifact, query)
 
     def store_function(self, func, name, project='', tag=''):
         project = project or config.default_project
@@ -404,6 +956,23 @@ class SQLDB(RunDBInterface):
         #uid = self._resolve_tag(Function, project, tag)
         updated = datetime.now(timezone.utc)
         update_in(func, 'metadata.updated', updated)
+        labels = get_in(func, 'metadata.labels', {})
+        if self.native_upsert:
+            values = {
+                'name': name,
+                'project': project,
+                'uid': tag,
+                'updated': updated,
+                'kind': func.get('kind'),
+                'state': get_in(func, 'status.state'),
+                **self._body_values(func, Function),
+            }
+            with self._transaction():
+                fn_id = self._upsert_obj(
+                    Function, ['name', 'project', 'uid'], values, labels)
+                self._set_latest(self.session.query(Function).get(fn_id))
+            return
+
 #        fn = self._get_function(name, project, uid)
         fn = self._get_function(name, project, tag)
         if not fn:
@@ -413,25 +982,23 @@ class SQLDB(RunDBInterface):
                 uid=tag,
             )
         fn.updated = updated
-        labels = get_in(func, 'metadata.labels', {})
+        update_function_fields(fn, func)
         update_labels(fn, labels)
-        fn.struct = func
-        self._upsert(fn)
+        fn.set_struct(func, self.body_format, self.compressor)
+        with self._transaction():
+            self._upsert(fn)
+            self._set_latest(fn)
 
     def get_function(self, name, project='', tag=''):
         project = project or config.default_project
         query = self._query(Function, name=name, project=project)
         tag = tag or 'latest'
-        # if tag:
-        #     if tag == 'latest':
-        #         uid = self._function_latest_uid(project, name)
-        #         if not uid:
-        #             raise RunDBError(
-        #                 f'no latest version for function {project}:{name}')
-        #     else:
-        #         uid = self._resolve_tag(Function, project, tag)
-        query = query.filter(Function.uid == tag)
-        obj = query.one_or_none()
+        obj = query.filter(Function.uid == tag).one_or_none()
+        if not obj and tag == 'latest':
+            # Not stored with "latest" tag, use last stored version
+            obj = query.join(
+                FunctionLatest, FunctionLatest.obj_id == Function.id,
+            ).one_or_none()
         if obj:
             return obj.struct
 
@@ -449,6 +1016,15 @@ class SQLDB(RunDBInterface):
         )
         return funcs
 
+    def list_functions_page(
+            self, name, project=None, tag=None, labels=None, page_size=100,
+            cursor=None):
+        project = project or config.default_project
+        query = self._find_functions(name, project, tag, labels)
+        objs, cursor = self._keyset_page(
+            query, Function.updated, Function.id, page_size, cursor)
+        return FunctionList(obj.struct for obj in objs), cursor
+
     def list_artifact_tags(self, project):
         query = self.session.query(Artifact.Tag.name).filter(
             Artifact.Tag.project == project).distinct()
@@ -456,7 +1032,7 @@ class SQLDB(RunDBInterface):
 
     def store_schedule(self, data):
         sched = Schedule()
-        sched.struct = data
+        sched.set_struct(data, self.body_format, self.compressor)
         self._upsert(sched)
 
     def list_schedules(self):
@@ -470,14 +1046,35 @@ class SQLDB(RunDBInterface):
         for obj in objs:
             tag = obj.Tag(project=project, name=name, obj_id=obj.id)
             self.session.add(tag)
+            self._tag_cache.delete((obj.__tablename__, project, name))
+        self._commit()
+
+    def tag_query(self, project: str, name: str, queries: dict):
+        """Tag the project objects matching queries with (project, name)
+
+        queries is table → {column: value}, e.g. {'functions': {'name':
+        'bugs'}}. Returns the number of tagged objects.
+        """
+        objs = []
+        for table, query in queries.items():
+            cls = table2cls(table)
+            if cls is None:
+                raise ValueError(f'unknown type - {table}')
+            for key in query:
+                if key not in cls.__table__.columns:
+                    raise ValueError(f'unknown {table} field - {key}')
+            objs.extend(self._query(cls, **dict(query, project=project)))
+        self.tag_objects(objs, project, name)
+        return len(objs)
 
     def del_tag(self, project: str, name: str):
         """Remove tag (project, name) from all objects"""
         count = 0
         for cls in _tagged:
-            for obj in self._query(cls.Tag, project=project, name=name):
-                self.session.delete(obj)
-                count += 1
+            query = self._query(cls.Tag, project=project, name=name)
+            count += query.delete(synchronize_session=False)
+        self._commit()
+        self._tag_cache.discard_group((project, name))
         return count
 
     def find_tagged(self, project: str, name: str):
@@ -487,19 +1084,23 @@ class SQLDB(RunDBInterface):
         """
         objs = []
         for cls in _tagged:
-            for tag in self._query(cls.Tag, project=project, name=name):
-                objs.append(self._query(cls).get(tag.obj_id))
+            query = self._query(cls).join(
+                cls.Tag, cls.Tag.obj_id == cls.id).filter(
+                    cls.Tag.project == project, cls.Tag.name == name)
+            objs.extend(query)
         return objs
 
     def list_tags(self, project: str):
         """Return all tags for a project"""
-        tags = set()
-        for cls in _tagged:
-            for tag in self._query(cls.Tag, project=project):
-                tags.add(tag.name)
-        return tags
-
-    def add_project(self, project: dict):
+        first, *rest = [
+            self.session.query(cls.Tag.name).filter(
+                cls.Tag.project == project)
+            for cls in _tagged
+        ]
+        return {name for name, in first.union(*rest)}
+
+    def add_project(self, project: dict, exist_ok=False):
+        """Add a project, with exist_ok an existing one is left as is"""
         project = project.copy()
         name = project.get('name')
         if not name:
@@ -507,6 +1108,19 @@ class SQLDB(RunDBInterface):
 
         user_names = project.pop('users', [])
         prj = Project(**project)
+        if exist_ok and self.native_upsert:
+            # Another process might add it at the same time
+            prj.created = prj.created or datetime.utcnow()
+            values = {
+                attr.columns[0].name: getattr(prj, attr.key)
+                for attr in inspect(Project).column_attrs
+                if attr.key != 'id'
+            }
+            with self._transaction():
+                prj_id = self._upsert_row(Project, ['name'], values)
+            self._projects.add(name)
+            return prj_id
+
         users = [] #self._find_or_create_users(user_names)
         prj.users.extend(users)
         self._upsert(prj)
@@ -542,29 +1156,311 @@ class SQLDB(RunDBInterface):
     def list_projects(self, owner=None):
         return self._query(Project, owner=owner)
 
+    def migrate_bodies(self, body_format=None, batch_size=1000):
+        """Re-encode stored bodies and refresh the projected columns
+
+        Used as a one-shot migration of databases written in the pickle
+        format, returns the number of converted rows per table.
+        """
+        body_format = body_format or self.body_format
+        if body_format not in body_formats:
+            raise ValueError(f'unsupported body format - {body_format}')
+
+        counts = {}
+        for cls in _with_struct:
+            count, last_id = 0, 0
+            while True:
+                query = self.session.query(cls).filter(cls.id > last_id)
+                if hasattr(cls, 'archive'):  # No body to convert
+                    query = query.filter(cls.archive.is_(None))
+                objs = query.order_by(cls.id).limit(batch_size).all()
+                if not objs:
+                    break
+                for obj in objs:
+                    struct = obj.struct
+                    update_fields = _fields_updaters.get(cls)
+                    if update_fields:
+                        update_fields(obj, struct)
+                    obj.set_struct(struct, body_format, self.compressor)
+                self._commit()
+                count += len(objs)
+                last_id = objs[-1].id
+            counts[cls.__tablename__] = count
+        return counts
+
+    def train_compression(self, tables=None, samples=1000, dict_size=None):
+        """Train a compression dictionary per table on its last bodies
+
+        New bodies of the table are compressed with the dictionary, use
+        migrate_bodies to recompress existing ones. Tables without enough
+        bodies are skipped. Returns table → dictionary id.
+        """
+        dict_size = dict_size or int(config.httpdb.compression_dict_size)
+        classes = {cls.__tablename__: cls for cls in _with_struct}
+        classes[LogChunk.__tablename__] = LogChunk
+        out = {}
+        for table in tables or classes:
+            cls = classes[table]
+            rows = self.session.query(cls.body, cls.codec).order_by(
+                cls.id.desc()).limit(samples)
+            data = train_dict(
+                [decompress(body, codec) for body, codec in rows], dict_size)
+            if not data:
+                continue
+            dict_id = add_dict(data)
+            self._query(BodyDict, dict_id=dict_id).delete()
+            self.session.add(BodyDict(table=table, dict_id=dict_id, data=data))
+            self._commit()
+            self.compressor.set_dict(table, dict_id)
+            out[table] = dict_id
+        return out
+
+    def storage_stats(self):
+        """Stored and raw (before compression) body bytes per table"""
+        stats = {}
+        for cls in _with_struct + [LogChunk]:
+            rows, compressed, stored, raw = self.session.query(
+                func.count(cls.id),
+                func.count(cls.codec),
+                func.sum(func.length(cls.body)),
+                func.sum(func.coalesce(cls.raw_size, func.length(cls.body))),
+            ).one()
+            stats[cls.__tablename__] = {
+                'rows': rows,
+                'compressed_rows': compressed,
+                'stored_bytes': int(stored or 0),
+                'raw_bytes': int(raw or 0),
+                'dict_id': self.compressor.dict_ids().get(cls.__tablename__),
+            }
+        return stats
+
+    def _load_dicts(self):
+        """Use the last trained dictionary of each table"""
+        query = self.session.query(BodyDict).order_by(BodyDict.id)
+        for bdict in query:
+            add_dict(bdict.data)
+            self.compressor.set_dict(bdict.table, bdict.dict_id)
+        set_dict_loader(self.dsn, self._load_dict)
+
+    def _load_dict(self, dict_id):
+        query = self.session.query(BodyDict.data).filter(
+            BodyDict.dict_id == dict_id)
+        return query.scalar()
+
+    def apply_retention(
+            self, project, days=0, runs=0, batch_size=500, delay=0.0):
+        """Delete runs and artifacts out of the project retention policy
+
+        days - delete runs started (and untagged artifacts updated) more than
+        days ago, runs - keep only the last runs (with their iterations) per
+        run name. Rows are deleted with their labels, tags and logs in
+        batches of batch_size, sleeping delay seconds between batches so
+        writers are not blocked. Returns deleted count per table.
+        """
+        queries = []
+        if days:
+            since = datetime.now() - timedelta(days=days)
+            queries.append((Run, self._query(Run, project=project).filter(
+                Run.start_time < since)))
+            tagged = self.session.query(Artifact.Tag.obj_id)
+            queries.append((Artifact, self._query(
+                Artifact, project=project).filter(
+                    Artifact.updated < since, ~Artifact.id.in_(tagged))))
+        if runs:
+            rank = func.row_number().over(
+                partition_by=Run.name,
+                order_by=(Run.start_time.desc(), Run.id.desc()),
+            )
+            ranked = self.session.query(
+                Run.uid.label('uid'), rank.label('rank')
+            ).filter(
+                Run.project == project, Run.iteration == 0,
+            ).subquery('ranked')
+            old = self.session.query(ranked.c.uid).filter(
+                ranked.c.rank > runs)
+            queries.append((Run, self._query(Run, project=project).filter(
+                Run.uid.in_(old))))
+
+        counts = {}
+        for cls, query in queries:
+            name = cls.__tablename__
+            counts[name] = counts.get(name, 0) + self._delete_batches(
+                cls, query, batch_size, delay)
+        return counts
+
+    def archive_runs(self, days, project=None, batch_size=500):
+        """Move runs, logs and artifacts older than days to the archive
+
+        Runs started more than days ago are written (with their logs) to
+        Parquet files of the archive, their rows stay as stubs without body
+        so runs can still be found by uid, name, state and labels. Untagged,
+        not latest, artifacts updated more than days ago are archived the
+        same way. Reading a stub fetches the object from the archive,
+        updating it stores it back. Returns archived count per kind.
+        """
+        if not self.archive:
+            raise RunDBError('archive is not configured (archive_path)')
+        cutoff = datetime.now() - timedelta(days=days)
+        counts = {'runs': 0, 'logs': 0, 'artifacts': 0}
+        queries = [
+            (Run, Run.start_time, self.session.query(Run).filter(
+                Run.start_time < cutoff)),
+            (Artifact, Artifact.updated, self.session.query(Artifact).filter(
+                Artifact.updated < cutoff,
+                ~Artifact.id.in_(self.session.query(ArtifactLatest.obj_id)),
+                ~Artifact.id.in_(self.session.query(Artifact.Tag.obj_id)),
+            )),
+        ]
+        for cls, time_col, query in queries:
+            query = query.filter(cls.archive.is_(None))
+            if project:
+                query = query.filter(cls.project == project)
+            while True:
+                objs = query.order_by(cls.id).limit(batch_size).all()
+                if not objs:
+                    break
+
+                def partition(obj):
+                    return obj.project, month(getattr(obj, time_col.key))
+
+                with self._transaction():
+                    for (prj, part), group in groupby(
+                            sorted(objs, key=partition), partition):
+                        self._archive_objs(cls, prj, part, list(group), counts)
+        return counts
+
+    def _archive_objs(self, cls, project, partition, objs, counts):
+        """Write objs to one archive file and make their rows stubs"""
+        rows = []
+        for obj in objs:
+            row = {
+                'project': obj.project,
+                'uid': obj.uid,
+                'labels': json.dumps(
+                    {lbl.name: lbl.value for lbl in obj.labels}),
+                'body': encode_struct(obj.struct),
+            }
+            if cls is Run:
+                row.update(
+                    iteration=obj.iteration, name=obj.name, state=obj.state,
+                    start_time=naive_utc(obj.start_time))
+            else:
+                row.update(key=obj.key, updated=naive_utc(obj.updated))
+            rows.append(row)
+        kind = cls.__tablename__
+        # File first, a failed write leaves the rows as they were
+        key = self.archive.write(kind, project, partition, rows)
+        for obj in objs:
+            obj.body, obj.codec, obj.raw_size, obj.archive = \
+                None, None, None, key
+        counts[kind] += len(objs)
+        if cls is not Run:
+            self._commit()
+            return
+
+        self.session.query(RunResult).filter(
+            RunResult.run_id.in_([run.id for run in objs])).delete(
+                synchronize_session=False)
+        logs = self.session.query(Log).filter(
+            Log.project == project,
+            Log.uid.in_({run.uid for run in objs}),
+            Log.archive.is_(None),
+        ).all()
+        if logs:
+            rows = [{
+                'project': project,
+                'uid': log.uid,
+                'body': self._log_data(log),
+            } for log in logs]
+            key = self.archive.write('logs', project, partition, rows)
+            for log, row in zip(logs, rows):
+                self._query(LogChunk, log_id=log.id).delete()
+                log.body, log.size, log.archive = None, len(row['body']), key
+            counts['logs'] += len(logs)
+        self._commit()
+
+    def delete_orphan_labels(self, batch_size=500, delay=0.0):
+        """Delete labels without an object, return count"""
+        count = 0
+        for cls in _tagged:
+            parents = self.session.query(cls.id)
+            query = self.session.query(cls.Label).filter(or_(
+                cls.Label.parent == NULL, ~cls.Label.parent.in_(parents)))
+            count += self._delete_batches(cls.Label, query, batch_size, delay)
+        return count
+
+    def hot_queries(self, project=None):
+        """Representative queries of the read paths, by name
+
+        Used to check which indexes the database picks for them.
+        """
+        project = project or config.default_project
+        runs = self._find_runs(None, project, None, None)
+        by_name = self._find_runs(None, project, None, None, name='x')
+        labeled = self._find_runs(None, project, ['kind=job'], None)
+        return {
+            'list_runs': runs.order_by(Run.start_time.desc()).limit(10),
+            'list_runs(name)':
+                by_name.order_by(Run.start_time.desc()).limit(10),
+            'list_runs(state)': runs.filter(Run.state == 'running'),
+            'list_runs(label)': labeled,
+            'list_artifacts(latest)':
+                self._find_artifacts(project, 'latest', None, None, None),
+            'resolve_tag': self._query(
+                Artifact.Tag, project=project, name='latest'),
+            'list_functions': self._find_functions('x', project, None, None),
+            'get_log': self._query(Log, project=project, uid='x'),
+            'query_results': self.session.query(RunResult).filter(
+                RunResult.project == project, RunResult.key == 'x',
+            ).order_by(RunResult.value.desc()).limit(10),
+        }
+
+    def explain_queries(self, project=None):
+        """Return the query plan and used indexes of the hot queries"""
+        names = {idx.name for table in Base.metadata.sorted_tables
+                 for idx in table.indexes}
+        out = {}
+        for key, query in self.hot_queries(project).items():
+            plan = explain(self.engine, query)
+            words = {
+                word for line in plan
+                for word in re.findall(r'\w+', line)}
+            # SQLite names unique constraint indexes sqlite_autoindex_*
+            used = {word for word in words
+                    if word in names or word.startswith('sqlite_autoindex_')}
+            out[key] = {'plan': plan, 'indexes': sorted(used)}
+        return out
+
     def _resolve_tag(self, cls, project, name):
-        for tag in self._query(cls.Tag, project=project, name=name):
-            return self._query(cls).get(tag.obj_id).uid
-        return name  # Not found, return original uid
+        table = cls.__tablename__
+        uid = self._tag_cache.get((table, project, name))
+        if uid is not None:
+            return uid
+        query = self.session.query(cls.uid).join(
+            cls.Tag, cls.Tag.obj_id == cls.id).filter(
+                cls.Tag.project == project, cls.Tag.name == name)
+        row = query.order_by(cls.Tag.id.desc()).first()  # last tagged
+        uid = row[0] if row else name  # Not found, return original uid
+        self._tag_cache.set(
+            (table, project, name), uid, groups=((project, name),))
+        return uid
 
     def _query(self, cls, **kw):
         kw = {k: v for k, v in kw.items() if v is not None}
         return self.session.query(cls).filter_by(**kw)
 
     def _function_latest_uid(self, project, name):
-        # FIXME
-        query = (
-            self._query(Function.uid)
-            .filter(Function.project == project, Function.name == name)
-            .order_by(Function.updated.desc())
-        ).limit(1)
+        query = self.session.query(Function.uid).join(
+            FunctionLatest, FunctionLatest.obj_id == Function.id).filter(
+                FunctionLatest.project == project,
+                FunctionLatest.name == name)
         out = query.one_or_none()
         if out:
             return out[0]
 
     def _create_project_if_not_exists(self, name):
         if name not in self._projects:
-            self.add_project({'name': name})
+            self.add_project({'name': name}, exist_ok=True)
 
     def _find_or_create_users(self, user_names):
         users = list(self._query(User).filter(User.name.in_(user_names)))
@@ -575,7 +1471,7 @@ class SQLDB(RunDBInterface):
                 self.session.add(user)
                 users.append(user)
             try:
-                self.session.commit()
+                self._commit()
             except SQLAlchemyError as err:
                 self.session.rollback()
                 raise RunDBError(f'add user: {err}') from err
@@ -587,76 +1483,271 @@ class SQLDB(RunDBInterface):
         return query.one_or_none()
 
     def _get_artifact(self, uid, project, key):
-        try:
-            sql_lock.acquire()
-            resp = self._query(
-                Artifact, uid=uid, project=project, key=key).one_or_none()
-            return resp
-        finally:
-            sql_lock.release()
-            pass
+        return self._query(
+            Artifact, uid=uid, project=project, key=key).one_or_none()
 
     def _get_run(self, uid, project, iteration):
-        try:
-            sql_lock.acquire()
-            resp = self._query(
-                Run, uid=uid, project=project, iteration=iteration).one_or_none()
-            return resp
-        finally:
-            sql_lock.release()
-            pass
-
-    def _delete_empty_labels(self, cls):
-        self.session.query(cls).filter(cls.parent == NULL).delete()
-        self.session.commit()
+        return self._query(
+            Run, uid=uid, project=project, iteration=iteration).one_or_none()
+
+    def _struct(self, obj):
+        """obj struct, fetched from the archive if obj is a stub"""
+        if not obj.archive:
+            return obj.struct
+        if not self.archive:
+            raise RunDBError(
+                f'{obj.archive} is archived, archive_path is not set')
+        match = {'project': obj.project, 'uid': obj.uid}
+        if isinstance(obj, Run):
+            match['iteration'] = obj.iteration
+        else:
+            match['key'] = obj.key
+        return decode_struct(self.archive.find(obj.archive, **match)['body'])
+
+    def _log_data(self, log):
+        """Log contents, for logs not stored in chunks"""
+        if log.archive:
+            if not self.archive:
+                raise RunDBError(
+                    f'{log.archive} is archived, archive_path is not set')
+            row = self.archive.find(
+                log.archive, project=log.project, uid=log.uid)
+            return row['body']
+        if log.size is None:
+            return log.body or b''
+        query = self.session.query(LogChunk.body, LogChunk.codec).filter(
+            LogChunk.log_id == log.id).order_by(LogChunk.start)
+        return b''.join(decompress(body, codec) for body, codec in query)
+
+    def _append_log(self, log, body):
+        """Append body to log chunks, only the last chunk is rewritten"""
+        if not body:
+            return
+        if isinstance(body, str):
+            body = body.encode()
+        chunk_size = config.httpdb.log_chunk_size
+        if log.size:
+            last = self._query(LogChunk, log_id=log.id).order_by(
+                LogChunk.start.desc()).first()
+            free = chunk_size - (log.size - last.start)
+            if free > 0:
+                data = decompress(last.body, last.codec) + body[:free]
+                self._set_chunk(last, data, chunk_size)
+                log.size += len(body[:free])
+                body = body[free:]
+
+        for i in range(0, len(body), chunk_size):
+            chunk = LogChunk(log_id=log.id, start=log.size)
+            self._set_chunk(chunk, body[i:i+chunk_size], chunk_size)
+            self.session.add(chunk)
+            log.size += chunk.raw_size
+
+    def _set_chunk(self, chunk, data, chunk_size):
+        """Set log chunk body, compressed once full (no more appends)"""
+        chunk.body, chunk.codec, chunk.raw_size = data, None, len(data)
+        if len(data) >= chunk_size:
+            chunk.body, chunk.codec = self.compressor.compress(
+                data, LogChunk.__tablename__)
+
+    def _body_values(self, struct, cls):
+        """body, codec and raw_size column values of struct"""
+        body = encode_body(struct, self.body_format)
+        data, codec = self.compressor.compress(body, cls.__tablename__)
+        return {'body': data, 'codec': codec, 'raw_size': len(body)}
+
+    @contextmanager
+    def _transaction(self):
+        """Defer commits of the current thread to a single commit"""
+        if getattr(self._local, 'in_batch', False):  # nested
+            yield
+            return
+
+        lock = self._write_lock or NoLock()
+        with lock:
+            self._local.in_batch = True
+            try:
+                yield
+                self._local.in_batch = False
+                self._commit()
+            except Exception:
+                self.session.rollback()
+                # projects added in the transaction are gone
+                self._projects = {p.name for p in self.list_projects()}
+                self._tag_cache.clear()
+                raise
+            finally:
+                self._local.in_batch = False
+
+    def _commit(self):
+        if getattr(self._local, 'in_batch', False):
+            self.session.flush()
+            return
+
+        with self._write_lock or NoLock():
+            self.session.commit()
 
     def _upsert(self, obj, ignore=False):
         try:
-            sql_lock.acquire()
             self.session.add(obj)
-            self.session.commit()
+            self._commit()
         except SQLAlchemyError as err:
-            self.session.rollback()
             cls = obj.__class__.__name__
+            if getattr(self._local, 'in_batch', False):
+                raise RunDBError(f'batch {cls} - {err}') from err
+            self.session.rollback()
             logger.warning(f'conflict adding {cls}, {err}')
             if not ignore:
-                sql_lock.release()
                 raise RunDBError(f'duplicate {cls} - {err}') from err
-        sql_lock.release()
 
-    def _find_runs(self, uid, project, labels, state):
+    def _upsert_row(self, cls, keys, values, update=(), incr=()):
+        """Insert or update a cls row by the keys unique constraint
+
+        update columns are set from values, incr ones are incremented.
+        Returns the row id, should run in a transaction.
+        """
+        stmt = upsert_stmt(
+            self.engine.dialect.name, cls.__table__, keys, list(values),
+            update, incr)
+        self.session.flush()
+        try:
+            self.session.execute(stmt, values)
+        except SQLAlchemyError as err:
+            raise RunDBError(f'upsert {cls.__name__} - {err}') from err
+        # Objects loaded by the session might be stale now
+        self.session.expire_all()
+        query = self.session.query(cls.id).filter_by(
+            **{key: values[key] for key in keys})
+        return query.scalar()
+
+    def _upsert_obj(self, cls, keys, values, labels, update=None, incr=()):
+        """Upsert a cls row (all non key columns by default) and labels"""
+        if update is None:
+            update = [col for col in values if col not in keys]
+        obj_id = self._upsert_row(cls, keys, values, update, incr)
+        rows = [
+            {'parent': obj_id, 'name': name, 'value': value}
+            for name, value in (labels or {}).items()
+        ]
+        self._sync_children(cls.Label, 'parent', obj_id, 'name', rows)
+        return obj_id
+
+    def _sync_children(self, cls, parent, parent_id, key, rows):
+        """Make rows the cls rows of parent_id, (parent, key) is unique"""
+        parent_col, key_col = getattr(cls, parent), getattr(cls, key)
+        query = self.session.query(cls).filter(parent_col == parent_id)
+        if rows:
+            query = query.filter(~key_col.in_([row[key] for row in rows]))
+        query.delete(synchronize_session=False)
+        if not rows:
+            return
+        cols = list(rows[0])
+        update = [col for col in cols if col not in (parent, key)]
+        stmt = upsert_stmt(
+            self.engine.dialect.name, cls.__table__, [parent, key], cols,
+            update)
+        try:
+            self.session.execute(stmt, rows)
+        except SQLAlchemyError as err:
+            raise RunDBError(f'upsert {cls.__name__} - {err}') from err
+
+    def _keyset_page(self, query, time_col, id_col, page_size, cursor):
+        """Return a page of objects by descending (time_col, id_col)"""
+        if cursor:
+            ts, last_id = decode_cursor(cursor)
+            ts = parse_time(ts)
+            if ts is None:  # NULLs sort last (time columns are always set)
+                query = query.filter(time_col.is_(None), id_col < last_id)
+            else:
+                query = query.filter(or_(
+                    time_col < ts,
+                    and_(time_col == ts, id_col < last_id),
+                ))
+        query = query.order_by(time_col.desc(), id_col.desc())
+        objs = query.limit(page_size + 1).all()
+        if len(objs) <= page_size:
+            return objs, None
+        objs = objs[:page_size]
+        last = objs[-1]
+        values = [getattr(last, time_col.key), getattr(last, id_col.key)]
+        return objs, encode_cursor(values)
+
+    def _find_runs(
+            self, uid, project, labels, state, name=None, archived=False):
         labels = label_set(labels)
-        query = self._query(Run, uid=uid, project=project, state=state)
+        query = self._query(
+            Run, uid=uid, project=project, state=state, name=name)
+        if not archived:
+            query = query.filter(Run.archive.is_(None))
         return self._add_labels_filter(query, Run, labels)
 
-    def _latest_uid_filter(self, query):
-        # Create a sub query of latest uid (by updated) per (project,key)
-        subq = self.session.query(
-            Artifact.uid,
-            Artifact.project,
-            Artifact.key,
-            func.max(Artifact.updated),
-        ).group_by(
-            Artifact.project,
-            Artifact.key.label('key'),
-        ).subquery('max_key')
-
-        # Join curreny query with sub query on (project, key, uid)
+    def _time_bucket(self, col, bucket):
+        """SQL expression of the start of col time bucket"""
+        fmt = time_buckets[bucket]
+        dialect = self.engine.dialect.name
+        if dialect == 'sqlite':
+            return func.strftime(fmt, col)
+        if dialect == 'postgresql':
+            return func.date_trunc(bucket, col)
+        if dialect == 'mysql':
+            return func.date_format(col, fmt.replace('%M', '%i'))
+        raise RunDBError(f'time buckets are not supported on {dialect}')
+
+    def _latest_filter(self, query):
+        """Filter artifacts query to latest per (project, key)"""
         return query.join(
-            subq,
-            and_(
-                Artifact.project == subq.c.project,
-                Artifact.key == subq.c.key,
-                Artifact.uid == subq.c.uid,
-            )
-        )
+            ArtifactLatest, ArtifactLatest.obj_id == Artifact.id)
+
+    def _set_latest(self, obj):
+        """Point latest of obj (project, key/name) to obj if newer"""
+        latest_cls, key = _latest[obj.__class__]
+        kw = {'project': obj.project, key: getattr(obj, key)}
+        ptr = self._query(latest_cls, **kw).one_or_none()
+        if ptr is None:
+            ptr = latest_cls(**kw)
+            self.session.add(ptr)
+        elif ptr.obj_id != obj.id and \
+                naive_utc(ptr.updated) > naive_utc(obj.updated):
+            return
+        ptr.obj_id = obj.id
+        ptr.updated = obj.updated
+        self._commit()
+
+    def _refresh_latest(self, cls, project, name):
+        """Set latest pointer from objects (e.g. after delete)"""
+        latest_cls, key = _latest[cls]
+        self._query(latest_cls, **{'project': project, key: name}).delete(
+            synchronize_session=False)
+        obj = self._query(cls, **{'project': project, key: name}).order_by(
+            cls.updated.desc(), cls.id.desc()).first()
+        if obj:
+            self.session.add(latest_cls(
+                project=project, updated=obj.updated, obj_id=obj.id,
+                **{key: name}))
 
-    def _find_artifacts(self, project, uid, labels, since, until):
+    def rebuild_latest(self, cls=None):
+        """Rebuild latest pointers from objects, return number of pointers"""
+        count = 0
+        classes = [cls] if cls else list(_latest)
+        for cls in classes:
+            latest_cls, key = _latest[cls]
+            col = getattr(cls, key)
+            keys = self.session.query(cls.project, col).distinct().all()
+            with self._transaction():
+                self.session.query(latest_cls).delete()
+                for project, name in keys:
+                    self._refresh_latest(cls, project, name)
+            count += len(keys)
+        return count
+
+    def _find_artifacts(
+            self, project, uid, labels, since, until, archived=False):
         labels = label_set(labels)
         query = self._query(Artifact, project=project)
+        if not archived:
+            query = query.filter(Artifact.archive.is_(None))
         if uid != '*':
             if uid == 'latest':
-                query = self._latest_uid_filter(query)
+                query = self._latest_filter(query)
             else:
                 query = query.filter(Artifact.uid == uid)
 
@@ -682,29 +1773,102 @@ class SQLDB(RunDBInterface):
 
     def _delete(self, cls, **kw):
         query = self.session.query(cls).filter_by(**kw)
-        for obj in query:
-            self.session.delete(obj)
-        self.session.commit()
-
-    def _find_lables(self, cls, label_cls, labels):
-        return self.session.query(cls).join(label_cls).filter(
-                label_cls.name.in_(labels))
+        return self._delete_query(cls, query)
+
+    def _delete_query(self, cls, query, limit=0):
+        """Delete objects matching query (up to limit), return count"""
+        query = query.with_entities(cls.id)
+        if limit:
+            query = query.limit(limit)
+        ids = [obj_id for obj_id, in query]
+        for i in range(0, len(ids), delete_chunk_size):
+            self._delete_ids(cls, ids[i:i+delete_chunk_size])
+        self._commit()
+        self.session.expire_all()
+        return len(ids)
+
+    def _delete_batches(self, cls, query, batch_size, delay):
+        count = 0
+        while True:
+            deleted = self._delete_query(cls, query, batch_size)
+            count += deleted
+            if deleted < batch_size:
+                return count
+            sleep(delay)
+
+    def _delete_ids(self, cls, ids):
+        """Delete objects by id with their labels, tags (and run logs)"""
+        keys = []
+        if cls is Run:
+            keys = self.session.query(Run.project, Run.uid).filter(
+                Run.id.in_(ids)).distinct().all()
+        if cls is Run:
+            self.session.query(RunResult).filter(
+                RunResult.run_id.in_(ids)).delete(synchronize_session=False)
+        if hasattr(cls, 'Label'):
+            self.session.query(cls.Label).filter(
+                cls.Label.parent.in_(ids)).delete(synchronize_session=False)
+        if hasattr(cls, 'Tag'):
+            self.session.query(cls.Tag).filter(
+                cls.Tag.obj_id.in_(ids)).delete(synchronize_session=False)
+        stale = []
+        if cls in _latest:
+            latest_cls, key = _latest[cls]
+            query = self.session.query(latest_cls).filter(
+                latest_cls.obj_id.in_(ids))
+            stale = [(ptr.project, getattr(ptr, key)) for ptr in query]
+            query.delete(synchronize_session=False)
+        self.session.query(cls).filter(
+            cls.id.in_(ids)).delete(synchronize_session=False)
+        for project, name in stale:
+            self._refresh_latest(cls, project, name)
+        if hasattr(cls, 'Tag'):
+            self._tag_cache.clear()
+
+        # Logs are per uid, delete ones with no iteration left
+        for project in {project for project, _ in keys}:
+            uids = [uid for prj, uid in keys if prj == project]
+            has_run = self.session.query(Run.id).filter(
+                Run.project == Log.project, Run.uid == Log.uid).exists()
+            log_ids = self.session.query(Log.id).filter(
+                Log.project == project, Log.uid.in_(uids), ~has_run)
+            log_ids = [log_id for log_id, in log_ids]
+            if not log_ids:
+                continue
+            self.session.query(LogChunk).filter(
+                LogChunk.log_id.in_(log_ids)).delete(synchronize_session=False)
+            self.session.query(Log).filter(
+                Log.id.in_(log_ids)).delete(synchronize_session=False)
 
     def _add_labels_filter(self, query, cls, labels):
-        if not labels:
-            return query
+        """Filter objects having all labels
 
-        preds = []
+        Each label ("name", "name=value", "name!=value" or "name~=value")
+        selects parents from the (name, value, parent) label index, the
+        database intersects the selections.
+        """
         for lbl in labels:
-            if '=' in lbl:
-                name, value = [v.strip() for v in lbl.split('=', 1)]
-                cond = and_(cls.Label.name == name, cls.Label.value == value)
-                preds.append(cond)
-            else:
-                preds.append(cls.Label.name == lbl.strip())
+            query = query.filter(self._label_cond(cls, lbl))
+        return query
 
-        subq = self.session.query(cls.Label).filter(*preds).subquery('labels')
-        return query.join(subq)
+    def _label_cond(self, cls, lbl):
+        label_cls = cls.Label
+        parents = self.session.query(label_cls.parent)
+        for verb in ('~=', '!=', '='):
+            if verb not in lbl:
+                continue
+            name, value = [v.strip() for v in lbl.split(verb, 1)]
+            parents = parents.filter(label_cls.name == name)
+            if verb == '~=':
+                like = value.replace('\\', '\\\\')
+                like = like.replace('%', r'\%').replace('_', r'\_')
+                return cls.id.in_(parents.filter(
+                    label_cls.value.like(f'%{like}%', escape='\\')))
+            parents = parents.filter(label_cls.value == value)
+            if verb == '!=':
+                return ~cls.id.in_(parents)
+            return cls.id.in_(parents)
+        return cls.id.in_(parents.filter(label_cls.name == lbl.strip()))
 
 
 def table2cls(name):
@@ -718,13 +1882,193 @@ def label_set(labels):
     return set(labels or [])
 
 
-def run_start_time(run):
-    ts = get_in(run, 'status.start_time', '')
+def sqlite_lock(database):
+    """Write lock of SQLite database file (shared by SQLDBs using it)"""
+    database = database or ''
+    if database not in _sqlite_locks:
+        database = os.path.abspath(database)
+    return _sqlite_locks.setdefault(database, RLock())
+
+
+def engine_options(url):
+    """create_engine keyword arguments from the httpdb pool configuration"""
+    if url.get_backend_name() == 'sqlite' and \
+            url.database in (None, '', ':memory:'):
+        return {}  # in memory databases can't be shared by a pool
+
+    cfg = config.httpdb
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(cfg.pool_size),
+        'max_overflow': int(cfg.pool_max_overflow),
+        'pool_recycle': int(cfg.pool_recycle),
+        'pool_timeout': int(cfg.pool_timeout),
+        'pool_pre_ping': True,
+    }
+
+
+def has_upsert(dialect):
+    """True if dialect supports upsert_stmt"""
+    if dialect.name == 'sqlite':
+        return dialect.dbapi.sqlite_version_info >= (3, 24, 0)
+    return dialect.name in ('postgresql', 'mysql')
+
+
+def upsert_stmt(dialect, table, keys, cols, update=(), incr=()):
+    """INSERT .. ON CONFLICT (keys) DO UPDATE statement of dialect
+
+    The statement takes cols parameters, on conflict update columns are
+    set to the inserted values and incr ones are incremented. Without
+    update and incr it does nothing on conflict.
+    """
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(table)
+        sets = {col: stmt.excluded[col] for col in update}
+        sets.update({col: table.c[col] + 1 for col in incr})
+        if not sets:
+            return stmt.on_conflict_do_nothing(index_elements=keys)
+        return stmt.on_conflict_do_update(index_elements=keys, set_=sets)
+
+    if dialect == 'mysql':
+        stmt = mysql.insert(table)
+        sets = {col: stmt.inserted[col] for col in update}
+        sets.update({col: table.c[col] + 1 for col in incr})
+        if not sets:
+            sets = {keys[0]: table.c[keys[0]]}  # no op update
+        return stmt.on_duplicate_key_update(sets)
+
+    if dialect != 'sqlite':
+        raise RunDBError(f'upsert is not supported on {dialect}')
+    # SQLAlchemy < 1.4 has no SQLite insert construct, same syntax as
+    # PostgreSQL
+    sets = [f'{col} = excluded.{col}' for col in update]
+    sets += [f'{col} = {table.name}.{col} + 1' for col in incr]
+    action = 'DO UPDATE SET ' + ', '.join(sets) if sets else 'DO NOTHING'
+    sql = (
+        f'INSERT INTO {table.name} ({", ".join(cols)}) '
+        f'VALUES ({", ".join(":" + col for col in cols)}) '
+        f'ON CONFLICT ({", ".join(keys)}) {action}'
+    )
+    params = [bindparam(col, type_=table.c[col].type) for col in cols]
+    return text(sql).bindparams(*params)
+
+
+def guard_pool_pid(engine):
+    """Invalidate connections inherited from a parent process (fork)"""
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info['pid'] != pid:
+            connection_record.connection = connection_proxy.connection = None
+            raise DisconnectionError(
+                f'connection belongs to pid {connection_record.info["pid"]}, '
+                f'current pid is {pid}')
+
+
+def upgrade_schema(engine):
+    """Add columns missing in tables created by older versions
+
+    Returns a list of added (table, column). Indexes are not created here
+    since building them on a large table can take a while, use
+    create_indexes (mlrun db indexes --create).
+    """
+    insp = inspect(engine)
+    existing = set(insp.get_table_names())
+    added = []
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            columns = {col['name'] for col in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in columns:
+                    continue
+                typ = col.type.compile(dialect=engine.dialect)
+                conn.execute(text(
+                    f'ALTER TABLE {table.name} ADD COLUMN {col.name} {typ}'))
+                added.append((table.name, col.name))
+    return added
+
+
+def missing_indexes(engine):
+    """Return the declared indexes that don't exist in the database"""
+    insp = inspect(engine)
+    existing = set(insp.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+        names = {idx['name'] for idx in insp.get_indexes(table.name)}
+        missing.extend(idx for idx in table.indexes if idx.name not in names)
+    return missing
+
+
+def create_indexes(engine):
+    """Create missing indexes, return the names of the created indexes
+
+    On PostgreSQL indexes are built CONCURRENTLY (no write lock), MySQL
+    (InnoDB) builds them online by default.
+    """
+    created = []
+    for idx in missing_indexes(engine):
+        if engine.dialect.name == 'postgresql':
+            ddl = str(CreateIndex(idx).compile(dialect=engine.dialect))
+            ddl = ddl.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)
+            # CONCURRENTLY can't run inside a transaction
+            with engine.connect() as conn:
+                conn.execution_options(
+                    isolation_level='AUTOCOMMIT').execute(text(ddl))
+        else:
+            idx.create(engine)
+        created.append(idx.name)
+    return created
+
+
+def explain(engine, query):
+    """Return the database query plan lines for an ORM query"""
+    sql = query.statement.compile(
+        dialect=engine.dialect, compile_kwargs={'literal_binds': True})
+    if engine.dialect.name == 'sqlite':
+        rows = engine.execute(text(f'EXPLAIN QUERY PLAN {sql}'))
+        return [row[-1] for row in rows]
+
+    rows = engine.execute(text(f'EXPLAIN {sql}'))
+    return [' '.join(str(col) for col in row) for row in rows]
+
+
+def parse_time(ts):
     if not ts:
         return None
+    if isinstance(ts, datetime):
+        return ts
     return parser.parse(ts)
 
 
+def naive_utc(ts):
+    """Naive UTC datetime (databases might drop the timezone)"""
+    if ts is None:
+        return datetime.min
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def bucket_str(value):
+    """Time bucket as string (databases return str or datetime)"""
+    if isinstance(value, datetime):
+        return value.strftime(time_buckets['minute'])
+    return value
+
+
+def run_start_time(run):
+    return parse_time(get_in(run, 'status.start_time', ''))
+
+
 def run_labels(run) -> dict:
     return get_in(run, 'metadata.labels', {})
 
@@ -733,11 +2077,74 @@ def run_state(run):
     return get_in(run, 'status.state', '')
 
 
+def run_fields(struct):
+    """Run columns projected from the run body (without duration)
+
+    state and start_time are None if missing, runs keep the current ones.
+    """
+    labels = run_labels(struct) or {}
+    return {
+        'name': get_in(struct, 'metadata.name'),
+        'state': run_state(struct) or None,
+        'start_time': run_start_time(struct),
+        'last_update': parse_time(get_in(struct, 'status.last_update')),
+        'kind': labels.get('kind'),
+        'owner': labels.get('owner'),
+    }
+
+
+def duration_seconds(start_time, last_update):
+    if start_time and last_update:
+        delta = naive_utc(last_update) - naive_utc(start_time)
+        return delta.total_seconds()
+
+
+def update_run_fields(run, struct):
+    """Update the run columns (and results) projected from the run body"""
+    for col, value in run_fields(struct).items():
+        if value is None and col in ('state', 'start_time'):
+            continue
+        setattr(run, col, value)
+    run.duration = duration_seconds(run.start_time, run.last_update)
+    update_results(run, struct)
+
+
+def update_artifact_fields(art, struct):
+    art.kind = struct.get('kind')
+    art.iteration = struct.get('iter') or 0
+
+
+def update_function_fields(fn, struct):
+    fn.kind = struct.get('kind')
+    fn.state = get_in(struct, 'status.state')
+
+
+_fields_updaters = {
+    Run: update_run_fields,
+    Artifact: update_artifact_fields,
+    Function: update_function_fields,
+}
+
+
+def update_results(run, struct):
+    """Sync run results rows with numeric status.results"""
+    results = numeric_results(struct)
+    if results == {res.key: res.value for res in run.results}:
+        return
+    old = {res.key: res for res in run.results}
+    run.results.clear()
+    for key, value in results.items():
+        res = old.get(key) or RunResult(key=key)
+        res.value, res.project = value, run.project
+        run.results.append(res)
+
+
 def update_labels(obj, labels: dict):
     old = {label.name: label for label in obj.labels}
     obj.labels.clear()
     for name, value in labels.items():
         if name in old:
+            old[name].value = value
             obj.labels.append(old[name])
         else:
             obj.labels.append(obj.Label(name=name, value=value, parent=obj.id))
@@ -748,7 +2155,7 @@ def to_dict(obj):
         return {
             attr: to_dict(getattr(obj, attr))
             for attr in dir(obj)
-            if is_field(attr)
+            if is_field(attr) and not callable(getattr(obj, attr))
         }
 
     if isinstance(obj, (list, tuple)):
@@ -395,6 +395,8 @@ class MLClientCtx(object):
             self._annotations['message'] = message
         self._last_update = now_date()
         self._update_db(commit=True, message=message)
+        if self._rundb:
+            self._rundb.flush()
 
     def set_state(self, state: str = None, error: str = None, commit=True):
         """modify and store the run state or mark an error"""
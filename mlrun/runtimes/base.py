@@ -32,6 +32,9 @@ from .generators import get_generator
 from ..k8s_utils import get_k8s_helper
 from ..config import config
 
+# max child run writes sent to the db in one batch (hyper param runs)
+db_batch_size = 100
+
 
 class FunctionStatus(ModelObj):
     def __init__(self, state=None, build_pod=None):
@@ -412,18 +415,29 @@ class BaseRuntime(ModelObj):
 
     def _run_many(self, tasks, execution, runobj: RunObject) -> RunList:
         results = RunList()
-        for task in tasks:
-            try:
-                # self.store_run(task)
-                resp = self._run(task, execution)
-                resp = self._post_run(resp, task=task)
-            except RunError as err:
-                task.status.state = 'error'
-                task.status.error = str(err)
-                resp = self._post_run(task=task, err=err)
-            results.append(resp)
+        db_ops = []  # child run writes, sent to the db in batches
+        try:
+            for task in tasks:
+                try:
+                    resp = self._run(task, execution)
+                    resp = self._post_run(resp, task=task, db_ops=db_ops)
+                except RunError as err:
+                    task.status.state = 'error'
+                    task.status.error = str(err)
+                    resp = self._post_run(task=task, err=err, db_ops=db_ops)
+                results.append(resp)
+                if len(db_ops) >= db_batch_size:
+                    self._flush_db_ops(db_ops)
+        finally:
+            # Runs done before an unexpected error are written as well
+            self._flush_db_ops(db_ops)
         return results
 
+    def _flush_db_ops(self, db_ops):
+        if self._get_db() and db_ops:
+            self._get_db().batch(db_ops)
+        del db_ops[:]
+
     def store_run(self, runobj: RunObject):
         if self._get_db() and runobj:
             project = runobj.metadata.project
@@ -438,16 +452,27 @@ class BaseRuntime(ModelObj):
             iter = get_in(rundict, 'metadata.iteration', 0)
             self._get_db().store_run(rundict, uid, project, iter=iter)
 
-    def _post_run(
-            self, resp: dict = None, task: RunObject = None, err=None) -> dict:
-        """update the task state in the DB"""
+    def _post_run(self, resp: dict = None, task: RunObject = None, err=None,
+                  db_ops: list = None) -> dict:
+        """update the task state in the DB
+
+        when db_ops (list) is passed the db writes are added to it instead
+        of being executed (see _run_many)
+        """
         was_none = False
         if resp is None and task:
             was_none = True
             resp = self._get_db_run(task)
 
             if not resp:
-                self.store_run(task)
+                if db_ops is None:
+                    self.store_run(task)
+                else:
+                    meta = task.metadata
+                    db_ops.append({
+                        'op': 'store_run', 'struct': task.to_dict(),
+                        'uid': meta.uid, 'project': meta.project,
+                        'iter': meta.iteration})
                 return task.to_dict()
 
             if task.status.status_text:
@@ -479,7 +504,12 @@ class BaseRuntime(ModelObj):
             project = get_in(resp, 'metadata.project')
             uid = get_in(resp, 'metadata.uid')
             iter = get_in(resp, 'metadata.iteration', 0)
-            self._get_db().update_run(updates, uid, project, iter=iter)
+            if db_ops is None:
+                self._get_db().update_run(updates, uid, project, iter=iter)
+            else:
+                db_ops.append({
+                    'op': 'update_run', 'updates': updates, 'uid': uid,
+                    'project': project, 'iter': iter})
 
         return resp
 
@@ -225,18 +225,21 @@ def numpy_representer_seq(dumper, data):
 
 
 def float_representer(dumper, data):
-    return dumper.represent_float(data)
+    return dumper.represent_float(float(data))
 
 
 def int_representer(dumper, data):
-    return dumper.represent_int(data)
+    return dumper.represent_int(int(data))
 
 
-yaml.add_representer(np.int64, int_representer, Dumper=yaml.SafeDumper)
-yaml.add_representer(np.integer, int_representer, Dumper=yaml.SafeDumper)
-yaml.add_representer(np.float64, float_representer, Dumper=yaml.SafeDumper)
-yaml.add_representer(np.floating, float_representer, Dumper=yaml.SafeDumper)
-yaml.add_representer(np.ndarray, numpy_representer_seq, Dumper=yaml.SafeDumper)
+# CSafeDumper is the LibYAML dumper (used by the FileRunDB yaml format)
+_dumpers = {yaml.SafeDumper, getattr(yaml, 'CSafeDumper', yaml.SafeDumper)}
+for _dumper in _dumpers:
+    yaml.add_representer(np.int64, int_representer, Dumper=_dumper)
+    yaml.add_representer(np.integer, int_representer, Dumper=_dumper)
+    yaml.add_representer(np.float64, float_representer, Dumper=_dumper)
+    yaml.add_representer(np.floating, float_representer, Dumper=_dumper)
+    yaml.add_representer(np.ndarray, numpy_representer_seq, Dumper=_dumper)
 
 
 def dict_to_yaml(struct):
@@ -0,0 +1,99 @@
+# Copyright 2019 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""FileRunDB.list_runs without the index, sequential vs concurrent reads
+
+    cd tests && python bench_file_list.py --files 100000 --workers 1 8
+
+Creates a synthetic tree (runs started a second apart, file modification
+time at the start) unless --dirpath already has it, then times a full
+list and list_runs(last=N) with each number of workers. Use --dirpath on
+a network file system to see the effect of storage latency.
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+from os import makedirs, path, utime
+from tempfile import mkdtemp
+from time import monotonic
+
+from mlrun.config import config
+from mlrun.db import FileRunDB
+from mlrun.utils import dict_to_yaml
+
+
+def create_tree(dirpath, project, files):
+    rundir = path.join(dirpath, 'runs', project)
+    makedirs(rundir, exist_ok=True)
+    start = datetime.now(timezone.utc) - timedelta(seconds=files)
+    for i in range(files):
+        run_start = start + timedelta(seconds=i)
+        run = {
+            'metadata': {
+                'name': f'train-{i % 10}',
+                'uid': f'{i:032x}',
+                'labels': {'kind': 'job', 'owner': f'user{i % 7}'},
+            },
+            'spec': {'parameters': {'lr': i / files, 'epochs': i % 20}},
+            'status': {
+                'state': 'completed',
+                'start_time': run_start.isoformat(),
+                'results': {'accuracy': i / files, 'loss': 1 - i / files},
+            },
+        }
+        filepath = path.join(rundir, f'{i:032x}.yaml')
+        with open(filepath, 'w') as fp:
+            fp.write(dict_to_yaml(run))
+        utime(filepath, (run_start.timestamp(), run_start.timestamp()))
+
+
+def timed(fn):
+    start = monotonic()
+    out = fn()
+    return monotonic() - start, len(out)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--dirpath', help='db directory (default: temp)')
+    parser.add_argument(
+        '--workers', type=int, nargs='+', default=[1, 8],
+        help='httpdb.file_load_workers values')
+    parser.add_argument('--last', type=int, default=100)
+    args = parser.parse_args()
+
+    project = 'bench'
+    dirpath = args.dirpath or mkdtemp(prefix='mlrun-bench')
+    if not path.isdir(path.join(dirpath, 'runs', project)):
+        print(f'creating {args.files} run files in {dirpath}')
+        create_tree(dirpath, project, args.files)
+
+    db = FileRunDB(dirpath).connect()
+    db.use_index = False
+    for workers in args.workers:
+        config.httpdb.file_load_workers = workers
+        duration, count = timed(lambda: db.list_runs(
+            project=project, last=args.last))
+        print(
+            f'{workers:3} workers, last={args.last}: {duration:8.3f}sec '
+            f'({count} runs)')
+        duration, count = timed(lambda: db.list_runs(
+            project=project, last=0))
+        print(
+            f'{workers:3} workers, full list: {duration:8.3f}sec '
+            f'({count} runs, {count / duration:.0f} runs/sec)')
+
+
+if __name__ == '__main__':
+    main()
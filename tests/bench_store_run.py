@@ -0,0 +1,76 @@
+# Copyright 2019 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""SQLDB.store_run throughput, ORM path vs native upsert
+
+    cd tests && python bench_store_run.py --threads 8 --runs 2000
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkdtemp
+from time import monotonic
+
+from mlrun.db import sqldb
+from mlrun.utils import logger
+from conftest import new_run
+
+
+def bench(native, threads, runs, uids, project='bench'):
+    db_file = f'{mkdtemp()}/mlrun.db'
+    db = sqldb.SQLDB(f'sqlite:///{db_file}?check_same_thread=false')
+    db.connect()
+    db.native_upsert = native and sqldb.has_upsert(db.engine.dialect)
+    warnings = []
+
+    def store(i):
+        uid = f'u{i % uids}'  # runs are stored uids times
+        run = new_run('running', {'kind': 'job', 'i': str(i)}, uid)
+        run['status']['results'] = {'accuracy': i / runs}
+        try:
+            db.store_run(run, uid, project)
+        except Exception as err:  # noqa: B902
+            warnings.append(err)
+        finally:
+            db.close_session()
+
+    warn = logger.warning
+    logger.warning = warnings.append  # "conflict adding Run" is a lost run
+    try:
+        start = monotonic()
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(store, range(runs)))
+        duration = monotonic() - start
+    finally:
+        logger.warning = warn
+    return duration, len(warnings)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--runs', type=int, default=2000)
+    parser.add_argument(
+        '--uids', type=int, default=500, help='number of distinct runs')
+    args = parser.parse_args()
+
+    for native in (False, True):
+        duration, errors = bench(native, args.threads, args.runs, args.uids)
+        name = 'native upsert' if native else 'ORM'
+        print(
+            f'{name:>14}: {args.runs / duration:8.1f} runs/sec '
+            f'({duration:.2f}sec), {errors} conflicts/errors')
+
+
+if __name__ == '__main__':
+    main()
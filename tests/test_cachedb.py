@@ -0,0 +1,111 @@
+# Copyright 2019 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""CachedRunDB specific tests, common tests should be in test_dbs.py"""
+
+from unittest.mock import patch
+
+import pytest
+
+from conftest import new_run
+from mlrun.db import CachedRunDB, RunDBInterface, SQLDB, cachedb
+
+
+@pytest.fixture
+def db():
+    sql_db = SQLDB('sqlite:///:memory:?check_same_thread=false')
+    return CachedRunDB(sql_db, size=10, ttl=60).connect()
+
+
+def test_read_run(db: CachedRunDB):
+    prj, uid = 'p1', 'u1'
+    db.store_run(new_run('s1', {}), uid, prj)
+    run = db.read_run(uid, prj)
+    run['status']['state'] = 'changed'
+    assert 's1' == db.read_run(uid, prj)['status']['state'], 'not a copy'
+    assert {'hits': 1, 'misses': 1} == _counts(db, 'run'), 'stats'
+
+    db.update_run({'status.state': 's2'}, uid, prj)
+    assert 's2' == db.read_run(uid, prj)['status']['state'], 'update'
+    assert {'hits': 1, 'misses': 2} == _counts(db, 'run'), 'invalidate'
+
+
+def test_artifact_and_function(db: CachedRunDB):
+    prj = 'p2'
+    db.store_artifact('k1', {'x': 1}, 'u1', tag='t1', project=prj)
+    db.store_function({'x': 1}, 'f1', prj, tag='latest')
+    for _ in range(2):
+        assert 1 == db.read_artifact('k1', 't1', project=prj)['x']
+        assert 1 == db.get_function('f1', prj)['x']
+
+    db.store_artifact('k1', {'x': 2}, 'u2', tag='t1', project=prj)
+    db.store_function({'x': 2}, 'f1', prj, tag='latest')
+    assert 2 == db.read_artifact('k1', 't1', project=prj)['x'], 'artifact'
+    assert 2 == db.get_function('f1', prj)['x'], 'function'
+    stats = db.cache_stats()
+    assert 1 == stats['artifact']['hits'], 'artifact hits'
+    assert 1 == stats['function']['hits'], 'function hits'
+
+
+def test_delegated(db: CachedRunDB):
+    prj = 'p4'
+    db.store_artifact('k1', {'x': 1}, 'u1', tag='v1', project=prj)
+    assert db.db.list_artifact_tags(prj) == db.list_artifact_tags(prj)
+    assert 'v1' in db.list_artifact_tags(prj), 'tags'
+    # iter_* and store_runs ... call the delegated list_*_page and batch
+    indirect = {
+        'iter_runs', 'iter_artifacts', 'iter_functions', 'store_runs',
+        'update_runs', 'store_artifacts'}
+    for name, fn in vars(RunDBInterface).items():
+        if callable(fn) and not name.startswith('_') and \
+                name not in indirect:
+            assert name in vars(CachedRunDB), f'{name} is not delegated'
+
+
+def test_ttl(db: CachedRunDB):
+    db.store_run(new_run('s1', {}), 'u3', 'p3')
+    db.read_run('u3', 'p3')
+    now = cachedb.monotonic()
+    with patch.object(cachedb, 'monotonic', lambda: now + 61):
+        db.read_run('u3', 'p3')
+    assert {'hits': 0, 'misses': 2} == _counts(db, 'run'), 'expired'
+
+
+def test_lru():
+    cache = cachedb.LRUCache(size=2, ttl=60)
+    for i in range(3):
+        cache.set(i, i)
+    cache.get(1)
+    cache.set(3, 3)
+    assert [None, None, 1, 3] == [cache.get(i) for i in (0, 2, 1, 3)], 'lru'
+
+
+def test_discard_group():
+    cache = cachedb.LRUCache(size=3, ttl=60)
+    for key in (('p1', 'k1', 1), ('p1', 'k2', 1), ('p2', 'k1', 1)):
+        cache.set(key, 1, groups=(key[:1], key[:2]))
+    cache.discard_group(('p1', 'k1'))
+    assert [None, 1, 1] == [
+        cache.get(key) for key in (('p1', 'k1', 1), ('p1', 'k2', 1),
+                                   ('p2', 'k1', 1))], 'key group'
+    cache.discard_group(('p1',))
+    assert cache.get(('p1', 'k2', 1)) is None, 'project group'
+    cache.set(('p3', 'k1', 1), 1, groups=(('p3',),))
+    cache.set(('p3', 'k2', 1), 1, groups=(('p3',),))
+    cache.set(('p3', 'k3', 1), 1, groups=(('p3',),))  # Evicts p2
+    assert {('p3',)} == set(cache._groups), 'evicted groups'
+
+
+def _counts(db, name):
+    stats = db.cache_stats()[name]
+    return {'hits': stats['hits'], 'misses': stats['misses']}
@@ -18,12 +18,17 @@ from tempfile import mkdtemp
 import pytest
 
 from conftest import new_run, run_now
-from mlrun.db import SQLDB, FileRunDB, RunDBError, sqldb
+from mlrun.db import (
+    SQLDB, CachedRunDB, FileRunDB, RunDBConflictError, RunDBError, sqldb
+)
+from mlrun.db.archive import RunArchive
 from mlrun.db.base import RunDBInterface
+from mlrun.db.compress import Compressor
 
 dbs = [
     'sql',
     'file',
+    'cached',
     # TODO: 'httpdb',
 ]
 
@@ -37,6 +42,10 @@ def db(request):
         db = SQLDB(f'sqlite:///{db_file}?check_same_thread=false')
     elif request.param == 'file':
         db = FileRunDB(path)
+    elif request.param == 'cached':
+        db_file = f'{path}/mlrun.db'
+        sql_db = SQLDB(f'sqlite:///{db_file}?check_same_thread=false')
+        db = CachedRunDB(sql_db, size=100, ttl=60)
     else:
         assert False, f'unknown db type - {request.param}'
 
@@ -156,8 +165,7 @@ def test_artifacts(db: RunDBInterface):
     db.store_artifact(k3, art3, u3, project=prj)
 
     arts = db.list_artifacts(project=prj, tag='*')
-    expected = 2 if isinstance(db, SQLDB) else 4  # FIXME
-    assert expected == len(arts), 'list artifacts length'
+    assert 2 == len(arts), 'list artifacts length'
     assert {2, 3} == {a['a'] for a in arts}, 'list artifact a'
 
     db.del_artifact(key=k1)
@@ -190,3 +198,218 @@ def test_schedules(db: RunDBInterface):
     scheds = list(db.list_schedules())
     assert count == len(scheds), 'wrong number of schedules'
     assert set(range(count)) == set(s['i'] for s in scheds), 'bad scheds'
+
+
+def test_runs_pages(db: RunDBInterface):
+    prj, count = 'p42', 25
+    for i in range(count):
+        run = new_run('s1', {}, f'uid{i}', x=i)
+        run['status']['start_time'] = f'2020-03-01T10:00:{i:02d}'
+        db.store_run(run, f'uid{i}', prj)
+
+    pages, cursor = [], None
+    while True:
+        runs, cursor = db.list_runs_page(
+            project=prj, page_size=10, cursor=cursor)
+        pages.append([run['x'] for run in runs])
+        if not cursor:
+            break
+
+    assert [10, 10, 5] == [len(page) for page in pages], 'page sizes'
+    xs = [x for page in pages for x in page]
+    assert list(reversed(range(count))) == xs, 'order'
+
+    xs = [run['x'] for run in db.iter_runs(project=prj, page_size=7)]
+    assert list(reversed(range(count))) == xs, 'iter_runs'
+
+
+def test_artifacts_pages(db: RunDBInterface):
+    prj, count = 'p43', 12
+    for i in range(count):
+        art = {'a': i, 'updated': f'2020-03-01T10:00:{i:02d}+00:00'}
+        db.store_artifact(f'k{i}', art, f'u{i}', project=prj)
+
+    arts = list(db.iter_artifacts(project=prj, tag='*', page_size=5))
+    assert count == len(arts), 'number of artifacts'
+    assert set(range(count)) == {art['a'] for art in arts}, 'artifacts'
+    assert count == len(db.list_artifacts(project=prj, tag='*')), 'list'
+
+
+def test_batch(db: RunDBInterface):
+    prj, count = 'p44', 5
+    db.store_runs([
+        {'struct': new_run('s1', {}, x=i), 'uid': 'u1', 'project': prj,
+         'iter': i}
+        for i in range(count)
+    ])
+    db.update_runs([
+        {'updates': {'status.state': 's2'}, 'uid': 'u1', 'project': prj,
+         'iter': i}
+        for i in range(count)
+    ])
+    runs = db.list_runs(project=prj, iter=True)
+    assert count == len(runs), 'number of runs'
+    assert {'s2'} == {run['status']['state'] for run in runs}, 'state'
+
+    db.store_artifacts([
+        {'key': f'k{i}', 'artifact': {'a': i}, 'uid': 'u1', 'project': prj}
+        for i in range(count)
+    ])
+    assert 3 == db.read_artifact('k3', project=prj)['a'], 'artifact'
+
+    with pytest.raises(RunDBError):
+        db.batch([{'op': 'del_run', 'uid': 'u1'}])
+
+
+def test_patch_run(db: RunDBInterface):
+    prj, uid = 'p47', 'u47'
+    db.store_run(new_run('s1', {'a': 'b'}), uid, prj)
+    version = db.patch_run([], uid, prj)
+    ops = [
+        {'op': 'set', 'key': 'status.state', 'value': 's2'},
+        {'op': 'append', 'key': 'status.events', 'value': 'e1'},
+        {'op': 'inc', 'key': 'status.retries'},
+        {'op': 'inc', 'key': 'status.retries', 'value': 2},
+    ]
+    new_version = db.patch_run(ops, uid, prj, version=version)
+    assert new_version != version, 'version not changed'
+    run = db.read_run(uid, prj)
+    assert 's2' == run['status']['state'], 'set'
+    assert ['e1'] == run['status']['events'], 'append'
+    assert 3 == run['status']['retries'], 'inc'
+
+    with pytest.raises(RunDBConflictError):
+        db.patch_run({'status.state': 's3'}, uid, prj, version=version)
+    assert 's2' == db.read_run(uid, prj)['status']['state'], 'conflict'
+
+    db.update_run({'metadata.labels.a': 'c'}, uid, prj)
+    runs = db.list_runs(project=prj, labels=['a=c'])
+    assert 1 == len(runs), 'labels not updated'
+
+
+def test_aggregate_runs(db: RunDBInterface):
+    prj = 'p48'
+    for i in range(6):
+        run = new_run('error' if i % 3 == 0 else 'completed', {'x': 'y'})
+        run['metadata']['name'] = f'n{i % 2}'
+        run['status']['start_time'] = f'2020-03-01T1{i % 2}:00:00+00:00'
+        run['status']['last_update'] = f'2020-03-01T1{i % 2}:00:{i:02d}+00:00'
+        db.store_run(run, f'u{i}', prj)
+
+    groups = db.aggregate_runs(prj, group_by=['name'], percentiles=[50])
+    assert ['n0', 'n1'] == [group['name'] for group in groups], 'names'
+    assert [3, 3] == [group['count'] for group in groups], 'counts'
+    assert [1, 1] == [group['failed'] for group in groups], 'failed'
+    n0 = groups[0]['duration']
+    assert (0, 4, 2, 2) == (n0['min'], n0['max'], n0['avg'], n0['p50'])
+
+    groups = db.aggregate_runs(prj, group_by=['label.x'], bucket='hour')
+    buckets = [(group['label.x'], group['bucket']) for group in groups]
+    expected = [('y', '2020-03-01T10:00:00'), ('y', '2020-03-01T11:00:00')]
+    assert expected == buckets, 'buckets'
+
+
+def test_query_results(db: RunDBInterface):
+    prj = 'p49'
+    for i in range(5):
+        run = new_run('completed', {}, f'u{i}')
+        run['status']['results'] = {'accuracy': i / 10, 'loss': 1 - i / 10}
+        db.store_run(run, f'u{i}', prj)
+    db.store_run(new_run('completed', {}, 'u5'), 'u5', prj)
+
+    runs = db.query_results(prj, order_by='accuracy', limit=2)
+    assert ['u4', 'u3'] == [run['metadata']['uid'] for run in runs], 'top'
+
+    runs = db.query_results(
+        prj, where=['results.accuracy > 0.1', 'loss>=0.7'], order_by='loss',
+        desc=False)
+    assert ['u3', 'u2'] == [run['metadata']['uid'] for run in runs], 'where'
+
+    db.update_run({'status.results.accuracy': 0.95}, 'u0', prj)
+    runs = db.query_results(prj, where=['accuracy > 0.9'])
+    assert ['u0'] == [run['metadata']['uid'] for run in runs], 'update'
+
+    with pytest.raises(RunDBError):
+        db.query_results(prj, where=['accuracy ~ 3'])
+
+
+def test_labels_and(db: RunDBInterface):
+    prj = 'p50'
+    labels = [
+        {'a': '1', 'b': 'x'},
+        {'a': '1', 'b': 'y'},
+        {'a': '2', 'b': 'x'},
+        {'b': 'x_z'},
+    ]
+    for i, lbls in enumerate(labels):
+        db.store_run(new_run('s1', lbls, f'u{i}'), f'u{i}', prj)
+
+    def uids(*labels):
+        runs = db.list_runs(project=prj, labels=list(labels))
+        return {run['metadata']['uid'] for run in runs}
+
+    assert {'u0'} == uids('a=1', 'b=x'), 'and'
+    assert {'u0', 'u1'} == uids('a', 'a=1'), 'name and value'
+    assert set() == uids('a=2', 'b=y'), 'empty intersection'
+    assert {'u2', 'u3'} == uids('b', 'a!=1'), 'not equal'
+    assert {'u3'} == uids('b~=_'), 'contains'
+
+    stats = db.label_stats(prj)
+    assert {'a': {'1': 2, '2': 1}, 'b': {'x': 2, 'y': 1, 'x_z': 1}} == stats
+
+    db.store_artifact('k1', {'labels': {'c': 'v'}}, 'u0', project=prj)
+    assert {'c': {'v': 1}} == db.label_stats(prj, 'artifacts'), 'artifacts'
+    with pytest.raises(ValueError):
+        db.label_stats(prj, 'bad')
+
+
+def test_compression(db: RunDBInterface):
+    pytest.importorskip('zstandard')
+    getattr(db, 'db', db).compressor = Compressor('zstd', min_size=16)
+    prj = 'p51'
+    runs = []
+    for i in range(20):
+        run = new_run('completed', {'kind': 'job'}, f'u{i}')
+        run['spec'] = {'parameters': {'p1': i, 'p2': 'x' * 50}}
+        db.store_run(run, f'u{i}', prj)
+        runs.append(run)
+    assert 'runs' in db.train_compression(), 'train'
+    db.store_run(runs[0], 'u0', prj)
+
+    assert runs[0] == db.read_run('u0', prj), 'read compressed'
+    assert runs[1] == db.read_run('u1', prj), 'read raw'
+    uids = {run['metadata']['uid'] for run in db.list_runs(project=prj)}
+    assert 20 == len(uids), 'list'
+    stats = db.storage_stats()['runs']
+    assert 1 <= stats['compressed_rows'], 'compressed rows'
+    assert stats['raw_bytes'] > stats['stored_bytes'], 'stats'
+
+
+def test_archive(db: RunDBInterface):
+    getattr(db, 'db', db).archive = RunArchive(mkdtemp())
+    prj = 'p52'
+    old = new_run('completed', {'kind': 'job'}, 'u1')
+    old['status']['start_time'] = '2019-05-01T10:00:00.000000Z'
+    db.store_run(old, 'u1', prj)
+    db.store_log('u1', prj, b'old log')
+    db.store_run(new_run('completed', {'kind': 'job'}, 'u2'), 'u2', prj)
+
+    counts = db.archive_runs(30, prj)
+    assert {'runs': 1, 'logs': 1} == {
+        kind: counts[kind] for kind in ('runs', 'logs')}, 'counts'
+    assert db.archive_runs(30, prj)['runs'] == 0, 'archived twice'
+
+    def uids(**kw):
+        return {run['metadata']['uid']
+                for run in db.list_runs(project=prj, **kw)}
+
+    assert {'u2'} == uids(), 'list'
+    assert {'u1', 'u2'} == uids(archived=True), 'list archived'
+    assert old == db.read_run('u1', prj), 'read'
+    assert b'old log' == db.get_log('u1', prj)[1], 'log'
+
+    db.store_log('u1', prj, b' more', append=True)
+    assert b'old log more' == db.get_log('u1', prj)[1], 'append'
+    db.update_run({'status.state': 'error'}, 'u1', prj)
+    assert {'u1', 'u2'} == uids(), 'rehydrate'
+    assert 'error' == db.read_run('u1', prj)['status']['state'], 'update'
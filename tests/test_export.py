@@ -0,0 +1,104 @@
+# Copyright 2019 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta
+from tempfile import mkdtemp
+
+import pytest
+
+from conftest import new_run
+from mlrun.db import FileRunDB, RunDBError, SQLDB
+from mlrun.db.archive import RunArchive
+from mlrun.db.export import RunExport
+from mlrun.db.sqldb import run_time_fmt
+
+
+@pytest.fixture(params=['sql', 'file'])
+def db(request):
+    path = mkdtemp()
+    if request.param == 'sql':
+        db = SQLDB(f'sqlite:///{path}/mlrun.db?check_same_thread=false')
+    else:
+        db = FileRunDB(path)
+    return db.connect()
+
+
+def store_runs(db, prj, start, count, state='completed'):
+    for i in range(start, start + count):
+        run = new_run(state, {'kind': 'job'}, f'u{i}')
+        run['metadata']['name'] = 'train'
+        start_time = datetime.now() - timedelta(minutes=100 - i)
+        run['status']['start_time'] = start_time.strftime(run_time_fmt)
+        run['spec'] = {'parameters': {'lr': [0.1, 0.2][i % 2]}}
+        run['status']['results'] = {'accuracy': i / 100}
+        db.store_run(run, f'u{i}', prj)
+
+
+def test_export(db):
+    prj = 'p1'
+    exp = RunExport(mkdtemp())
+    store_runs(db, prj, 0, 10)
+    store_runs(db, prj, 10, 1, state='running')
+    assert 10 == exp.export(db, prj), 'first export'
+    assert 0 == exp.export(db, prj), 'nothing new'
+
+    store_runs(db, prj, 10, 1)  # done
+    store_runs(db, prj, 11, 4)
+    assert 5 == exp.export(db, prj), 'incremental'
+
+    df = exp.query(prj)
+    assert 15 == len(df), 'rows'
+    assert sorted(df['uid']) == sorted(f'u{i}' for i in range(15)), 'uids'
+    assert {'label.kind', 'param.lr', 'result.accuracy'} < set(df.columns)
+
+    df = exp.query(
+        prj, columns=['uid', 'result.accuracy'],
+        where=['result.accuracy >= 0.1', 'state == completed'])
+    assert ['uid', 'result.accuracy'] == list(df.columns), 'columns'
+    assert 5 == len(df), 'filter'
+
+    df = exp.query(
+        prj, group_by=['param.lr'], agg={'result.accuracy': ['max', 'count']})
+    by_lr = {
+        row['param.lr']: row['result.accuracy_max']
+        for _, row in df.iterrows()
+    }
+    assert {0.1: 0.14, 0.2: 0.13} == by_lr, 'group by'
+
+    with pytest.raises(RunDBError):
+        exp.query(prj, where=['nope > 1'])
+
+
+def test_export_types(db):
+    prj = 'p2'
+    exp = RunExport(mkdtemp())
+    store_runs(db, prj, 0, 2)
+    exp.export(db, prj)
+    run = new_run('completed', {}, 'x1')
+    run['spec'] = {'parameters': {'lr': 'high'}}
+    db.store_run(run, 'x1', prj)
+    exp.export(db, prj)
+
+    assert 'double' == exp.columns(prj)['param.lr'], 'first type wins'
+    df = exp.query(prj, columns=['uid', 'param.lr'], where=['uid == x1'])
+    assert df['param.lr'].isnull().all(), 'not converted'
+
+
+def test_export_archived(db):
+    prj = 'p3'
+    exp = RunExport(mkdtemp())
+    store_runs(db, prj, 0, 3)
+    db.archive = RunArchive(mkdtemp())
+    assert 3 == db.archive_runs(0, prj)['runs'], 'archive'
+    assert 3 == exp.export(db, prj), 'archived runs not exported'
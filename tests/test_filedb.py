@@ -12,12 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import multiprocessing
 from datetime import datetime, timedelta, timezone
+from os import listdir, path, stat, utime
 from tempfile import mkdtemp
+from threading import Thread
 
+import numpy as np
 import pytest
 
-from mlrun.db import FileRunDB
+from mlrun.config import config
+from mlrun.db import FileRunDB, RunDBConflictError, RunDBError
+from mlrun.db.archive import RunArchive
 
 
 @pytest.fixture
@@ -72,19 +78,409 @@ def test_list_artifact_date(db: FileRunDB):
     db.store_artifact('k2', {'updated': t2.isoformat()}, 'u2', project=prj)
     db.store_artifact('k3', {'updated': t3.isoformat()}, 'u3', project=prj)
 
-    # FIXME: We get double what we expect since latest is an alias
     arts = db.list_artifacts(project=prj, since=t3, tag='*')
-    assert 6 == len(arts), 'since t3'
+    assert 3 == len(arts), 'since t3'
 
     arts = db.list_artifacts(project=prj, since=t2, tag='*')
-    assert 4 == len(arts), 'since t2'
+    assert 2 == len(arts), 'since t2'
 
     arts = db.list_artifacts(
         project=prj, since=t1 + timedelta(days=1), tag='*')
     assert not arts, 'since t1+'
 
     arts = db.list_artifacts(project=prj, until=t2, tag='*')
-    assert 4 == len(arts), 'until t2'
+    assert 2 == len(arts), 'until t2'
 
     arts = db.list_artifacts(project=prj, since=t2, until=t2, tag='*')
-    assert 2 == len(arts), 'since/until t2'
+    assert 1 == len(arts), 'since/until t2'
+
+
+def new_run(name, uid, labels=None, state='completed', start=''):
+    return {
+        'metadata': {'name': name, 'uid': uid, 'labels': labels or {}},
+        'status': {'state': state, 'start_time': start},
+    }
+
+
+def test_file_index(db: FileRunDB):
+    prj = 'p8'
+    for i in range(5):
+        run = new_run(
+            f'run{i % 2}', f'u{i}', {'owner': f'o{i % 3}'},
+            start=f'2020-01-0{i + 1}T00:00:00')
+        db.store_run(run, f'u{i}', prj)
+
+    runs = db.list_runs(project=prj, last=2)
+    assert ['u4', 'u3'] == [r['metadata']['uid'] for r in runs], 'last'
+    runs = db.list_runs(name='run1', project=prj)
+    assert {'u1', 'u3'} == {r['metadata']['uid'] for r in runs}, 'name'
+    runs = db.list_runs(project=prj, labels=['owner=o0'])
+    assert {'u0', 'u3'} == {r['metadata']['uid'] for r in runs}, 'labels'
+    runs = db.list_runs(project=prj, labels=['owner!=o0'])
+    assert 3 == len(runs), 'not equal label'
+
+    db.del_run('u0', prj)
+    runs = db.list_runs(project=prj, labels=['owner=o0'])
+    assert ['u3'] == [r['metadata']['uid'] for r in runs], 'del'
+
+    # Only the returned runs are read
+    loaded = []
+    loads = db._loads
+    db._loads = lambda *args: loaded.append(args) or loads(*args)
+    db.list_runs(project=prj, last=1)
+    assert 1 == len(loaded), 'loaded files'
+
+
+def test_file_index_rebuild(db: FileRunDB):
+    prj = 'p9'
+    db.use_index = False
+    for i in range(3):
+        db.store_run(new_run('run', f'u{i}'), f'u{i}', prj)
+    db.store_artifact('k1', {'key': 'k1'}, 'u1', project=prj)
+
+    db.use_index = True  # Built from the files on first use
+    assert 3 == len(db.list_runs(project=prj)), 'runs'
+    assert 1 == len(db.list_artifacts(project=prj, tag='*')), 'artifacts'
+
+    index = db._index('runs', prj)
+    with open(index.filepath, 'a') as fp:
+        fp.write('{"path": "u9.y')  # Crashed writer
+    db.store_run(new_run('run', 'u3'), 'u3', prj)
+    assert 4 == len(db.list_runs(project=prj)), 'partial line'
+
+    counts = db.rebuild_index(project=prj)
+    assert {'runs': 4, 'artifacts': 2, 'functions': 0} == counts
+    assert 4 == index.stats()['lines'], 'rebuilt'
+
+
+@pytest.mark.parametrize('fmt', ['.json', '.yaml'])
+def test_convert_format(db: FileRunDB, fmt):
+    prj = 'p10'
+    db.store_run(new_run('run', 'u1', {'owner': 'o1'}), 'u1', prj)
+    db.store_artifact('k1', {'key': 'k1'}, 'u1', project=prj)
+    db.store_function({'x': 1}, 'f1', prj)
+    db.store_schedule({'i': 1})
+
+    counts = db.convert_format(fmt)
+    expected = 0 if fmt == '.yaml' else 1
+    assert expected == counts['runs'], 'runs'
+    assert 2 * expected == counts['artifacts'], 'artifacts'
+    assert expected == counts['functions'], 'functions'
+    assert expected == counts['schedules'], 'schedules'
+
+    assert 'u1' == db.read_run('u1', prj)['metadata']['uid'], 'read run'
+    assert 1 == len(db.list_runs(project=prj, labels=['owner=o1']))
+    assert 'k1' == db.read_artifact('k1', project=prj)['key'], 'artifact'
+    assert 1 == len(db.list_artifacts(project=prj, tag='*')), 'artifacts'
+    assert 1 == db.get_function('f1', prj)['x'], 'function'
+    assert [{'i': 1}] == list(db.list_schedules()), 'schedules'
+
+
+def test_mixed_formats(db: FileRunDB):
+    prj = 'p11'
+    db.store_run(new_run('run', 'u1'), 'u1', prj)
+    db.format = '.json'
+    db.store_run(new_run('run', 'u2'), 'u2', prj)
+    db.store_run(new_run('run', 'u1', state='error'), 'u1', prj)
+    db.use_index = False
+
+    runs = db.list_runs(project=prj)
+    assert {'u1', 'u2'} == {r['metadata']['uid'] for r in runs}, 'list'
+    assert 'error' == db.read_run('u1', prj)['status']['state'], 'replaced'
+    db.format = '.yaml'
+    assert 'u2' == db.read_run('u2', prj)['metadata']['uid'], 'other format'
+
+
+def test_numpy_results(db: FileRunDB):
+    run = new_run('run', 'u1')
+    run['status']['results'] = {
+        'accuracy': np.float64(0.5), 'epochs': np.int64(3),
+        'scores': np.array([1, 2])}
+    db.store_run(run, 'u1', 'p20')
+    results = db.read_run('u1', 'p20')['status']['results']
+    assert {'accuracy': 0.5, 'epochs': 3, 'scores': [1, 2]} == results
+
+
+def test_patch_version(db: FileRunDB):
+    prj, uid = 'p21', 'u1'
+    db.store_run(new_run('run', uid), uid, prj)
+    filepath = db._find_file(*db._run_paths(prj, uid))
+    mtime = stat(filepath).st_mtime_ns
+    version = db.patch_run([], uid, prj)
+    new_version = db.patch_run(
+        {'status.state': 's2'}, uid, prj, version=version)
+    assert new_version > version, 'patch version'
+    utime(filepath, ns=(mtime, mtime))  # Written in the same clock tick
+    with pytest.raises(RunDBConflictError):
+        db.patch_run({'status.state': 's3'}, uid, prj, version=version)
+
+    db.store_run(new_run('run', uid), uid, prj)
+    assert db.patch_run([], uid, prj) > new_version, 'store_run'
+    with pytest.raises(RunDBConflictError):
+        db.patch_run({'status.state': 's3'}, uid, prj, version=new_version)
+    assert '_version' not in db.read_run(uid, prj), 'read'
+    assert '_version' not in db.list_runs(project=prj)[0], 'list'
+
+
+def store_runs(db, prj, count):
+    """Store runs started a minute apart, files modified at the start"""
+    start = datetime.now(timezone.utc) - timedelta(days=1)
+    for i in range(count):
+        run_start = start + timedelta(minutes=i)
+        db.store_run(
+            new_run(f'run{i % 3}', f'u{i}', start=run_start.isoformat()),
+            f'u{i}', prj)
+        filepath = db._filepath('runs', prj, f'u{i}', '') + db.format
+        utime(filepath, (run_start.timestamp(), run_start.timestamp()))
+
+
+def test_scan_last(db: FileRunDB, monkeypatch):
+    prj = 'p12'
+    monkeypatch.setattr(config.httpdb, 'file_load_workers', 1)
+    monkeypatch.setattr(config.httpdb, 'file_mtime_slack', 0)
+    db.use_index = False
+    store_runs(db, prj, 20)
+
+    loaded = []
+    loads = db._loads
+    db._loads = lambda *args: loaded.append(args) or loads(*args)
+    runs = db.list_runs(project=prj, last=3)
+    assert ['u19', 'u18', 'u17'] == [r['metadata']['uid'] for r in runs]
+    assert 4 == len(loaded), 'early stop'
+
+    del loaded[:]
+    runs = db.list_runs(name='run1', project=prj, last=2)
+    assert ['u19', 'u16'] == [r['metadata']['uid'] for r in runs], 'name'
+    assert len(loaded) < 20, 'early stop with filter'
+
+
+def test_load_concurrent(db: FileRunDB, monkeypatch):
+    prj = 'p13'
+    db.use_index = False
+    store_runs(db, prj, 50)
+    monkeypatch.setattr(config.httpdb, 'file_load_workers', 1)
+    expected = db.list_runs(project=prj, last=0)
+    monkeypatch.setattr(config.httpdb, 'file_load_workers', 4)
+    assert expected == db.list_runs(project=prj, last=0), 'list'
+    runs = db.list_runs(project=prj, last=5)
+    assert expected[:5] == runs, 'last'
+
+
+def test_pages_load(db: FileRunDB):
+    prj = 'p31'
+    store_runs(db, prj, 10)
+    for i in range(5):
+        art = {'updated': f'2020-03-01T10:00:0{i}+00:00'}
+        db.store_artifact(f'k{i}', art, f'u{i}', project=prj)
+
+    loaded = []
+    loads = db._loads
+    db._loads = lambda *args: loaded.append(args) or loads(*args)
+    runs, cursor = db.list_runs_page(project=prj, page_size=3)
+    assert ['u9', 'u8', 'u7'] == [r['metadata']['uid'] for r in runs]
+    assert 3 == len(loaded), 'run page loads'
+    runs, _ = db.list_runs_page(project=prj, page_size=3, cursor=cursor)
+    assert ['u6', 'u5', 'u4'] == [r['metadata']['uid'] for r in runs]
+
+    del loaded[:]
+    arts, cursor = db.list_artifacts_page(project=prj, tag='*', page_size=2)
+    assert ['2020-03-01T10:00:04+00:00', '2020-03-01T10:00:03+00:00'] == [
+        art['updated'] for art in arts], 'artifact page'
+    assert 2 == len(loaded), 'artifact page loads'
+
+
+def test_index_stats(db: FileRunDB):
+    prj = 'p32'
+    for i in range(4):
+        run = new_run(f'run{i % 2}', f'u{i}', {'a': str(i % 2)})
+        run['status']['start_time'] = '2020-03-01T10:00:00+00:00'
+        run['status']['last_update'] = f'2020-03-01T10:00:0{i}+00:00'
+        db.store_run(run, f'u{i}', prj)
+    db.store_function({'metadata': {'labels': {'b': 'x'}}}, 'f1', prj)
+
+    loaded = []
+    loads = db._loads
+    db._loads = lambda *args: loaded.append(args) or loads(*args)
+    groups = db.aggregate_runs(prj, group_by=['label.a'], percentiles=[])
+    assert [2, 2] == [group['count'] for group in groups], 'counts'
+    assert [1, 2] == [group['duration']['avg'] for group in groups]
+    assert {'a': {'0': 2, '1': 2}} == db.label_stats(prj), 'runs'
+    assert {'b': {'x': 1}} == db.label_stats(prj, 'functions'), 'functions'
+    assert not loaded, 'files loaded'
+
+    index = db._index('runs', prj)
+    index.rebuild(
+        (relpath, {k: v for k, v in fields.items() if k != 'last_update'})
+        for relpath, fields in index.entries())
+    groups = db.aggregate_runs(prj, percentiles=[])
+    assert 1.5 == groups[0]['duration']['avg'], 'old index'
+
+
+def fill_project(db, prj):
+    for i in range(3):
+        db.store_run(new_run('run', f'u{i}', {'owner': 'o1'}), f'u{i}', prj)
+        db.store_log(f'u{i}', prj, b'log')
+    db.store_run(new_run('run', 'u0'), 'u0', prj, iter=1)
+    db.store_artifact('k1', {'key': 'k1'}, 'u1', project=prj)
+    db.store_artifact('k2', {'key': 'k2'}, 'u2', tag='v1', project=prj)
+
+
+def check_project(db, prj):
+    assert 'u1' == db.read_run('u1', prj)['metadata']['uid'], 'read run'
+    assert 'u0' == db.read_run('u0', prj, iter=1)['metadata']['uid'], 'iter'
+    assert b'log' == db.get_log('u2', prj)[1], 'log'
+    assert 3 == len(db.list_runs(project=prj, labels=['owner=o1'])), 'runs'
+    assert 'k2' == db.read_artifact('k2', 'v1', project=prj)['key'], 'tag'
+    assert 1 == len(db.list_artifacts(project=prj)), 'latest'
+    assert 1 == len(db.list_artifacts(project=prj, tag='v1')), 'v1'
+    assert 2 == len(db.list_artifacts(project=prj, tag='*')), 'all'
+
+
+@pytest.mark.parametrize('use_index', [True, False])
+def test_hashed_layout(db: FileRunDB, monkeypatch, use_index):
+    monkeypatch.setattr(config.httpdb, 'file_layout', 'hashed')
+    db.use_index = use_index
+    prj = 'p14'
+    fill_project(db, prj)
+    check_project(db, prj)
+
+    rundir = db._table_dir('runs', prj)
+    names = [name for name in listdir(rundir) if not name.startswith('.')]
+    assert all(len(name) == 2 for name in names), 'hash directories'
+    assert 'hashed' == db._layout('runs', prj)['layout'], 'manifest'
+
+    db.del_run('u1', prj)
+    db.del_artifacts(project=prj, tag='v1')
+    assert 2 == len(db.list_runs(project=prj, labels=['owner'])), 'del'
+    assert 0 == len(db.list_artifacts(project=prj, tag='v1')), 'del'
+
+
+def test_migrate_layout(db: FileRunDB, monkeypatch):
+    prj = 'p15'
+    fill_project(db, prj)  # Flat
+    monkeypatch.setattr(config.httpdb, 'file_layout', 'hashed')
+    check_project(FileRunDB(db.dirpath).connect(), prj)  # Still readable
+
+    counts = db.migrate_layout('hashed')
+    assert {'runs': 7, 'artifacts': 4} == counts, 'hashed'
+    check_project(db, prj)
+    check_project(FileRunDB(db.dirpath).connect(), prj)
+    assert {'runs': 0, 'artifacts': 0} == db.migrate_layout('hashed')
+
+    counts = db.migrate_layout('flat')
+    assert {'runs': 7, 'artifacts': 4} == counts, 'flat'
+    check_project(db, prj)
+    rundir = db._table_dir('runs', prj)
+    assert not [name for name in listdir(rundir) if len(name) == 2]
+
+
+def test_atomic_write(db: FileRunDB):
+    prj = 'p16'
+    db.store_run(new_run('run', 'u1'), 'u1', prj)
+    filepath = db._filepath('runs', prj, 'u1', '') + db.format
+    with pytest.raises(TypeError):
+        db._put(filepath, 17)  # Fails mid write
+    assert 'u1' == db.read_run('u1', prj)['metadata']['uid'], 'intact'
+    assert ['.layout.json', 'u1.yaml'] == sorted(
+        name for name in listdir(path.dirname(filepath))
+        if name.endswith(('.yaml', '.tmp', '.json'))), 'temp files'
+
+
+def increment(dirpath, prj, count):
+    db = FileRunDB(dirpath).connect()
+    for _ in range(count):
+        db.patch_run([{'op': 'inc', 'key': 'status.count'}], 'u1', prj)
+
+
+def test_concurrent_patch(db: FileRunDB):
+    prj = 'p17'
+    db.store_run(new_run('run', 'u1'), 'u1', prj)
+    threads = [
+        Thread(target=increment, args=(db.dirpath, prj, 20))
+        for _ in range(4)]
+    ctx = multiprocessing.get_context('fork')
+    procs = [
+        ctx.Process(target=increment, args=(db.dirpath, prj, 20))
+        for _ in range(2)]
+    for worker in threads + procs:
+        worker.start()
+    for worker in threads + procs:
+        worker.join()
+    assert 120 == db.read_run('u1', prj)['status']['count'], 'lost updates'
+
+
+def test_write_behind(db: FileRunDB, monkeypatch):
+    prj = 'p18'
+    monkeypatch.setattr(config.httpdb, 'file_write_behind', 60)
+    db = FileRunDB(db.dirpath).connect()
+    puts = []
+    put = db._put
+    db._put = lambda *args: puts.append(args[0]) or put(*args)
+
+    run = new_run('run', 'u1')
+    db.store_run(run, 'u1', prj)
+    run['status']['state'] = 'running'  # Buffered runs are copies
+    db.update_run({'status.state': 'error'}, 'u1', prj)
+    db.store_run(new_run('run', 'u2'), 'u2', prj)
+    assert not puts, 'written'
+    assert 'error' == db.read_run('u1', prj)['status']['state'], 'read'
+
+    assert 2 == len(db.list_runs(project=prj)), 'list'
+    assert 2 == len(puts), 'coalesced'
+    db.update_run({'status.state': 'completed'}, 'u1', prj)
+    db.flush()
+    db.flush()
+    assert 3 == len(puts), 'flush'
+    other = FileRunDB(db.dirpath).connect()
+    assert 'completed' == other.read_run('u1', prj)['status']['state']
+
+
+def test_object_store(db: FileRunDB, monkeypatch):
+    prj = 'p19'
+    monkeypatch.setattr(config.httpdb, 'file_list_page_size', 2)
+    # The object store code path, on the local file store
+    db._local = False
+    db.use_index = False
+    fill_project(db, prj)
+    check_project(db, prj)
+    check_project(FileRunDB(db.dirpath).connect(), prj)
+    assert [{'name': prj}] == db.list_projects(), 'projects'
+    db.store_log('u2', prj, b'+', append=True)
+    assert b'log+' == db.get_log('u2', prj)[1], 'append'
+    assert b'' == db.get_log('u2', prj, offset=10)[1], 'offset'
+
+    gets = []
+    get = db._get
+    db._get = lambda *args: gets.append(args[0]) or get(*args)
+    assert 3 == len(db.list_runs(project=prj, labels=['owner=o1']))
+    assert not gets, 'cached'
+    db.update_run({'status.state': 'error'}, 'u1', prj)
+    del gets[:]
+    runs = db.list_runs(project=prj, labels=['owner=o1'])
+    assert 'error' in [r['status']['state'] for r in runs], 'updated'
+    assert 1 == len(gets) and 'u1' in gets[0], 'etag changed'
+
+    db.del_run('u0', prj, iter=1)
+    assert 3 == len(db.list_runs(project=prj)), 'deleted'
+    with pytest.raises(RunDBError):
+        db.rebuild_index()
+
+
+def test_archive_concurrent_patch(db: FileRunDB):
+    prj = 'p30'
+    for uid in ['u1', 'u2']:
+        db.store_run(
+            new_run('run', uid, start='2019-01-01T00:00:00'), uid, prj)
+    db.archive = archive = RunArchive(mkdtemp())
+    write = archive.write
+
+    def patched_write(*args):
+        # Patched after the archive scan, before the stubs are written
+        db.patch_run({'status.state': 'patched'}, 'u1', prj)
+        archive.write = write
+        return write(*args)
+
+    archive.write = patched_write
+    assert 1 == db.archive_runs(30, prj)['runs'], 'archived'
+    assert 'patched' == db.read_run('u1', prj)['status']['state'], 'lost'
+    assert 1 == len(db.list_runs(project=prj)), 'u1 not archived'
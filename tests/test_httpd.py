@@ -1,10 +1,12 @@
 from http import HTTPStatus
+from tempfile import mkdtemp
 from uuid import uuid4
 from contextlib import contextmanager
 
 import pytest
 
 from mlrun.db import httpd, sqldb
+from mlrun.db.archive import RunArchive
 
 
 @contextmanager
@@ -105,6 +107,8 @@ def test_tag(client):
         query = {'functions': {'name': name}}
         resp = client.post(f'/api/{prj}/tag/{tag}', json=query)
         assert resp.status_code == HTTPStatus.OK, 'status tag'
+    resp = client.post(f'/api/{prj}/tag/{tag}', json={'nope': {}})
+    assert resp.status_code == HTTPStatus.BAD_REQUEST, 'unknown type'
 
     resp = client.get(f'/api/{prj}/tag/{tag}')
     assert resp.status_code == HTTPStatus.OK, 'status get tag'
@@ -116,3 +120,151 @@ def test_tag(client):
     resp = client.get(f'/api/{prj}/tags')
     assert resp.status_code == HTTPStatus.OK, 'list tags'
     assert tag not in resp.json['tags'], 'tag not deleted'
+
+
+def test_list_runs_pages(client):
+    prj, count = 'prj8', 7
+    for i in range(count):
+        run = {
+            'metadata': {'name': 'r', 'uid': f'u{i}'},
+            'status': {'start_time': f'2020-03-01T10:00:{i:02d}'},
+        }
+        resp = client.post(f'/api/run/{prj}/u{i}', json=run)
+        assert resp.status_code == HTTPStatus.OK, 'store run'
+
+    uids, cursor = [], ''
+    for _ in range(count):
+        resp = client.get(
+            f'/api/runs?project={prj}&page_size=3&cursor={cursor}')
+        assert resp.status_code == HTTPStatus.OK, 'list runs'
+        uids.extend(run['metadata']['uid'] for run in resp.json['runs'])
+        cursor = resp.json['next_cursor']
+        if not cursor:
+            break
+
+    assert [f'u{i}' for i in reversed(range(count))] == uids, 'pages'
+
+
+def test_batch(client):
+    prj = 'prj9'
+    ops = [
+        {'op': 'store_run', 'struct': {'metadata': {'uid': 'u1'}},
+         'uid': 'u1', 'project': prj},
+        {'op': 'update_run', 'updates': {'status.state': 'done'},
+         'uid': 'u1', 'project': prj},
+    ]
+    resp = client.post('/api/batch', json={'ops': ops})
+    assert resp.status_code == HTTPStatus.OK, 'batch'
+    assert 2 == resp.json['count'], 'count'
+
+    resp = client.get(f'/api/run/{prj}/u1')
+    assert 'done' == resp.json['data']['status']['state'], 'state'
+
+    resp = client.post('/api/batch', json={'ops': [{'op': 'del_run'}]})
+    assert resp.status_code != HTTPStatus.OK, 'bad op'
+
+
+def test_patch_run(client):
+    prj, uid = 'prj10', 'u10'
+    resp = client.post(f'/api/run/{prj}/{uid}', json={'metadata': {}})
+    assert resp.status_code == HTTPStatus.OK, 'store'
+    resp = client.post(f'/api/run/{prj}/{uid}/patch', json={'ops': []})
+    version = resp.json['version']
+
+    ops = [{'op': 'inc', 'key': 'status.retries'}]
+    body = {'ops': ops, 'version': version}
+    resp = client.post(f'/api/run/{prj}/{uid}/patch', json=body)
+    assert resp.status_code == HTTPStatus.OK, 'patch'
+    resp = client.post(f'/api/run/{prj}/{uid}/patch', json=body)
+    assert resp.status_code == HTTPStatus.CONFLICT, 'conflict'
+
+    resp = client.get(f'/api/run/{prj}/{uid}')
+    assert 1 == resp.json['data']['status']['retries'], 'retries'
+
+
+def test_aggregate_runs(client):
+    prj = 'prj11'
+    for i, state in enumerate(['completed', 'error', 'completed']):
+        run = {'metadata': {'name': 'n1'}, 'status': {'state': state}}
+        resp = client.post(f'/api/run/{prj}/u{i}', json=run)
+        assert resp.status_code == HTTPStatus.OK, 'store'
+
+    params = {'project': prj, 'group_by': 'name,state'}
+    resp = client.get('/api/runs/aggregate', query_string=params)
+    assert resp.status_code == HTTPStatus.OK, 'aggregate'
+    counts = {group['state']: group['count'] for group in resp.json['groups']}
+    assert {'completed': 2, 'error': 1} == counts, 'counts'
+
+    params['bucket'] = 'year'
+    resp = client.get('/api/runs/aggregate', query_string=params)
+    assert resp.status_code != HTTPStatus.OK, 'bad bucket'
+
+
+def test_query_results(client):
+    prj = 'prj12'
+    for i in range(3):
+        run = {'metadata': {'uid': f'u{i}'}, 'status': {'results': {'a': i}}}
+        resp = client.post(f'/api/run/{prj}/u{i}', json=run)
+        assert resp.status_code == HTTPStatus.OK, 'store'
+
+    params = {'project': prj, 'where': 'a>0', 'order_by': 'a', 'limit': 1}
+    resp = client.get('/api/runs/results', query_string=params)
+    assert resp.status_code == HTTPStatus.OK, 'query'
+    assert ['u2'] == [r['metadata']['uid'] for r in resp.json['runs']], 'top'
+
+
+def test_label_stats(client):
+    prj = 'prj13'
+    for i in range(3):
+        labels = {'a': str(i % 2)}
+        run = {'metadata': {'uid': f'u{i}', 'labels': labels}}
+        resp = client.post(f'/api/run/{prj}/u{i}', json=run)
+        assert resp.status_code == HTTPStatus.OK, 'store'
+
+    params = {'project': prj}
+    resp = client.get('/api/labels', query_string=params)
+    assert resp.status_code == HTTPStatus.OK, 'stats'
+    assert {'a': {'0': 2, '1': 1}} == resp.json['labels'], 'labels'
+
+    params['kind'] = 'nope'
+    resp = client.get('/api/labels', query_string=params)
+    assert resp.status_code == HTTPStatus.BAD_REQUEST, 'bad kind'
+
+
+def test_storage_stats(client):
+    resp = client.get('/api/db/storage')
+    assert resp.status_code == HTTPStatus.OK, 'status'
+    assert 'runs' in resp.json['stats'], 'runs stats'
+
+
+def test_list_archived_runs(client):
+    prj = 'prj14'
+    run = {'metadata': {'uid': 'u1'}, 'status': {
+        'start_time': '2019-05-01T10:00:00.000000Z'}}
+    resp = client.post(f'/api/run/{prj}/u1', json=run)
+    assert resp.status_code == HTTPStatus.OK, 'store'
+    httpd._db.archive = RunArchive(mkdtemp())
+    assert 1 == httpd._db.archive_runs(30, prj)['runs'], 'archive'
+
+    params = {'project': prj}
+    resp = client.get('/api/runs', query_string=params)
+    assert [] == resp.json['runs'], 'archived listed'
+    params['archived'] = 'yes'
+    resp = client.get('/api/runs', query_string=params)
+    assert ['u1'] == [r['metadata']['uid'] for r in resp.json['runs']]
+    params['page_size'] = 10
+    resp = client.get('/api/runs', query_string=params)
+    assert ['u1'] == [r['metadata']['uid'] for r in resp.json['runs']]
+
+
+def test_del_runs(client):
+    prj = 'prj15'
+    for uid in ['u1', 'u2']:
+        run = {'metadata': {'name': 'r', 'uid': uid}}
+        resp = client.post(f'/api/run/{prj}/{uid}', json=run)
+        assert resp.status_code == HTTPStatus.OK, 'store'
+
+    resp = client.delete('/api/runs', query_string={'project': prj})
+    assert resp.status_code == HTTPStatus.OK, 'delete'
+    resp = client.get('/api/runs', query_string={'project': prj})
+    assert [] == resp.json['runs'], 'runs left after delete'
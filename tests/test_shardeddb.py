@@ -0,0 +1,137 @@
+# Copyright 2019 Iguazio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tempfile import mkdtemp
+
+import pytest
+
+from conftest import new_run
+from mlrun.db import RunDBError, ShardedSQLDB, sqldb
+from mlrun.db.shardeddb import parse_shards
+
+
+def sqlite_dsn(path, name):
+    return f'sqlite:///{path}/{name}.db?check_same_thread=false'
+
+
+@pytest.fixture
+def db():
+    path = mkdtemp()
+    shards = {'hot': sqlite_dsn(path, 'hot')}
+    db = ShardedSQLDB(sqlite_dsn(path, 'mlrun'), shards, routes_ttl=0)
+    return db.connect()
+
+
+def uids(runs):
+    return {run['metadata']['uid'] for run in runs}
+
+
+def test_parse_shards():
+    shards = parse_shards('a=sqlite:///a.db?x=1, b=mysql://db/b')
+    assert {'a': 'sqlite:///a.db?x=1', 'b': 'mysql://db/b'} == shards
+    with pytest.raises(ValueError):
+        parse_shards('a')
+
+
+def test_routing(db: ShardedSQLDB):
+    db.set_route('p2', 'hot')
+    db.store_run(new_run('s1', {'a': '1'}, 'u1'), 'u1', 'p1')
+    db.store_run(new_run('s1', {'a': '2'}, 'u2'), 'u2', 'p2')
+
+    main, hot = db.shards['default'], db.shards['hot']
+    assert {'u1'} == uids(main.list_runs(project='*')), 'default shard'
+    assert {'u2'} == uids(hot.list_runs(project='*')), 'hot shard'
+    assert main._write_lock is not hot._write_lock, 'shared lock'
+
+    assert {'u2'} == uids(db.list_runs(project='p2')), 'routed list'
+    assert {'u1', 'u2'} == uids(db.list_runs(project='*')), 'fan out'
+    assert {'p1', 'p2'} == {prj.name for prj in db.list_projects()}
+    aggs = db.aggregate_runs('*', group_by=['state'])
+    assert [2] == [agg['count'] for agg in aggs], 'aggregate'
+
+    db.batch([
+        {'op': 'update_run', 'updates': {'status.state': 's2'},
+         'uid': 'u1', 'project': 'p1'},
+        {'op': 'update_run', 'updates': {'status.state': 's2'},
+         'uid': 'u2', 'project': 'p2'},
+    ])
+    runs = db.list_runs(project='*', state='s2')
+    assert {'u1', 'u2'} == uids(runs), 'batch'
+
+    with pytest.raises(RunDBError):
+        db.set_route('p3', 'nope')
+
+
+def test_move_project(db: ShardedSQLDB):
+    prj = 'p3'
+    for i in range(5):
+        run = new_run('completed', {'kind': 'job'}, f'u{i}')
+        run['status']['results'] = {'accuracy': i / 10}
+        db.store_run(run, f'u{i}', prj)
+    db.store_log('u0', prj, b'log')
+    db.store_artifact('k1', {'x': 1}, 'a1', tag='t1', project=prj)
+    db.store_function({'x': 2}, 'f1', prj, tag='v1')
+    db.store_run(new_run('completed', {}, 'other'), 'other', 'p4')
+    before = db.read_run('u1', prj)
+
+    counts = db.move_project(prj, 'hot', batch_size=2)
+    assert 5 == counts['runs'], 'copied runs'
+    assert 'hot' == db.route(prj), 'route'
+    hot, main = db.shards['hot'], db.shards['default']
+    assert {f'u{i}' for i in range(5)} == uids(hot.list_runs(project=prj))
+    assert not main.list_runs(project=prj), 'left in source'
+    assert {'other'} == uids(main.list_runs(project='*')), 'other project'
+
+    assert before == db.read_run('u1', prj), 'run'
+    assert b'log' == db.get_log('u0', prj)[1], 'log'
+    assert 1 == db.read_artifact('k1', 't1', project=prj)['x'], 'tag'
+    assert 1 == db.read_artifact('k1', project=prj)['x'], 'latest'
+    assert 2 == db.get_function('f1', prj, 'v1')['x'], 'function'
+    best = db.query_results(prj, order_by='accuracy', limit=1)
+    assert {'u4'} == uids(best), 'results'
+    assert {'u0'} == uids(db.list_runs(project=prj, labels=['kind=job'],
+                                       uid='u0')), 'labels'
+    assert prj in {p.name for p in db.list_projects()}, 'project'
+
+
+def test_moving_project_read_only(db: ShardedSQLDB):
+    prj = 'p5'
+    db.store_run(new_run('s1', {}, 'u1'), 'u1', prj)
+    db._save_route(prj, 'default', target='hot')
+    with pytest.raises(RunDBError):
+        db.store_run(new_run('s1', {}, 'u2'), 'u2', prj)
+    assert {'u1'} == uids(db.list_runs(project=prj)), 'reads'
+
+
+def test_sqlite_lock():
+    path = mkdtemp()
+    lock = sqldb.sqlite_lock(f'{path}/a.db')
+    assert lock is sqldb.sqlite_lock(f'{path}/x/../a.db'), 'same file'
+    assert lock is not sqldb.sqlite_lock(f'{path}/b.db'), 'other file'
+    assert sqldb.sql_lock is sqldb.sqlite_lock(':memory:'), 'memory'
+
+
+def test_tag_query(db: ShardedSQLDB):
+    prj = 'p5'
+    db.set_route(prj, 'hot')
+    db.store_function({'x': 1}, 'f1', prj, tag='v1')
+    db.store_function({'x': 2}, 'f2', prj, tag='v1')
+    db.store_function({'x': 3}, 'f1', 'p6', tag='v1')
+    count = db.tag_query(prj, 't1', {'functions': {'name': 'f1'}})
+    assert 1 == count, 'tagged'
+    assert [1] == [obj.struct['x'] for obj in db.find_tagged(prj, 't1')]
+    with pytest.raises(ValueError):
+        db.tag_query(prj, 't1', {'nope': {'name': 'f1'}})
+    with pytest.raises(ValueError):
+        db.tag_query(prj, 't1', {'functions': {'nope': 'f1'}})
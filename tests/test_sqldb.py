@@ -15,12 +15,16 @@
 
 from contextlib import contextmanager
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from tempfile import mkdtemp
 from unittest.mock import Mock
 
 import pytest
 
 from mlrun.db import sqldb
+from mlrun.db.archive import RunArchive
+from mlrun.db.compress import Compressor
 from conftest import new_run
 
 
@@ -218,6 +222,302 @@ def test_cache_projects(db: sqldb.SQLDB):
     mock.assert_called_once()
 
 
+def test_json_body():
+    db = sqldb.SQLDB(
+        'sqlite:///:memory:?check_same_thread=false', body_format='json')
+    db.connect()
+    prj = 'p19'
+    for i, name in enumerate(['n1', 'n2', 'n1']):
+        run = new_run('s1', {'kind': 'job', 'owner': 'u1'}, x=i)
+        run['metadata']['name'] = name
+        db.store_run(run, f'uid{i}', prj)
+
+    runs = db.list_runs(name='n1', project=prj)
+    assert {0, 2} == {run['x'] for run in runs}, 'name filter'
+
+    obj = db._get_run('uid1', prj, 0)
+    assert obj.body.startswith(b'{'), 'not json'
+    assert ('n2', 'job', 'u1') == (obj.name, obj.kind, obj.owner), 'columns'
+
+
+def test_migrate_bodies(db: sqldb.SQLDB):
+    prj = 'p20'
+    run = new_run('s1', {'owner': 'u2'}, x=1)
+    run['metadata']['name'] = 'n3'
+    db.store_run(run, 'uid1', prj)
+    db.store_artifact('k1', {'kind': 'plot'}, 'u1', project=prj)
+    obj = db._get_run('uid1', prj, 0)
+    obj.name = None  # simulate a row written before the projection
+    db.session.commit()
+
+    counts = db.migrate_bodies('json')
+    assert 1 == counts['runs'], 'runs count'
+    assert 1 == counts['artifacts'], 'artifacts count'
+    obj = db._get_run('uid1', prj, 0)
+    assert obj.body.startswith(b'{'), 'not json'
+    assert 'n3' == obj.name, 'name not projected'
+    assert run == db.read_run('uid1', prj), 'body'
+    assert 'plot' == db._get_artifact('u1', prj, 'k1').kind, 'artifact kind'
+
+
+def test_session_per_thread():
+    db_file = f'{mkdtemp()}/mlrun.db'
+    db = sqldb.SQLDB(f'sqlite:///{db_file}?check_same_thread=false')
+    db.connect()
+    prj = 'p21'
+    for i in range(5):
+        db.store_run(new_run('s1', {}, x=i), f'uid{i}', prj)
+
+    def read(i):
+        session = db.session()
+        try:
+            return session, db.read_run(f'uid{i % 5}', prj)['x']
+        finally:
+            db.close_session()
+
+    with ThreadPoolExecutor(4) as pool:
+        out = list(pool.map(read, range(20)))
+
+    assert [i % 5 for i in range(20)] == [x for _, x in out], 'reads'
+    assert db.session() not in {session for session, _ in out}, 'shared'
+    stats = db.pool_stats()
+    assert stats['checkouts'] >= 20, 'checkouts'
+    assert 0 == stats['checked_out'], 'connections not returned'
+
+
+def test_indexes(db: sqldb.SQLDB):
+    assert [] == sqldb.missing_indexes(db.engine), 'missing indexes'
+    plans = db.explain_queries()
+    expected = {
+        'list_runs': 'idx_runs_project_start_time',
+        'list_runs(name)': 'idx_runs_project_name_start_time',
+        'get_log': 'idx_logs_project_uid',
+        'query_results': 'idx_run_results_project_key_value',
+    }
+    for name, index in expected.items():
+        assert index in plans[name]['indexes'], f'{name} not using {index}'
+
+
+def test_batch_rollback(db: sqldb.SQLDB):
+    prj = 'p45'
+    ops = [
+        {'op': 'store_run', 'struct': new_run('s1', {}), 'uid': 'u1',
+         'project': prj},
+        {'op': 'update_run', 'updates': {'x': 1}, 'uid': 'nope',
+         'project': prj},
+    ]
+    with pytest.raises(sqldb.RunDBError):
+        db.batch(ops)
+    assert not db.list_runs(project=prj), 'batch not rolled back'
+    assert prj not in db._projects, 'project cache'
+
+
+def test_log_chunks(db: sqldb.SQLDB):
+    prj, uid = 'p71', 'u71'
+    data = bytes(range(256)) * 4
+    with patch(sqldb.config.httpdb, log_chunk_size=100):
+        for i in range(0, len(data), 70):
+            db.store_log(uid, prj, data[i:i+70], append=True)
+
+        assert len(data) == db.get_log_size(uid, prj), 'size'
+        _, log = db.get_log(uid, prj)
+        assert data == log, 'full log'
+        for offset, size in [(0, 10), (95, 10), (150, 300), (1000, 100)]:
+            _, log = db.get_log(uid, prj, offset, size)
+            assert data[offset:offset+size] == log, f'{offset}:{size}'
+
+        chunks = db.session.query(sqldb.LogChunk).all()
+        assert 11 == len(chunks), 'chunks'
+        assert all(len(chunk.body) <= 100 for chunk in chunks), 'chunk size'
+
+        db.store_log(uid, prj, b'new')
+        assert ('', b'new') == db.get_log(uid, prj), 'overwrite'
+        assert 1 == db.session.query(sqldb.LogChunk).count(), 'old chunks'
+
+
+def test_log_not_chunked(db: sqldb.SQLDB):
+    prj, uid = 'p72', 'u72'
+    db.session.add(sqldb.Log(uid=uid, project=prj, body=b'old'))
+    db.session.commit()
+    assert ('', b'ld') == db.get_log(uid, prj, 1), 'read'
+    db.store_log(uid, prj, b' new', append=True)
+    assert ('', b'old new') == db.get_log(uid, prj), 'append'
+    assert 7 == db.get_log_size(uid, prj), 'size'
+
+
+def test_del_runs_cascade(db: sqldb.SQLDB):
+    prj = 'p81'
+    for i in range(3):
+        db.store_run(new_run('s1', {'a': 'b'}), f'uid{i}', prj)
+        db.store_log(f'uid{i}', prj, b'log', append=True)
+    db.store_run(new_run('s1', {'a': 'b'}), 'uid0', prj, iter=1)
+    db.tag_objects([db._get_run('uid1', prj, 0)], prj, 't1')
+
+    db.del_runs(project=prj)
+    assert not db.list_runs(project=prj, iter=True), 'runs'
+    for cls in (sqldb.Run.Label, sqldb.Run.Tag, sqldb.Log, sqldb.LogChunk):
+        assert 0 == db.session.query(cls).count(), f'{cls.__name__} left'
+
+
+def test_retention(db: sqldb.SQLDB):
+    prj = 'p82'
+    now = datetime.now()
+    for i in range(6):
+        run = new_run('s1', {'a': 'b'}, f'uid{i}')
+        run['metadata']['name'] = 'n1' if i % 2 else 'n2'
+        run['status']['start_time'] = (now - timedelta(days=i)).isoformat()
+        db.store_run(run, f'uid{i}', prj)
+    db.store_run(new_run('s1', {}), 'other', 'p83')
+
+    counts = db.apply_retention(prj, days=3.5, batch_size=1)
+    assert {'runs': 2, 'artifacts': 0} == counts, 'days'
+    counts = db.apply_retention(prj, runs=1, batch_size=2)
+    assert {'runs': 2} == counts, 'runs per name'
+    uids = {run['metadata']['uid'] for run in db.list_runs(project=prj)}
+    assert {'uid0', 'uid1'} == uids, 'kept'
+    assert 1 == len(db.list_runs(project='p83')), 'other project'
+
+
+def test_delete_orphan_labels(db: sqldb.SQLDB):
+    db.session.add(sqldb.Run.Label(name='a', value='b', parent=None))
+    db.session.add(sqldb.Run.Label(name='a', value='b', parent=1000))
+    db.session.commit()
+    db.store_run(new_run('s1', {'a': 'b'}), 'u84', 'p84')
+    assert 2 == db.delete_orphan_labels(batch_size=1), 'count'
+    assert 1 == db.session.query(sqldb.Run.Label).count(), 'labels'
+
+
+def test_tag_cache(db: sqldb.SQLDB):
+    prj = 'p91'
+    db.store_artifact('k1', {'x': 1}, 'u1', tag='t1', project=prj)
+    assert 'u1' == db._resolve_tag(sqldb.Artifact, prj, 't1'), 'resolve'
+    db.store_artifact('k1', {'x': 2}, 'u2', tag='t1', project=prj)
+    assert 'u2' == db._resolve_tag(sqldb.Artifact, prj, 't1'), 'tag'
+    assert 2 == db.read_artifact('k1', 't1', project=prj)['x'], 'read'
+    assert 1 == db.read_artifact('k1', 'u1', project=prj)['x'], 'uid'
+
+    db.del_tag(prj, 't1')
+    assert 't1' == db._resolve_tag(sqldb.Artifact, prj, 't1'), 'del_tag'
+
+
+def test_latest_pointers(db: sqldb.SQLDB):
+    prj = 'p95'
+    t1 = datetime(2020, 2, 16)
+    t2 = t1 + timedelta(days=1)
+    db.store_artifact('k1', {'x': 1, 'updated': t2}, 'u1', project=prj)
+    db.store_artifact('k1', {'x': 2, 'updated': t1}, 'u2', project=prj)
+    db.store_artifact('k2', {'x': 3}, 'u3', project=prj)
+
+    arts = db.list_artifacts(project=prj)
+    assert [1, 3] == sorted(art['x'] for art in arts), 'list latest'
+    assert 1 == db.read_artifact('k1', project=prj)['x'], 'read latest'
+
+    db.del_artifact('k1', 'u1', project=prj)
+    assert 2 == db.read_artifact('k1', project=prj)['x'], 'after delete'
+    assert 2 == db.rebuild_latest(sqldb.Artifact), 'rebuild'
+    assert 2 == db.read_artifact('k1', project=prj)['x'], 'after rebuild'
+
+
+def test_function_latest_pointer(db: sqldb.SQLDB):
+    prj, name = 'p96', 'f96'
+    db.store_function({'x': 1}, name, prj, tag='v1')
+    db.store_function({'x': 2}, name, prj, tag='v2')
+    assert 2 == db.get_function(name, prj)['x'], 'latest'
+    assert 'v2' == db._function_latest_uid(prj, name), 'latest uid'
+    db.store_function({'x': 3}, name, prj, tag='latest')
+    db.store_function({'x': 4}, name, prj, tag='v3')
+    assert 3 == db.get_function(name, prj)['x'], 'latest tag'
+
+
+def test_patch_run_concurrent():
+    db_file = f'{mkdtemp()}/mlrun.db'
+    db = sqldb.SQLDB(f'sqlite:///{db_file}?check_same_thread=false')
+    db.connect()
+    prj, uid = 'p97', 'u97'
+    db.store_run(new_run('s1', {}), uid, prj)
+
+    def inc(_):
+        try:
+            db.patch_run([{'op': 'inc', 'key': 'status.count'}], uid, prj)
+        finally:
+            db.close_session()
+
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(inc, range(20)))
+    assert 20 == db.read_run(uid, prj)['status']['count'], 'lost update'
+
+
+@pytest.mark.parametrize('native', [True, False])
+def test_store_upsert(db: sqldb.SQLDB, native):
+    db.native_upsert = native
+    prj, uid = 'p98', 'u98'
+    run = new_run('s1', {'a': '1', 'b': '2'}, uid)
+    run['status']['results'] = {'x': 1, 'y': 2}
+    db.store_run(run, uid, prj)
+    assert prj in {p.name for p in db.list_projects()}, 'project'
+    version = db._get_run(uid, prj, 0).version
+
+    run = new_run('', {'a': '3'}, uid)
+    run['status']['results'] = {'y': 3}
+    db.store_run(run, uid, prj)
+    obj = db._get_run(uid, prj, 0)
+    assert 's1' == obj.state, 'state not kept'
+    assert {'a': '3'} == {lbl.name: lbl.value for lbl in obj.labels}
+    assert {'y': 3} == {res.key: res.value for res in obj.results}
+    assert obj.version > version, 'version'
+    assert run == db.read_run(uid, prj), 'body'
+
+    db.store_artifact('k1', {'labels': {'c': '1'}}, uid, project=prj)
+    db.store_artifact('k1', {'labels': {'c': '2'}}, uid, project=prj)
+    labels = db.list_artifacts(project=prj)[0]['labels']
+    assert {'c': '2'} == labels, 'artifact labels'
+
+    fn = {'metadata': {'labels': {'d': '1'}}}
+    db.store_function(fn, 'f1', prj)
+    fn['metadata']['labels'] = {}
+    db.store_function(fn, 'f1', prj)
+    obj = db._get_function('f1', prj, 'latest')
+    assert [] == obj.labels, 'function labels'
+    assert 1 == len(db.list_functions('f1', prj)), 'functions'
+
+
+@pytest.mark.parametrize('native', [True, False])
+def test_store_function_tagged(db: sqldb.SQLDB, native):
+    db.native_upsert = native
+    prj = 'p99'
+    db.store_function({'x': 1}, 'f1', prj)
+    db.tag_objects([db._get_function('f1', prj, 'latest')], prj, 'prod')
+    db.store_function({'x': 2}, 'f2', prj, tag='prod')
+    assert 2 == db.get_function('f2', prj, 'prod')['x'], 'tagged function'
+    assert 1 == db.get_function('f1', prj)['x'], 'other function'
+
+
+def test_store_run_concurrent():
+    db_file = f'{mkdtemp()}/mlrun.db'
+    db = sqldb.SQLDB(f'sqlite:///{db_file}?check_same_thread=false')
+    db.connect()
+    if not sqldb.has_upsert(db.engine.dialect):
+        pytest.skip('SQLite < 3.24')
+    db.native_upsert = True
+    prj = 'p99'
+
+    def store(i):
+        try:
+            uid = f'u{i % 5}'
+            db.store_run(new_run('s1', {'i': str(i)}, uid), uid, prj)
+        finally:
+            db.close_session()
+
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(store, range(40)))
+    runs = db.list_runs(project=prj)
+    assert 5 == len(runs), 'runs'
+    for uid in ('u0', 'u1', 'u2', 'u3', 'u4'):
+        obj = db._get_run(uid, prj, 0)
+        assert 1 == len(obj.labels), 'labels'
+        assert 8 == obj.version, 'lost update'
+
+
 # def test_function_latest(db: sqldb.SQLDB):
 #     fn1, t1 = {'x': 1}, 'u83'
 #     fn2, t2 = {'x': 2}, 'u23'
@@ -227,3 +527,77 @@ def test_cache_projects(db: sqldb.SQLDB):
 #
 #     fn = db.get_function(name, prj, 'latest')
 #     assert fn2 == fn, 'latest'
+
+
+def test_compression():
+    pytest.importorskip('zstandard')
+    db_file = f'{mkdtemp()}/mlrun.db'
+    dsn = f'sqlite:///{db_file}?check_same_thread=false'
+    db = sqldb.SQLDB(dsn)
+    db.connect()
+    db.compressor = Compressor('zstd', min_size=16)
+    prj = 'p100'
+
+    def hyper_run(i):
+        run = new_run('completed', {'kind': 'job'}, f'u{i}')
+        run['spec'] = {'parameters': {'p1': i, 'p2': 'x' * 50}}
+        return run
+
+    runs = [hyper_run(i) for i in range(50)]
+    for i, run in enumerate(runs):
+        db.store_run(run, f'u{i}', prj)
+    db.store_log('u0', prj, b'x' * 100000)
+    assert 'runs' in db.train_compression(), 'train'
+
+    run = hyper_run(100)
+    db.store_run(run, 'u100', prj)
+    obj = db._get_run('u100', prj, 0)
+    assert 'zstd' == obj.codec, 'codec'
+    assert obj.raw_size > len(obj.body), 'not compressed'
+
+    stats = db.storage_stats()
+    assert stats['runs']['raw_bytes'] > stats['runs']['stored_bytes']
+    assert 1 <= stats['log_chunks']['compressed_rows'], 'log chunks'
+    _, log = db.get_log('u0', prj, offset=65530, size=10)
+    assert b'x' * 10 == log, 'log'
+
+    # Dictionary loaded from the database, old rows readable
+    db = sqldb.SQLDB(dsn)
+    db.connect()
+    assert run == db.read_run('u100', prj), 'read compressed'
+    assert runs[1] == db.read_run('u1', prj), 'read raw'
+
+
+def test_archive(db: sqldb.SQLDB):
+    db.archive = RunArchive(mkdtemp())
+    prj = 'p101'
+    old = (datetime.now() - timedelta(days=40)).isoformat()
+    run = new_run('completed', {'kind': 'job'}, 'u1')
+    run['status'].update(start_time=old, results={'accuracy': 0.9})
+    db.store_run(run, 'u1', prj)
+    db.store_log('u1', prj, b'x' * 100000)
+    db.store_artifact('k1', {'x': 1, 'updated': old}, 'a1', project=prj)
+    db.store_artifact('k1', {'x': 2}, 'a2', project=prj)
+
+    counts = db.archive_runs(30, prj)
+    assert {'runs': 1, 'logs': 1, 'artifacts': 1} == counts, 'counts'
+    obj = db._get_run('u1', prj, 0)
+    assert obj.archive and obj.body is None, 'run stub'
+    assert 0 == db.session.query(sqldb.RunResult).count(), 'results'
+    runs = db.list_runs(project=prj, labels=['kind=job'], archived=True)
+    assert run == runs[0], 'labels kept'
+
+    assert 0 == db.session.query(sqldb.LogChunk).count(), 'log chunks'
+    assert 100000 == db.get_log_size('u1', prj), 'log size'
+    assert b'x' * 10 == db.get_log('u1', prj, 500, 10)[1], 'log'
+
+    arts = db.list_artifacts(project=prj, tag='*')
+    assert [2] == [art['x'] for art in arts], 'archived artifact listed'
+    assert 1 == db.read_artifact('k1', 'a1', project=prj)['x'], 'artifact'
+    assert 0 == db.migrate_bodies()['runs'], 'migrated stub'
+
+    live = new_run('completed', {'kind': 'job'}, 'u2')
+    live['status']['results'] = {'accuracy': 0.8}
+    db.store_run(live, 'u2', prj)
+    assert [live] == db.query_results(prj), 'results of archived run'
+    assert [live] == db.query_results(prj, where=['accuracy > 0.5'])